@@ -0,0 +1,150 @@
+"""Бенчмарк выбора обработчика кнопки: цепочка фильтров F.data против таблицы callback_data.
+
+Строит два aiogram Router с пустыми обработчиками. Первый повторяет прежнюю цепочку
+(F.data == ... / F.data.startswith(...) в порядке объявления, разбор id через str.replace),
+второй - один обработчик с фильтром geiu.callback_route_filter. Через оба прогоняются
+одни и те же нажатия (старый формат для цепочки, новый - для таблицы), замеряется
+TelegramEventObserver.trigger - ровно то, что делает aiogram для каждого CallbackQuery.
+
+    python bench_callback_router.py --repeat 2000
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import harness
+
+# До import geiu: бот и база создаются при импорте
+TMP_DIR = harness.prepare("bench_callback_router_")
+
+import geiu
+from aiogram import F, Router
+from aiogram.types import CallbackQuery, Chat, Message, User
+
+# Прежние фильтры кнопок в порядке объявления обработчиков: (callback_data, есть ли аргумент)
+LEGACY_CHAIN = [
+    ("main_menu", False), ("buy_stars", False), ("buy_premium", False), ("premium_", True),
+    ("exchange", False), ("info", False), ("admin_active_orders", False), ("orders_page_", True),
+    ("manage_order_", True), ("admin_confirm_payment_", True), ("admin_final_confirm_", True),
+    ("admin_reject_order_", True), ("admin_final_reject_", True), ("admin_delivered_", True),
+    ("admin_final_delivered_", True), ("admin_stats", False), ("admin_back", False), ("card_pay_", True),
+    ("crypto_pay_", True), ("check_crypto_", True), ("confirm_paid_", True), ("cancel_photo_", True),
+]
+
+# Нажатия: (старый callback_data, новый callback_data)
+PRESSES = [
+    ("main_menu", geiu.pack_callback("main_menu")),
+    ("buy_stars", geiu.pack_callback("buy_stars")),
+    ("premium_6m", geiu.pack_callback("premium", "6m")),
+    ("orders_page_wconf_n_20250101120000_4821", geiu.pack_callback("orders_page", "wconf", "n", "20250101120000", 4821)),
+    ("manage_order_4821", geiu.pack_callback("manage_order", 4821)),
+    ("admin_final_confirm_4821", geiu.pack_callback("admin_final_confirm", 4821)),
+    ("card_pay_4821", geiu.pack_callback("card_pay", 4821)),
+    ("check_crypto_4821", geiu.pack_callback("check_crypto", 4821)),
+    ("confirm_paid_4821", geiu.pack_callback("confirm_paid", 4821)),
+    ("cancel_photo_4821", geiu.pack_callback("cancel_photo", 4821)),
+]
+
+
+def legacy_router():
+    """Цепочка фильтров как до таблицы: каждый обработчик сам вырезает аргумент из строки"""
+    router = Router()
+    for data, has_arg in LEGACY_CHAIN:
+        if has_arg:
+            async def handler(callback: CallbackQuery, prefix=data):
+                return callback.data.replace(prefix, "")
+            router.callback_query.register(handler, F.data.startswith(data))
+        else:
+            async def handler(callback: CallbackQuery):
+                return None
+            router.callback_query.register(handler, F.data == data)
+    return router
+
+
+def table_router():
+    """Один обработчик: действие и типизированные аргументы приходят из фильтра"""
+    router = Router()
+
+    async def handler(callback: CallbackQuery, callback_action, callback_args):
+        return callback_args
+
+    router.callback_query.register(handler, geiu.callback_route_filter)
+    return router
+
+
+def make_callback(data):
+    user = User(id=1, is_bot=False, first_name="bench")
+    message = Message(message_id=1, date=datetime.now(), chat=Chat(id=1, type="private"), text="...")
+    return CallbackQuery(id="1", from_user=user, chat_instance="1", message=message, data=data)
+
+
+async def measure(router, callbacks, repeat):
+    """Медиана µs на одно нажатие по каждому callback_data"""
+    observer = router.callback_query
+    results = {}
+    for callback in callbacks:
+        timings = []
+        for _ in range(5):
+            started = time.perf_counter()
+            for _ in range(repeat):
+                await observer.trigger(callback)
+            timings.append((time.perf_counter() - started) / repeat * 1e6)
+        results[callback.data] = statistics.median(timings)
+    return results
+
+
+def measure_codec(repeat):
+    """Только разбор callback_data без aiogram: словарь против перебора MagicFilter"""
+    filters = [(F.data.startswith(data) if has_arg else F.data == data) for data, has_arg in LEGACY_CHAIN]
+    legacy_total = table_total = 0.0
+    for old, new in PRESSES:
+        callback = make_callback(old)
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for magic in filters:
+                if magic.resolve(callback):
+                    break
+        legacy_total += time.perf_counter() - started
+
+        started = time.perf_counter()
+        for _ in range(repeat):
+            geiu.unpack_callback(new)
+        table_total += time.perf_counter() - started
+
+    presses = repeat * len(PRESSES)
+    print(f"\nТолько разбор: цепочка MagicFilter {legacy_total / presses * 1e6:.2f} µs, "
+          f"unpack_callback {table_total / presses * 1e6:.2f} µs на нажатие")
+
+
+async def bench(repeat):
+    legacy = await measure(legacy_router(), [make_callback(old) for old, _ in PRESSES], repeat)
+    table = await measure(table_router(), [make_callback(new) for _, new in PRESSES], repeat)
+
+    print(f"{'нажатие (старый формат)':<42} {'новый формат':<30} {'цепочка µs':>10} {'таблица µs':>10}")
+    for old, new in PRESSES:
+        print(f"{old:<42} {new:<30} {legacy[old]:>10.1f} {table[new]:>10.1f}")
+    print(f"{'среднее':<73} {statistics.mean(legacy.values()):>10.1f} {statistics.mean(table.values()):>10.1f}")
+
+    # Оба варианта должны выбрать обработчик для каждого нажатия
+    for old, new in PRESSES:
+        assert geiu.unpack_callback(old) is not None and geiu.unpack_callback(new) is not None, old
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=2000, help="нажатий на каждый callback_data в одном замере")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(bench(args.repeat))
+        measure_codec(args.repeat)
+    finally:
+        geiu.db.close()
+        harness.cleanup(TMP_DIR)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
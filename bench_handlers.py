@@ -0,0 +1,271 @@
+"""Бенчмарк обработчиков: прогон синтетических апдейтов через настоящий Dispatcher.
+
+Импортирует geiu со временной базой, подменяет сессию бота на фейковую (запросы
+к Bot API только записываются) и CryptoBot на фейковый клиент, затем гоняет через
+dp.feed_update все сценарии: /start, звезды, премиум, обмен, оплата картой с фото,
+оплата CryptoBot и полный цикл админа (подтверждение и выдача).
+
+Печатает p50/p95/p99 по каждому обработчику и время в БД внутри него.
+
+    python bench_handlers.py --rounds 200 --parallel 1
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import math
+import re
+import sys
+import time
+from datetime import datetime
+
+import harness
+
+# До import geiu: бот и база создаются при импорте
+TMP_DIR = harness.prepare("bench_handlers_")
+
+import geiu
+from aiogram.types import CallbackQuery, Chat, Message, PhotoSize, Update, User
+
+ADMIN_ID = geiu.ADMIN_IDS[0]
+
+message_ids = itertools.count(1)
+update_ids = itertools.count(1)
+
+# Накопитель времени в БД для текущего апдейта
+db_time = contextvars.ContextVar("db_time", default=None)
+
+
+class Recorder:
+    """Время обработчиков и БД по имени обработчика"""
+
+    def __init__(self):
+        self.handlers = {}
+
+    async def middleware(self, handler, event, data):
+        spent = [0.0]
+        token = db_time.set(spent)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            db_time.reset(token)
+            name = geiu.handler_name(data)
+            self.handlers.setdefault(name, []).append((elapsed, spent[0]))
+
+
+def timed_db(method):
+    """Обертка Database._read/_write, добавляющая время к накопителю апдейта"""
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            spent = db_time.get()
+            if spent is not None:
+                spent[0] += time.perf_counter() - started
+    return wrapper
+
+
+class Client:
+    """Пользователь Telegram, который шлет апдейты в диспетчер"""
+
+    def __init__(self, bot, session, user_id):
+        self.bot = bot
+        self.session = session
+        self.user = User(id=user_id, is_bot=False, first_name=f"user{user_id}", username=f"user{user_id}")
+        self.chat = Chat(id=user_id, type="private")
+
+    def _message(self, **kwargs):
+        return Message(message_id=next(message_ids), date=datetime.now(), chat=self.chat, from_user=self.user, **kwargs)
+
+    async def send(self, text):
+        await geiu.dp.feed_update(self.bot, Update(update_id=next(update_ids), message=self._message(text=text)))
+
+    async def send_photo(self):
+        photo = [PhotoSize(file_id=f"PHOTO{self.user.id}", file_unique_id=f"u{self.user.id}", width=1, height=1)]
+        await geiu.dp.feed_update(self.bot, Update(update_id=next(update_ids), message=self._message(photo=photo)))
+
+    async def click(self, data):
+        callback = CallbackQuery(
+            id=str(next(message_ids)), from_user=self.user, chat_instance=str(self.user.id),
+            message=self._message(text="..."), data=data
+        )
+        await geiu.dp.feed_update(self.bot, Update(update_id=next(update_ids), callback_query=callback))
+
+    def button(self, label):
+        """callback_data кнопки из последней клавиатуры в чате, по части текста"""
+        keyboard = self.session.keyboards.get(self.user.id)
+        for row in keyboard.inline_keyboard if keyboard else []:
+            for button in row:
+                if label in button.text and button.callback_data:
+                    return button.callback_data
+        raise LookupError(f"Нет кнопки {label!r} в чате {self.user.id}")
+
+    async def press(self, label):
+        data = self.button(label)
+        await self.click(data)
+        return data
+
+
+def order_id_from(data):
+    return int(re.findall(r"\d+", data)[-1])
+
+
+async def flow_stars(client):
+    await client.send("/start")
+    await client.click("buy_stars")
+    await client.send("@someone")
+    await client.send("100")
+    return order_id_from(client.button("Перевод на карту"))
+
+
+async def flow_premium(client):
+    await client.send("/start")
+    await client.click("buy_premium")
+    await client.press("3 месяца")
+    await client.send("@friend")
+    return order_id_from(client.button("Перевод на карту"))
+
+
+async def flow_exchange(client):
+    await client.send("/start")
+    await client.click("exchange")
+    await client.send("500")
+    return order_id_from(client.button("Оплатить картой"))
+
+
+async def flow_card_payment(client, label):
+    await client.press(label)
+    await client.press("Я оплатил")
+    await client.send_photo()
+
+
+async def flow_crypto_payment(client, cryptobot):
+    await client.press("CryptoBot")
+    check = await client.press("Проверить оплату")
+    order = await geiu.db.get_order(order_id_from(check))
+    cryptobot.pay(order.invoice_id)
+    await client.click(check)
+
+
+async def open_order(admin, order_id):
+    """Найти заказ в списке активных, листая страницы, и открыть его"""
+    await admin.click("admin_active_orders")
+    while True:
+        try:
+            return await admin.press(f"#{order_id}")
+        except LookupError:
+            await admin.press("Старее")
+
+
+async def flow_admin(admin, order_id):
+    await admin.send("/admin")
+    await open_order(admin, order_id)
+    await admin.press("Подтвердить оплату")
+    await admin.press("ДА")
+    await open_order(admin, order_id)
+    await admin.press("Я передал товар")
+    await admin.press("ДА")
+    await admin.click("admin_stats")
+
+
+# Админ один и жмет кнопки по очереди; клавиатура в его чате общая для всех раундов
+admin_lock = asyncio.Lock()
+
+
+async def run_round(bot, session, cryptobot, user_id):
+    """Все сценарии одного покупателя и цикл админа по его заказу с фото"""
+    client = Client(bot, session, user_id)
+    admin = Client(bot, session, ADMIN_ID)
+
+    await flow_stars(client)
+    await flow_card_payment(client, "Перевод на карту")
+    order_id = await flow_exchange(client)
+    await flow_card_payment(client, "Оплатить картой")
+    await flow_premium(client)
+    await flow_crypto_payment(client, cryptobot)
+    async with admin_lock:
+        await flow_admin(admin, order_id)
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def report(recorder, wall, updates, calls):
+    print(f"\n{'обработчик':<32} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'БД p50':>8} {'БД %':>6}")
+    for name, samples in sorted(recorder.handlers.items(), key=lambda item: -sum(s[0] for s in item[1])):
+        totals = [s[0] * 1000 for s in samples]
+        db_totals = [s[1] * 1000 for s in samples]
+        db_share = sum(db_totals) / sum(totals) * 100 if sum(totals) else 0
+        print(f"{name:<32} {len(samples):>6} {percentile(totals, 50):>8.2f} {percentile(totals, 95):>8.2f} "
+              f"{percentile(totals, 99):>8.2f} {percentile(db_totals, 50):>8.2f} {db_share:>5.0f}%")
+    print(f"\nАпдейтов: {updates} за {wall:.2f} s ({updates / wall:.0f}/s), вызовов Bot API: {calls}")
+
+
+async def bench(rounds, parallel):
+    bot, session, cryptobot = harness.install_fakes()
+    geiu.db._read = timed_db(geiu.db._read)
+    geiu.db._write = timed_db(geiu.db._write)
+
+    recorder = Recorder()
+    geiu.dp.message.middleware(recorder.middleware)
+    geiu.dp.callback_query.middleware(recorder.middleware)
+
+    # Прогрев: первый проход создает соединения пулов и кэши aiogram
+    await run_round(bot, session, cryptobot, 10 ** 6)
+    recorder.handlers.clear()
+    first_update = next(update_ids)
+
+    user_ids = iter(range(1, rounds + 1))
+    started = time.perf_counter()
+
+    async def worker():
+        for user_id in user_ids:
+            await run_round(bot, session, cryptobot, user_id)
+
+    await asyncio.gather(*(worker() for _ in range(parallel)))
+    wall = time.perf_counter() - started
+    updates = next(update_ids) - first_update - 1
+
+    # Фоновая работа после апдейтов: outbox и буфер пользователей
+    started = time.perf_counter()
+    delivered = 0
+    while taken := await geiu.deliver_outbox_batch():
+        delivered += taken
+    outbox_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    await geiu.user_buffer.flush()
+    await geiu.fsm_storage.flush()
+    flush_time = time.perf_counter() - started
+
+    report(recorder, wall, updates, sum(session.calls.values()))
+    print(f"Outbox: {delivered} сообщений за {outbox_time * 1000:.1f} ms, "
+          f"запись буферов пользователей и FSM: {flush_time * 1000:.1f} ms")
+    print(f"Кэш заказов: {geiu.db.order_cache_info()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=200, help="покупателей, каждый проходит все сценарии")
+    parser.add_argument("--parallel", type=int, default=1, help="покупателей одновременно")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную базу")
+    args = parser.parse_args()
+
+    # Логи aiogram о каждом апдейте искажают замеры
+    geiu.logging.getLogger("aiogram").setLevel(geiu.logging.WARNING)
+
+    try:
+        asyncio.run(bench(args.rounds, args.parallel))
+    finally:
+        geiu.db.close()
+        if not args.keep:
+            harness.cleanup(TMP_DIR)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""Бенчмарк запросов к orders без индексов миграции 1 и с ними.
+
+Создает временную базу со схемой версии 0, заполняет ее заказами (по умолчанию 1M)
+и применяет migrate_schema. Замеряются сами методы чтения Database (_get_active_orders,
+_get_orders_by_status, ...) на соединении бенчмарка - ровно те запросы, что выполняет бот.
+План каждого запроса берется из трассировки соединения. Сначала замер идет без индексов
+миграции 1, затем индексы создаются заново и замер повторяется.
+
+    python bench_orders.py --orders 1000000 --active 0.001
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import harness
+
+# До import geiu: бот и база создаются при импорте
+TMP_DIR = harness.prepare("bench_orders_", db_name="import.db")
+
+import geiu
+
+ACTIVE_STATUSES = ["pending", "waiting_payment", "waiting_confirmation", "waiting_crypto", "confirmed"]
+
+# Методы чтения Database и их аргументы: (имя, метод, аргументы)
+QUERIES = [
+    ("get_active_orders", geiu.Database._get_active_orders, ()),
+    ("get_active_orders_page", geiu.Database._get_active_orders_page, (10, None, None, None)),
+    ("get_active_orders_page(status)", geiu.Database._get_active_orders_page, (10, None, None, "waiting_confirmation")),
+    ("get_orders_by_status", geiu.Database._get_orders_by_status, ("waiting_crypto",)),
+    ("get_order", geiu.Database._get_order, (4242,)),
+]
+
+# Индексы миграции 1 - их и сравниваем
+ORDER_INDEXES = ["idx_orders_active", "idx_orders_status", "idx_orders_user"]
+
+
+class Reader:
+    """Подставляется вместо self у методов Database: им нужно только self.conn"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+def traced(conn, method, args):
+    """SQL, который выполнил метод (с подставленными параметрами)"""
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        method(Reader(conn), *args)
+    finally:
+        conn.set_trace_callback(None)
+    return statements
+
+
+def seed(conn, total, active_share, users):
+    """Заполнить orders: большая часть завершена, небольшая доля активна"""
+    rnd = random.Random(1)
+    now = datetime.now()
+
+    def rows():
+        for _ in range(total):
+            roll = rnd.random()
+            if roll < active_share:
+                status = rnd.choice(ACTIVE_STATUSES)
+            elif roll < 0.85:
+                status = "completed"
+            else:
+                status = "cancelled"
+
+            created_at = now - timedelta(seconds=rnd.randint(0, 365 * 24 * 3600))
+            order_type = rnd.choice(["stars", "premium", "exchange"])
+            yield (
+                rnd.randint(1, users), order_type, "someone", '{"stars": 100}',
+                150.0, "card", status, str(rnd.randint(1, 10 ** 9)),
+                created_at.strftime("%Y-%m-%d %H:%M:%S")
+            )
+
+    conn.executemany(
+        """INSERT INTO orders
+           (user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        rows()
+    )
+    conn.commit()
+
+
+def measure(conn, repeat):
+    reader = Reader(conn)
+    for name, method, args in QUERIES:
+        plan = [
+            step for sql in traced(conn, method, args)
+            for step in conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        ]
+
+        timings = []
+        result = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = method(reader, *args)
+            timings.append((time.perf_counter() - started) * 1000)
+
+        rows = len(result) if isinstance(result, list) else int(result is not None)
+        print(f"  {name}: {rows} строк, median {statistics.median(timings):.2f} ms, "
+              f"max {max(timings):.2f} ms")
+        for step in plan:
+            print(f"      {step[-1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=1_000_000)
+    parser.add_argument("--active", type=float, default=0.001, help="доля активных заказов")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--keep", action="store_true", help="не удалять временную базу")
+    args = parser.parse_args()
+
+    path = os.path.join(TMP_DIR, "orders.db")
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for statement in geiu.BASE_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+    started = time.perf_counter()
+    seed(conn, args.orders, args.active, args.users)
+    print(f"Заказов: {args.orders}, заполнено за {time.perf_counter() - started:.1f} s ({path})")
+
+    started = time.perf_counter()
+    geiu.migrate_schema(conn)
+    print(f"Миграции применены за {time.perf_counter() - started:.1f} s")
+
+    for index in ORDER_INDEXES:
+        conn.execute(f"DROP INDEX {index}")
+    print("\nБез индексов миграции 1:")
+    measure(conn, args.repeat)
+
+    started = time.perf_counter()
+    for statement in geiu.SCHEMA_MIGRATIONS[0]:
+        conn.execute(statement)
+    conn.commit()
+    print(f"\nИндексы созданы за {time.perf_counter() - started:.1f} s")
+
+    print("\nС индексами:")
+    measure(conn, args.repeat)
+
+    conn.close()
+    geiu.db.close()
+    if not args.keep:
+        harness.cleanup(TMP_DIR)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
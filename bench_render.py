@@ -0,0 +1,189 @@
+"""Бенчмарк отрисовки списка заказов: JSON в details против отдельных колонок.
+
+Создает временную базу со схемой версии 0, заполняет ее активными заказами
+(по умолчанию 10k) с деталями в details, отрисовывает их так, как это делал список
+активных заказов до миграции 5 (json.loads на каждую строку), затем применяет
+migrate_schema и отрисовывает те же заказы через format_active_order.
+
+    python bench_render.py --orders 10000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import harness
+
+# До import geiu: бот и база создаются при импорте
+TMP_DIR = harness.prepare("bench_render_", db_name="import.db")
+
+import geiu
+
+ACTIVE_STATUSES = ["pending", "waiting_payment", "waiting_confirmation", "waiting_crypto", "confirmed"]
+
+# Запрос списка до миграции 5 и текущий запрос Database.get_active_orders
+LEGACY_SQL = """SELECT id, user_id, order_type, recipient, details, amount_rub,
+                       payment_method, status, created_at
+                FROM orders
+                WHERE status NOT IN ('completed', 'cancelled')
+                ORDER BY created_at DESC, id DESC"""
+TYPED_SQL = f"""{geiu.ORDER_SELECT}
+               WHERE status NOT IN ('completed', 'cancelled')
+               ORDER BY created_at DESC, id DESC"""
+
+
+def seed(conn, total):
+    """Заполнить orders активными заказами всех трех типов, детали - в JSON"""
+    rnd = random.Random(1)
+    now = datetime.now()
+
+    def rows():
+        for _ in range(total):
+            order_type = rnd.choice(["stars", "premium", "exchange"])
+            if order_type == "stars":
+                stars = rnd.randint(50, 5000)
+                details = {"stars": stars}
+                amount_rub = stars * geiu.STAR_RATE
+            elif order_type == "premium":
+                period = rnd.choice(list(geiu.PREMIUM_PRICES))
+                details = {"period": period}
+                amount_rub = geiu.PREMIUM_PRICES[period]["rub"]
+            else:
+                amount_rub = float(rnd.randint(100, 10000))
+                details = {"amount_rub": amount_rub, "amount_usd": amount_rub / geiu.USD_RATE,
+                           "exchange_rate": geiu.USD_RATE}
+
+            if rnd.random() < 0.3:
+                details["payment_photo"] = f"PHOTO{rnd.randint(1, 10 ** 9)}"
+
+            created_at = now - timedelta(seconds=rnd.randint(0, 30 * 24 * 3600))
+            yield (
+                rnd.randint(1, 100_000), order_type, "" if order_type == "exchange" else "someone",
+                json.dumps(details), amount_rub, "card", rnd.choice(ACTIVE_STATUSES),
+                created_at.strftime("%Y-%m-%d %H:%M:%S")
+            )
+
+    conn.executemany(
+        """INSERT INTO orders
+           (user_id, order_type, recipient, details, amount_rub, payment_method, status, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        rows()
+    )
+    conn.commit()
+
+
+def format_legacy_order(order):
+    """Блок заказа так, как список отрисовывал его до миграции 5"""
+    order_id, user_id, order_type, recipient, details, amount_rub, payment_method, status, created_at = order
+
+    status_emoji = {
+        'pending': '⏳',
+        'waiting_payment': '💳',
+        'waiting_confirmation': '📸',
+        'waiting_crypto': '💎',
+        'confirmed': '✅'
+    }.get(status, '❓')
+
+    created_short = str(created_at)[:16] if created_at else "---"
+
+    text = f"{status_emoji} **Заказ #{order_id}**\n"
+    text += f"📦 Тип: {order_type}\n"
+
+    if order_type == "stars":
+        try:
+            details_dict = json.loads(details) if details else {}
+            stars = details_dict.get("stars", 0)
+            text += f"⭐️ Количество: {stars} звезд\n"
+        except:
+            pass
+    elif order_type == "premium":
+        try:
+            details_dict = json.loads(details) if details else {}
+            period = details_dict.get("period", "")
+            period_name = geiu.PREMIUM_PRICES.get(period, {}).get("name", "")
+            text += f"👑 Период: {period_name}\n"
+        except:
+            pass
+    elif order_type == "exchange":
+        try:
+            details_dict = json.loads(details) if details else {}
+            amount_usd = details_dict.get("amount_usd", amount_rub / geiu.USD_RATE)
+            text += f"💸 К выдаче: {amount_usd:.2f} USD\n"
+        except:
+            pass
+
+    if recipient:
+        text += f"👤 Получатель: @{recipient}\n"
+
+    text += f"💰 Сумма: {amount_rub:.2f} RUB\n"
+    text += f"💳 Метод: {payment_method}\n"
+    text += f"📅 Дата: {created_short}\n"
+    text += f"📊 Статус: {status}\n\n"
+    return text
+
+
+def measure(conn, sql, render, repeat):
+    """Медианы выборки и отрисовки всех заказов; возвращает отрисованный текст для сверки"""
+    fetch_timings, render_timings = [], []
+    text = ""
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = conn.execute(sql).fetchall()
+        fetched = time.perf_counter()
+        text = "".join(render(row) for row in rows)
+        finished = time.perf_counter()
+
+        fetch_timings.append((fetched - started) * 1000)
+        render_timings.append((finished - fetched) * 1000)
+
+    fetch_ms = statistics.median(fetch_timings)
+    render_ms = statistics.median(render_timings)
+    print(f"  {len(rows)} заказов: выборка {fetch_ms:.2f} ms, отрисовка {render_ms:.2f} ms, "
+          f"всего {fetch_ms + render_ms:.2f} ms ({(fetch_ms + render_ms) * 1000 / max(len(rows), 1):.2f} µs/заказ)")
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--keep", action="store_true", help="не удалять временную базу")
+    args = parser.parse_args()
+
+    path = os.path.join(TMP_DIR, "orders.db")
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for statement in geiu.BASE_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+    seed(conn, args.orders)
+    print(f"Заказов: {args.orders} ({path})")
+
+    print("\nДо миграций (details JSON):")
+    before = measure(conn, LEGACY_SQL, format_legacy_order, args.repeat)
+
+    started = time.perf_counter()
+    geiu.migrate_schema(conn)
+    print(f"\nМиграции применены за {time.perf_counter() - started:.1f} s")
+
+    print("\nПосле миграций (колонки, строки - Order):")
+    conn.row_factory = geiu.Order.from_row
+    after = measure(conn, TYPED_SQL, geiu.format_active_order, args.repeat)
+
+    # Перенос деталей в колонки не должен менять то, что видит админ
+    print(f"\nТекст совпадает: {'да' if before == after else 'НЕТ'}")
+
+    conn.close()
+    geiu.db.close()
+    if not args.keep:
+        harness.cleanup(TMP_DIR)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
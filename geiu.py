@@ -3,15 +3,40 @@ import logging
 import sqlite3
 import os
 import json
-import requests
+import gzip
+import hashlib
+import hmac
+import inspect
+import re
+import sys
+import threading
+import time
+import traceback
+import aiohttp
+from aiohttp import web
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import replace
 from datetime import datetime
+from operator import itemgetter
+from pathlib import Path
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command, CommandStart
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 # ========== КОНФИГУРАЦИЯ ==========
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
-ADMIN_IDS = [6997318168]  # ⬅️ ВАШ ID ОТКРЫТО
+ADMIN_IDS = [int(admin_id) for admin_id in os.environ.get("ADMIN_IDS", "6997318168").split(",")]  # ⬅️ ВАШ ID ОТКРЫТО
 CRYPTOBOT_TOKEN = os.environ.get("CRYPTOBOT_TOKEN", "")
 
 # Настройки
@@ -29,18 +54,381 @@ REPUTATION_CHANNEL = "https://t.me/+3pbAABRgo1ljOTJi"
 NEWS_CHANNEL = "https://t.me/NewsDigistars"
 SUPPORT_USER = "swordSar"
 
+ADMIN_ORDERS_PAGE_SIZE = 8  # заказов на одной странице админки
+
+# Рассылка уведомлений (лимиты Telegram Bot API)
+NOTIFY_GLOBAL_RATE = 30  # сообщений в секунду на весь бот
+NOTIFY_CHAT_INTERVAL = 1.0  # секунд между сообщениями в один чат
+NOTIFY_MAX_RETRIES = 3  # повторов после RetryAfter
+
+# Outbox: уведомления пишутся в БД вместе со сменой статуса и доставляются в фоне
+OUTBOX_BATCH = 50  # сообщений за один проход
+# Сообщений одного чата за проход: в чат пишем не чаще NOTIFY_CHAT_INTERVAL, и занятый чат
+# (админ после серии фото) не должен задерживать весь проход, пока ждут остальные чаты
+OUTBOX_CHAT_BATCH = 1
+OUTBOX_POLL_INTERVAL = 5  # секунд между проходами, если не разбудили раньше
+OUTBOX_MAX_ATTEMPTS = 8  # попыток до пометки failed
+OUTBOX_BACKOFF_BASE = 2  # секунд до первого повтора, дальше удваивается
+OUTBOX_BACKOFF_MAX = 600  # секунд максимум между повторами
+OUTBOX_KEEP_DAYS = 7  # дней храним отправленные (для дедупликации)
+
+# Запись входящих апдейтов для replay.py (выключено, если UPDATE_LOG_DIR пустой)
+UPDATE_LOG_DIR = os.environ.get("UPDATE_LOG_DIR", "")
+UPDATE_LOG_SALT = os.environ.get("UPDATE_LOG_SALT", "")  # ключ псевдонимов id, пусто - новый на каждый запуск
+UPDATE_LOG_ROTATE_BYTES = 64 * 1024 * 1024  # несжатых байт в одном файле
+UPDATE_LOG_KEEP_FILES = 100  # сколько последних файлов хранить
+
+# Планировщик апдейтов: класс -> (приоритет, одновременно в работе, мест в очереди, секунд ожидания).
+# None - без ограничения. Освободившееся место получает класс с меньшим числом приоритета.
+UPDATE_WORKERS = 32  # апдейтов в обработке одновременно, всего
+UPDATE_CLASSES = {
+    "payment": (0, 16, None, None),  # оплата и фото чеков: не отбрасываются
+    "admin": (1, 8, None, None),  # все действия админов
+    "input": (2, 16, 2000, None),  # ввод получателя и суммы, выбор периода
+    "browsing": (3, 12, 200, 5),  # меню и информация: лишнее отбрасывается
+}
+
+# Состояния пользователей (FSM)
+FSM_CACHE_SIZE = 10000  # записей в памяти, остальные только в SQLite
+FSM_TTL = 24 * 3600  # секунд живет незавершенный диалог
+FSM_FLUSH_INTERVAL = 2  # секунд между пакетными записями в SQLite
+FSM_FLUSH_BATCH = 500  # измененных записей, после которых пишем сразу
+FSM_SWEEP_INTERVAL = 300  # секунд между очистками просроченных записей
+
+# Новые пользователи из /start копятся в памяти и пишутся пачками
+USER_FLUSH_INTERVAL = 2  # секунд между пакетными записями
+USER_FLUSH_BATCH = 500  # пользователей в буфере, после которых пишем сразу
+USER_SEEN_LIMIT = 200000  # id уже записанных пользователей, которые помним
+
+# База данных
+DB_PATH = os.environ.get("DB_PATH", "digistore.db")
+DB_READERS = 4  # read-only соединений для параллельного чтения
+ORDER_CACHE_SIZE = 1000  # заказов в LRU кэше get_order
+
+# Свой сервер Bot API (локальный telegram-bot-api или тестовый стенд), пусто - api.telegram.org
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "")
+
+# Получение обновлений: "polling" или "webhook"
+UPDATES_MODE = os.environ.get("UPDATES_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # публичный https адрес без пути
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+
+# HTTP клиент CryptoBot
+CRYPTOBOT_API_URL = os.environ.get("CRYPTOBOT_API_URL", "https://pay.crypt.bot/api")
+CRYPTOBOT_TIMEOUT = 10  # секунд на один запрос к API
+CRYPTOBOT_MAX_CONCURRENCY = 10  # одновременных запросов к API
+CRYPTOBOT_KEEPALIVE = 60  # секунд держим соединение открытым
+
+# Фоновая проверка CryptoBot счетов
+CRYPTO_WATCH_BATCH = 100  # инвойсов в одном запросе getInvoices
+CRYPTO_WATCH_MIN_INTERVAL = 5  # секунд между проверками при активности
+CRYPTO_WATCH_MAX_INTERVAL = 60  # секунд между проверками в простое
+
+# Отмена заброшенных заказов: статус -> (секунд в этом статусе, уведомлять покупателя).
+# waiting_crypto закрывает watcher по статусу счета, waiting_confirmation ждет решения админа.
+ORDER_TTLS = {
+    "pending": (int(os.environ.get("ORDER_PENDING_TTL", "7200")), False),  # дошел до выбора оплаты и ушел
+    "waiting_payment": (int(os.environ.get("ORDER_WAITING_PAYMENT_TTL", "86400")), True),  # получил реквизиты
+}
+ORDER_SWEEP_INTERVAL = 300  # секунд между проходами
+ORDER_SWEEP_BATCH = 1000  # заказов в одном UPDATE
+
+# Архив: завершенные заказы старше ORDER_ARCHIVE_DAYS переносятся из orders в orders_archive
+ORDER_ARCHIVE_DAYS = int(os.environ.get("ORDER_ARCHIVE_DAYS", "30"))  # 0 - не архивировать
+ORDER_ARCHIVE_INTERVAL = 3600  # секунд между проходами
+ORDER_ARCHIVE_BATCH = 500  # заказов в одной транзакции
+DB_VACUUM_PAGES = 1000  # страниц за один шаг incremental_vacuum
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics, проверка готовности на /ready
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))  # 0 - не запускать
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # секунды
+
+# Контроль задержки event loop
+LOOP_LAG_INTERVAL = 0.1  # секунд между замерами
+LOOP_LAG_STACK_THRESHOLD = 0.5  # секунд блокировки, после которых в лог пишется стек главного потока
+LOOP_LAG_WINDOW = 600  # последних замеров для перцентилей (минута при 0.1 s)
+LOOP_READY_MAX_LAG = 1.0  # /ready отвечает 503, если задержка за LOOP_READY_WINDOW секунд была больше
+LOOP_READY_WINDOW = 10
+
+# ========== МЕТРИКИ ==========
+METRICS = []  # все метрики в порядке объявления, для /metrics
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metric:
+    """Метрика с метками. Значения меняются только из event loop, блокировки не нужны.
+    collect - функция, которая возвращает {значения меток: значение} в момент выдачи."""
+    
+    kind = "untyped"
+    
+    def __init__(self, name, documentation, labels=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.collect = collect
+        self._values = {}
+        METRICS.append(self)
+    
+    def _label_text(self, label_values, extra=()):
+        pairs = [*zip(self.labels, label_values), *extra]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{label}="{escape_label(value)}"' for label, value in pairs) + "}"
+    
+    def samples(self):
+        values = self.collect() if self.collect else self._values
+        for label_values, value in values.items():
+            yield f"{self.name}{self._label_text(label_values)} {value}"
+
+class Counter(Metric):
+    kind = "counter"
+    
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+    
+    def set(self, value, *label_values):
+        self._values[label_values] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+    
+    def __init__(self, name, documentation, labels=(), buckets=METRICS_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, *label_values):
+        series = self._values.get(label_values)
+        if series is None:
+            # [счетчики по корзинам (последняя - +Inf), сумма, количество]
+            series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+    
+    def samples(self):
+        for label_values, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{self._label_text(label_values, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{self._label_text(label_values)} {total}"
+            yield f"{self.name}_count{self._label_text(label_values)} {count}"
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+handler_seconds = Histogram("bot_handler_seconds", "Время обработчика aiogram", ["handler"])
+handler_errors = Counter("bot_handler_errors_total", "Исключения, вышедшие из обработчика", ["handler", "error"])
+db_seconds = Histogram("bot_db_seconds", "Время метода Database вместе с ожиданием пула", ["method"])
+db_errors = Counter("bot_db_errors_total", "Исключения в методах Database", ["method", "error"])
+telegram_seconds = Histogram("bot_telegram_seconds", "Время вызова Bot API", ["method"])
+telegram_errors = Counter("bot_telegram_errors_total", "Ошибки вызовов Bot API", ["method", "error"])
+cryptobot_seconds = Histogram("bot_cryptobot_seconds", "Время запроса к CryptoBot API", ["method"])
+cryptobot_errors = Counter("bot_cryptobot_errors_total", "Ошибки запросов к CryptoBot API", ["method", "error"])
+swallowed_errors = Counter(
+    "bot_swallowed_errors_total", "Ошибки, которые перехвачены и только записаны в лог", ["where", "error"]
+)
+orders_expired = Counter("bot_orders_expired_total", "Заказы, отмененные по сроку, по прежнему статусу", ["status"])
+orders_archived = Counter("bot_orders_archived_total", "Завершенные заказы, перенесенные в orders_archive")
+
+# Размеры очередей и кэшей; db и fsm_storage создаются ниже, collect вызывается только при выдаче
+fsm_entries = Gauge(
+    "bot_fsm_entries", "Незавершенные диалоги в памяти: default - покупки, admin_confirmation - подтверждения админа",
+    ["destiny"], collect=lambda: fsm_storage.active_counts()
+)
+order_cache_entries = Gauge(
+    "bot_order_cache_entries", "Заказов в кэше get_order", collect=lambda: {(): db.order_cache_info()["size"]}
+)
+order_cache_requests = Counter(
+    "bot_order_cache_requests_total", "Обращения к кэшу get_order", ["result"],
+    collect=lambda: {("hit",): db.order_cache_hits, ("miss",): db.order_cache_misses}
+)
+active_orders = Gauge("bot_active_orders", "Активные заказы по статусам", ["status"])
+outbox_pending = Gauge("bot_outbox_pending", "Сообщения outbox, ожидающие отправки")
+
+def handler_name(data):
+    """Имя обработчика апдейта; для кнопок - обработчик действия, а не общий route_callback"""
+    if "callback_action" in data:
+        return data["callback_action"].handler.__name__
+    return data["handler"].callback.__name__
+
+async def handler_metrics(handler, event, data):
+    """Inner middleware сообщений и кнопок: время и исключения по имени обработчика"""
+    name = handler_name(data)
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception as e:
+        handler_errors.inc(name, type(e).__name__)
+        raise
+    finally:
+        handler_seconds.observe(time.perf_counter() - started, name)
+
+async def telegram_metrics(make_request, bot, method):
+    """Middleware сессии бота: время и ошибки каждого вызова Bot API"""
+    name = type(method).__name__
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        telegram_errors.inc(name, type(e).__name__)
+        raise
+    finally:
+        telegram_seconds.observe(time.perf_counter() - started, name)
+
+# ========== КОНТРОЛЬ EVENT LOOP ==========
+class LoopWatchdog:
+    """Задержка event loop: задача в loop просыпается каждые interval секунд и отмечается,
+    поток-наблюдатель проверяет отметку. Если loop не отмечался дольше stack_threshold,
+    в лог пишется стек главного потока - то, что его сейчас держит."""
+    
+    def __init__(self, interval=LOOP_LAG_INTERVAL, stack_threshold=LOOP_LAG_STACK_THRESHOLD, window=LOOP_LAG_WINDOW):
+        self.interval = interval
+        self.stack_threshold = stack_threshold
+        self.stalls = 0  # блокировок со снятым стеком
+        self._lags = deque(maxlen=window)  # (время замера, задержка)
+        self._beat = None  # time.monotonic() последней отметки loop
+        self._loop_thread_id = None
+        self._stop = threading.Event()
+    
+    async def run(self):
+        """Фоновая задача: замеры в loop и поток-наблюдатель на время ее работы"""
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        
+        try:
+            while True:
+                started = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self._beat = time.monotonic()
+                
+                lag = max(self._beat - started - self.interval, 0.0)
+                self._lags.append((self._beat, lag))
+                loop_lag_seconds.observe(lag)
+                if lag >= self.stack_threshold:
+                    logger.warning(f"Event loop был заблокирован {lag:.3f} s")
+        finally:
+            self._stop.set()
+    
+    def _watch(self):
+        reported_beat = None
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            stalled = time.monotonic() - beat - self.interval
+            
+            # Одна блокировка - один стек, даже если она длится много проверок
+            if stalled >= self.stack_threshold and beat != reported_beat:
+                reported_beat = beat
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is None:
+                    continue
+                self.stalls += 1
+                stack = "".join(traceback.format_stack(frame))
+                logger.warning(f"Event loop не отвечает {stalled:.3f} s, стек главного потока:\n{stack}")
+    
+    def quantiles(self):
+        """Перцентили задержки за окно: {(квантиль,): секунды}"""
+        lags = sorted(lag for _, lag in self._lags)
+        if not lags:
+            return {}
+        return {(q,): lags[min(int(q * len(lags)), len(lags) - 1)] for q in (0.5, 0.9, 0.99, 1.0)}
+    
+    def recent_max_lag(self, seconds=LOOP_READY_WINDOW):
+        """Наибольшая задержка за последние seconds секунд, включая текущую паузу"""
+        if self._beat is None:
+            return None
+        now = time.monotonic()
+        current = max(now - self._beat - self.interval, 0.0)
+        return max([lag for measured_at, lag in self._lags if measured_at >= now - seconds] + [current])
+
+loop_watchdog = LoopWatchdog()
+
+loop_lag_seconds = Histogram("bot_loop_lag_seconds", "Задержка event loop: насколько позже срока проснулся таймер")
+loop_lag_quantiles = Gauge(
+    "bot_loop_lag_quantile_seconds", f"Перцентили задержки event loop за последние {LOOP_LAG_WINDOW} замеров",
+    ["quantile"], collect=loop_watchdog.quantiles
+)
+loop_stalls = Counter(
+    "bot_loop_stalls_total", "Блокировки event loop, для которых в лог записан стек",
+    collect=lambda: {(): loop_watchdog.stalls}
+)
+
 # ========== CRYPTOBOT ==========
 class CryptoBotAPI:
-    def __init__(self, token):
+    def __init__(self, token, base_url=CRYPTOBOT_API_URL, timeout=CRYPTOBOT_TIMEOUT,
+                 max_concurrency=CRYPTOBOT_MAX_CONCURRENCY):
         self.token = token
-        self.base_url = "https://pay.crypt.bot/api"
+        self.base_url = base_url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_concurrency = max_concurrency
+        self._limit = asyncio.Semaphore(max_concurrency)
+        self._session = None
+    
+    async def start(self):
+        """Открыть общую HTTP сессию (пул соединений с keep-alive)"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency,
+                keepalive_timeout=CRYPTOBOT_KEEPALIVE,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"Crypto-Pay-API-Token": self.token},
+                timeout=self.timeout
+            )
+    
+    async def close(self):
+        """Закрыть HTTP сессию"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    async def _request(self, http_method, api_method, timeout=None, **kwargs):
+        """Один запрос к API через общую сессию с ограничением параллельности"""
+        await self.start()
+        request_timeout = aiohttp.ClientTimeout(total=timeout) if timeout else self.timeout
+        
+        started = time.perf_counter()
+        try:
+            async with self._limit:
+                async with self._session.request(
+                    http_method,
+                    f"{self.base_url}/{api_method}",
+                    timeout=request_timeout,
+                    **kwargs
+                ) as response:
+                    result = await response.json(content_type=None)
+        except Exception as e:
+            # Вызывающие методы превращают исключение в {"success": False}, здесь оно хотя бы считается
+            cryptobot_errors.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            cryptobot_seconds.observe(time.perf_counter() - started, api_method)
+        
+        if not result.get("ok"):
+            cryptobot_errors.inc(api_method, result.get("error", {}).get("name", "Unknown error"))
+        return result
     
-    async def create_invoice(self, amount, description=""):
+    async def create_invoice(self, amount, description="", timeout=None):
         """Создать счет для оплаты"""
         try:
-            url = f"{self.base_url}/createInvoice"
-            headers = {"Crypto-Pay-API-Token": self.token}
-            
             amount_usdt = amount / 85.0
             
             data = {
@@ -53,8 +441,7 @@ class CryptoBotAPI:
                 "allow_anonymous": False
             }
             
-            response = requests.post(url, json=data, headers=headers, timeout=30)
-            result = response.json()
+            result = await self._request("POST", "createInvoice", timeout=timeout, json=data)
             
             if result.get("ok"):
                 invoice = result["result"]
@@ -68,19 +455,17 @@ class CryptoBotAPI:
             else:
                 return {"success": False, "error": result.get("error", {}).get("name", "Unknown error")}
                 
+        except asyncio.TimeoutError:
+            return {"success": False, "error": "Timeout"}
         except Exception as e:
             return {"success": False, "error": str(e)}
     
-    async def check_invoice_status(self, invoice_id):
+    async def check_invoice_status(self, invoice_id, timeout=None):
         """Проверить статус инвойса в CryptoBot"""
         try:
-            url = f"{self.base_url}/getInvoices"
-            headers = {"Crypto-Pay-API-Token": self.token}
+            params = {"invoice_ids": str(invoice_id)}
             
-            params = {"invoice_ids": invoice_id}
-            
-            response = requests.get(url, headers=headers, params=params, timeout=30)
-            result = response.json()
+            result = await self._request("GET", "getInvoices", timeout=timeout, params=params)
             
             if result.get("ok"):
                 invoice = result["result"]["items"][0]
@@ -93,6 +478,28 @@ class CryptoBotAPI:
             else:
                 return {"success": False, "error": result.get("error", {}).get("name", "Unknown error")}
                 
+        except asyncio.TimeoutError:
+            return {"success": False, "error": "Timeout"}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    async def get_invoices(self, invoice_ids, timeout=None):
+        """Статусы нескольких инвойсов одним запросом"""
+        try:
+            params = {
+                "invoice_ids": ",".join(str(invoice_id) for invoice_id in invoice_ids),
+                "count": str(len(invoice_ids))
+            }
+            
+            result = await self._request("GET", "getInvoices", timeout=timeout, params=params)
+            
+            if result.get("ok"):
+                return {"success": True, "items": result["result"]["items"]}
+            else:
+                return {"success": False, "error": result.get("error", {}).get("name", "Unknown error")}
+        
+        except asyncio.TimeoutError:
+            return {"success": False, "error": "Timeout"}
         except Exception as e:
             return {"success": False, "error": str(e)}
 
@@ -100,147 +507,1630 @@ class CryptoBotAPI:
 cryptobot = CryptoBotAPI(CRYPTOBOT_TOKEN) if CRYPTOBOT_TOKEN else None
 
 # ========== БАЗА ДАННЫХ ==========
-class Database:
-    def __init__(self, db_name="digistore.db"):
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
-        self.create_tables()
-    
-    def create_tables(self):
-        cursor = self.conn.cursor()
-        
-        cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            full_name TEXT,
+# Исходная схема (версия 0)
+BASE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        full_name TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        order_type TEXT,
+        recipient TEXT,
+        details TEXT,
+        amount_rub REAL,
+        payment_method TEXT,
+        status TEXT DEFAULT 'pending',
+        invoice_id TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''',
+]
+
+# Миграции схемы по порядку. Номер последней примененной хранится в PRAGMA user_version,
+# поэтому существующий digistore.db обновляется на месте при запуске.
+SCHEMA_MIGRATIONS = [
+    # 1: индексы под реальные запросы к orders
+    [
+        # get_active_orders: только активные заказы, уже отсортированные по дате
+        """CREATE INDEX IF NOT EXISTS idx_orders_active
+           ON orders (created_at) WHERE status NOT IN ('completed', 'cancelled')""",
+        # выборки по статусу (waiting_crypto для watcher) с сортировкой по дате
+        "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id)",
+    ],
+    # 2: FSM хранилище (состояния диалогов пользователей)
+    [
+        """CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            expires_at REAL
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_fsm_storage_expires ON fsm_storage (expires_at)",
+    ],
+    # 3: агрегаты статистики, обновляются в тех же транзакциях, что и orders
+    [
+        """CREATE TABLE IF NOT EXISTS stats_status (
+            status TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS stats_product (
+            order_type TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL DEFAULT 0,
+            paid INTEGER NOT NULL DEFAULT 0,
+            revenue_rub REAL NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            orders INTEGER NOT NULL DEFAULT 0,
+            paid INTEGER NOT NULL DEFAULT 0,
+            revenue_rub REAL NOT NULL DEFAULT 0
+        )""",
+        # Разовое заполнение по существующим заказам (оплата относится к дню создания заказа)
+        "INSERT OR REPLACE INTO stats_status SELECT status, COUNT(*) FROM orders GROUP BY status",
+        """INSERT OR REPLACE INTO stats_product
+           SELECT order_type, COUNT(*),
+                  SUM(status IN ('confirmed', 'completed')),
+                  SUM(CASE WHEN status IN ('confirmed', 'completed') THEN amount_rub ELSE 0 END)
+           FROM orders GROUP BY order_type""",
+        """INSERT OR REPLACE INTO stats_daily
+           SELECT date(created_at), COUNT(*),
+                  SUM(status IN ('confirmed', 'completed')),
+                  SUM(CASE WHEN status IN ('confirmed', 'completed') THEN amount_rub ELSE 0 END)
+           FROM orders GROUP BY date(created_at)""",
+    ],
+    # 4: outbox уведомлений
+    [
+        """CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedupe_key TEXT UNIQUE,
+            chat_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
-        
-        cursor.execute('''CREATE TABLE IF NOT EXISTS orders (
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at) WHERE status = 'pending'",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_chat ON outbox (chat_id, id) WHERE status = 'pending'",
+    ],
+    # 5: поля товара отдельными колонками вместо JSON в details
+    [
+        "ALTER TABLE orders ADD COLUMN stars INTEGER",
+        "ALTER TABLE orders ADD COLUMN period TEXT",
+        "ALTER TABLE orders ADD COLUMN amount_usd REAL",
+        "ALTER TABLE orders ADD COLUMN exchange_rate REAL",
+        "ALTER TABLE orders ADD COLUMN payment_photo TEXT",
+        # details старых заказов остается как есть, новые заказы его не заполняют
+        """UPDATE orders SET
+               stars = json_extract(details, '$.stars'),
+               period = json_extract(details, '$.period'),
+               amount_usd = json_extract(details, '$.amount_usd'),
+               exchange_rate = json_extract(details, '$.exchange_rate'),
+               payment_photo = json_extract(details, '$.payment_photo')
+           WHERE json_valid(details)""",
+    ],
+    # 6: история смены статусов - по ней считается время каждого этапа заказа
+    [
+        """CREATE TABLE IF NOT EXISTS order_status_history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            old_status TEXT,
+            new_status TEXT NOT NULL,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_status_history_order ON order_status_history (order_id, id)",
+    ],
+    # 7: архив завершенных заказов - те же колонки, что у orders
+    [
+        """CREATE TABLE IF NOT EXISTS orders_archive (
+            id INTEGER PRIMARY KEY,
             user_id INTEGER,
             order_type TEXT,
             recipient TEXT,
             details TEXT,
             amount_rub REAL,
             payment_method TEXT,
-            status TEXT DEFAULT 'pending',
+            status TEXT,
             invoice_id TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
+            created_at TIMESTAMP,
+            stars INTEGER,
+            period TEXT,
+            amount_usd REAL,
+            exchange_rate REAL,
+            payment_photo TEXT,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+    ],
+    # 8: время входа в текущий статус - от него отсчитываются сроки ORDER_TTLS и возраст для архива
+    [
+        "ALTER TABLE orders ADD COLUMN status_changed_at TIMESTAMP",
+        "ALTER TABLE orders_archive ADD COLUMN status_changed_at TIMESTAMP",
+        # Активные заказы - по последней записи истории для их статуса, без истории - с момента создания
+        """UPDATE orders SET status_changed_at = COALESCE(
+               (SELECT MAX(changed_at) FROM order_status_history AS history
+                WHERE history.order_id = orders.id AND history.new_status = orders.status),
+               created_at
+           )
+           WHERE status NOT IN ('completed', 'cancelled')""",
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_changed ON orders (status, status_changed_at)",
+    ],
+]
+
+# Статусы оплаченных заказов - по переходу в них считаются выручка и конверсия
+PAID_STATUSES = ("confirmed", "completed")
+
+# Разрешенные переходы статусов заказа; completed и cancelled - конечные.
+# Админ может подтвердить или отменить заказ на любом этапе до подтверждения.
+ORDER_TRANSITIONS = {
+    "pending": {"waiting_payment", "waiting_crypto", "confirmed", "cancelled"},
+    "waiting_payment": {"waiting_crypto", "waiting_confirmation", "confirmed", "cancelled"},
+    "waiting_crypto": {"waiting_payment", "confirmed", "cancelled"},
+    "waiting_confirmation": {"confirmed", "cancelled"},
+    "confirmed": {"completed"},
+    "completed": set(),
+    "cancelled": set(),
+}
+
+def can_change_status(old_status, new_status):
+    return new_status in ORDER_TRANSITIONS.get(old_status, ())
+
+# Статусы, в которых заказ принимает фото оплаты (повторное фото - пока идет проверка)
+PAYMENT_PHOTO_STATUSES = ("waiting_payment", "waiting_confirmation")
+
+def migrate_schema(conn):
+    """Применить недостающие миграции, каждую в своей транзакции"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    
+    for number in range(version, len(SCHEMA_MIGRATIONS)):
+        conn.execute("BEGIN")
+        try:
+            for step in SCHEMA_MIGRATIONS[number]:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {number + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        logger.info(f"Схема БД обновлена до версии {number + 1}")
+
+# Колонки orders в том порядке, в котором их читают все запросы заказов
+ORDER_COLUMNS = (
+    "id", "user_id", "order_type", "recipient", "amount_rub", "payment_method", "status",
+    "invoice_id", "created_at", "stars", "period", "amount_usd", "exchange_rate", "payment_photo",
+    "status_changed_at"
+)
+ORDER_SELECT = f"SELECT {', '.join(ORDER_COLUMNS)} FROM orders"
+ORDER_ARCHIVE_SELECT = f"SELECT {', '.join(ORDER_COLUMNS)} FROM orders_archive"
+# Колонки, которые переносятся в архив (details - у старых заказов)
+ORDER_ARCHIVE_COLUMNS = ", ".join(ORDER_COLUMNS + ("details",))
+
+class Order(tuple):
+    """Заказ - строка orders в порядке ORDER_COLUMNS. Поля читаются по имени прямо из кортежа
+    строки, без __dict__ и без разбора на каждую строку; производные поля считаются при обращении."""
+    
+    __slots__ = ()
+    
+    id = property(itemgetter(0))
+    user_id = property(itemgetter(1))
+    order_type = property(itemgetter(2))
+    recipient = property(itemgetter(3))
+    amount_rub = property(itemgetter(4))
+    payment_method = property(itemgetter(5))
+    status = property(itemgetter(6))
+    invoice_id = property(itemgetter(7))
+    created_at = property(itemgetter(8))
+    stars = property(itemgetter(9))
+    period = property(itemgetter(10))
+    amount_usd = property(itemgetter(11))
+    exchange_rate = property(itemgetter(12))
+    payment_photo = property(itemgetter(13))
+    status_changed_at = property(itemgetter(14))
+    
+    @staticmethod
+    def from_row(cursor, row):
+        """row_factory для курсоров, выбирающих ORDER_SELECT"""
+        return tuple.__new__(Order, row)
+    
+    @property
+    def payout_usd(self):
+        """Сумма к выдаче по обмену; у старых заказов без amount_usd - по текущему курсу"""
+        amount_usd = self[11]
+        return amount_usd if amount_usd is not None else self[4] / USD_RATE
+    
+    @property
+    def period_name(self):
+        return PREMIUM_PRICES.get(self[10], {}).get("name", "")
+    
+    def __repr__(self):
+        return f"Order(id={self[0]}, type={self[2]}, status={self[6]})"
+
+class Database:
+    """Асинхронный доступ к SQLite: чтение через пул read-only соединений (WAL),
+    все записи последовательно в одном потоке-писателе. Event loop не блокируется."""
+    
+    def __init__(self, db_name=DB_PATH, readers=DB_READERS, order_cache_size=ORDER_CACHE_SIZE):
+        self.db_name = db_name
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        
+        # SQLite допускает одного писателя, поэтому все записи идут через один поток
+        self._writer = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="db-writer",
+            initializer=self._open_connection,
+            initargs=(False,)
+        )
+        self._readers = ThreadPoolExecutor(
+            max_workers=readers,
+            thread_name_prefix="db-reader",
+            initializer=self._open_connection,
+            initargs=(True,)
+        )
+        
+        self._writer.submit(self.create_tables).result()
+        
+        # Выставляется, когда в outbox появились новые сообщения
+        self.outbox_ready = asyncio.Event()
+        
+        # LRU кэш get_order: order_id -> Order. Используется только из event loop,
+        # сбрасывается методами, которые меняют заказ
+        self._order_cache = OrderedDict()
+        self._order_cache_size = order_cache_size
+        self._order_cache_version = 0
+        self.order_cache_hits = 0
+        self.order_cache_misses = 0
+    
+    def _open_connection(self, readonly):
+        """Открыть соединение для текущего потока пула"""
+        if readonly:
+            uri = Path(self.db_name).absolute().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_name, check_same_thread=False)
+            # Новая база создается в режиме incremental_vacuum: прагма действует только на пустой
+            # файл, до перехода в WAL. Существующую базу переводит vacuum.py при остановленном боте.
+            if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        
+        self._local.conn = conn
+        with self._connections_lock:
+            self._connections.append(conn)
+    
+    @property
+    def conn(self):
+        """Соединение текущего потока пула"""
+        return self._local.conn
+    
+    async def _read(self, func, *args):
+        return await self._run(self._readers, func, args)
+    
+    async def _write(self, func, *args):
+        return await self._run(self._writer, func, args)
+    
+    async def _run(self, executor, func, args):
+        """Выполнить func в пуле, время и ошибки - в метрики под именем метода"""
+        method = func.__name__.lstrip("_")
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        except Exception as e:
+            db_errors.inc(method, type(e).__name__)
+            raise
+        finally:
+            db_seconds.observe(time.perf_counter() - started, method)
+    
+    def close(self):
+        """Дождаться незавершенных запросов и закрыть все соединения"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+    
+    def create_tables(self):
+        cursor = self.conn.cursor()
+        
+        if ORDER_ARCHIVE_DAYS and cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logger.info("База не в режиме auto_vacuum=INCREMENTAL: место после архива заказов "
+                        "не возвращается ОС, перевести базу - python vacuum.py")
+        
+        for statement in BASE_SCHEMA:
+            cursor.execute(statement)
         
         self.conn.commit()
+        migrate_schema(self.conn)
     
-    def add_user(self, user_id, username, full_name):
+    async def add_users(self, users):
+        """Добавить пользователей [(user_id, username, full_name)] одной транзакцией, существующие пропускаются"""
+        await self._write(self._add_users, users)
+    
+    def _add_users(self, users):
         cursor = self.conn.cursor()
-        cursor.execute(
+        cursor.executemany(
             "INSERT OR IGNORE INTO users (user_id, username, full_name) VALUES (?, ?, ?)",
-            (user_id, username, full_name)
+            users
         )
         self.conn.commit()
     
-    def add_order(self, user_id, order_type, recipient, details, amount_rub, payment_method, invoice_id=None):
+    async def add_order(self, user_id, order_type, recipient, amount_rub, payment_method, invoice_id=None,
+                        stars=None, period=None, amount_usd=None, exchange_rate=None):
+        return await self._write(
+            self._add_order, user_id, order_type, recipient, amount_rub, payment_method, invoice_id,
+            stars, period, amount_usd, exchange_rate
+        )
+    
+    def _add_order(self, user_id, order_type, recipient, amount_rub, payment_method, invoice_id,
+                   stars, period, amount_usd, exchange_rate):
         cursor = self.conn.cursor()
         cursor.execute(
             """INSERT INTO orders 
-            (user_id, order_type, recipient, details, amount_rub, payment_method, invoice_id) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (user_id, order_type, recipient, details, amount_rub, payment_method, invoice_id)
+            (user_id, order_type, recipient, amount_rub, payment_method, invoice_id,
+             stars, period, amount_usd, exchange_rate, status_changed_at) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
+            (user_id, order_type, recipient, amount_rub, payment_method, invoice_id,
+             stars, period, amount_usd, exchange_rate)
         )
         order_id = cursor.lastrowid
+        self._count_order(cursor, order_type)
+        self._count_status_change(cursor, order_type, amount_rub, None, "pending")
+        cursor.execute(
+            "INSERT INTO order_status_history (order_id, old_status, new_status) VALUES (?, NULL, 'pending')",
+            (order_id,)
+        )
         self.conn.commit()
         return order_id
     
-    def update_order_status(self, order_id, status):
+    async def update_order_status(self, order_id, status, notifications=()):
+        """Перевести заказ в status, если это разрешено ORDER_TRANSITIONS из текущего статуса.
+        notifications - [(chat_id, метод Bot API, аргументы)], пишутся в outbox в той же
+        транзакции; chat_id None - покупатель заказа. Возвращает True, если переход выполнен
+        этим вызовом; при повторном или устаревшем нажатии - False и ничего не меняется."""
+        updated = await self._write(self._update_order_status, order_id, status, notifications)
+        self.invalidate_order(order_id)
+        if updated and notifications:
+            self.outbox_ready.set()
+        if not updated:
+            logger.info(f"Заказ #{order_id}: переход в {status} отклонен")
+        return updated
+    
+    def _update_order_status(self, order_id, status, notifications):
         cursor = self.conn.cursor()
         cursor.execute(
-            "UPDATE orders SET status = ? WHERE id = ?",
-            (status, order_id)
+            "SELECT status, order_type, amount_rub, user_id FROM orders WHERE id = ?",
+            (order_id,)
+        )
+        row = cursor.fetchone()
+        if row is None or not can_change_status(row[0], status):
+            return False
+        
+        old_status, order_type, amount_rub, user_id = row
+        # compare-and-set: переход выигрывает, только если статус не сменился после чтения
+        cursor.execute(
+            "UPDATE orders SET status = ?, status_changed_at = datetime('now') WHERE id = ? AND status = ?",
+            (status, order_id, old_status)
+        )
+        if cursor.rowcount == 0:
+            self.conn.rollback()
+            return False
+        
+        cursor.execute(
+            "INSERT INTO order_status_history (order_id, old_status, new_status) VALUES (?, ?, ?)",
+            (order_id, old_status, status)
+        )
+        self._count_status_change(cursor, order_type, amount_rub, old_status, status)
+        self._enqueue_outbox(cursor, f"order:{order_id}:{status}", user_id, notifications)
+        self.conn.commit()
+        return True
+    
+    async def expire_orders(self, status, older_than, notifications=None, limit=ORDER_SWEEP_BATCH):
+        """Отменить до limit заказов, находящихся в статусе status больше older_than секунд.
+        notifications(order_id) - уведомления покупателю для outbox. Возвращает id отмененных."""
+        expired = await self._write(self._expire_orders, status, older_than, notifications, limit)
+        for order_id in expired:
+            self.invalidate_order(order_id)
+        if expired and notifications:
+            self.outbox_ready.set()
+        return expired
+    
+    def _expire_orders(self, status, older_than, notifications, limit):
+        cursor = self.conn.cursor()
+        # Один UPDATE на пачку по индексу (status, status_changed_at); история, агрегаты и outbox -
+        # в той же транзакции, как у update_order_status
+        cursor.execute(
+            """UPDATE orders SET status = 'cancelled', status_changed_at = datetime('now')
+               WHERE id IN (
+                   SELECT id FROM orders
+                   WHERE status = ? AND status_changed_at < datetime('now', ?)
+                   ORDER BY status_changed_at LIMIT ?
+               )
+               RETURNING id, user_id""",
+            (status, f"-{older_than} seconds", limit)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            self.conn.commit()
+            return []
+        
+        cursor.executemany(
+            "INSERT INTO order_status_history (order_id, old_status, new_status) VALUES (?, ?, 'cancelled')",
+            [(order_id, status) for order_id, _ in rows]
+        )
+        # Статусы ORDER_TTLS не оплаченные - меняются только счетчики статусов
+        cursor.execute("UPDATE stats_status SET orders = orders - ? WHERE status = ?", (len(rows), status))
+        cursor.execute(
+            """INSERT INTO stats_status (status, orders) VALUES ('cancelled', ?)
+               ON CONFLICT(status) DO UPDATE SET orders = orders + excluded.orders""",
+            (len(rows),)
+        )
+        if notifications:
+            for order_id, user_id in rows:
+                self._enqueue_outbox(cursor, f"order:{order_id}:cancelled", user_id, notifications(order_id))
+        self.conn.commit()
+        return [order_id for order_id, _ in rows]
+    
+    async def add_notifications(self, dedupe_prefix, user_id, notifications):
+        """Уведомления в outbox без смены статуса; повторы с тем же dedupe_prefix игнорируются"""
+        await self._write(self._add_notifications, dedupe_prefix, user_id, notifications)
+        self.outbox_ready.set()
+    
+    def _add_notifications(self, dedupe_prefix, user_id, notifications):
+        self._enqueue_outbox(self.conn.cursor(), dedupe_prefix, user_id, notifications)
+        self.conn.commit()
+    
+    def _enqueue_outbox(self, cursor, dedupe_prefix, user_id, notifications):
+        """Добавить уведомления в outbox (внутри текущей транзакции); повторы с тем же ключом игнорируются"""
+        now = time.time()
+        cursor.executemany(
+            """INSERT OR IGNORE INTO outbox (dedupe_key, chat_id, method, payload, next_attempt_at)
+               VALUES (?, ?, ?, ?, ?)""",
+            [
+                (
+                    f"{dedupe_prefix}:{chat_id or user_id}:{number}",
+                    chat_id or user_id,
+                    method,
+                    json.dumps(kwargs, ensure_ascii=False),
+                    now
+                )
+                for number, (chat_id, method, kwargs) in enumerate(notifications)
+            ]
+        )
+    
+    def _count_order(self, cursor, order_type):
+        """Новый заказ в агрегатах по товару и по дню (внутри текущей транзакции)"""
+        cursor.execute(
+            """INSERT INTO stats_product (order_type, orders) VALUES (?, 1)
+               ON CONFLICT(order_type) DO UPDATE SET orders = orders + 1""",
+            (order_type,)
+        )
+        cursor.execute(
+            """INSERT INTO stats_daily (day, orders) VALUES (date('now'), 1)
+               ON CONFLICT(day) DO UPDATE SET orders = orders + 1"""
+        )
+    
+    def _count_status_change(self, cursor, order_type, amount_rub, old_status, new_status):
+        """Смена статуса в агрегатах: счетчики статусов, оплаты и выручка (внутри текущей транзакции)"""
+        if old_status == new_status:
+            return
+        
+        if old_status is not None:
+            cursor.execute("UPDATE stats_status SET orders = orders - 1 WHERE status = ?", (old_status,))
+        cursor.execute(
+            """INSERT INTO stats_status (status, orders) VALUES (?, 1)
+               ON CONFLICT(status) DO UPDATE SET orders = orders + 1""",
+            (new_status,)
+        )
+        
+        was_paid = old_status in PAID_STATUSES
+        is_paid = new_status in PAID_STATUSES
+        if was_paid == is_paid:
+            return
+        
+        sign = 1 if is_paid else -1
+        cursor.execute(
+            """INSERT INTO stats_product (order_type, paid, revenue_rub) VALUES (?, ?, ?)
+               ON CONFLICT(order_type) DO UPDATE SET
+                   paid = paid + excluded.paid, revenue_rub = revenue_rub + excluded.revenue_rub""",
+            (order_type, sign, sign * (amount_rub or 0))
+        )
+        cursor.execute(
+            """INSERT INTO stats_daily (day, paid, revenue_rub) VALUES (date('now'), ?, ?)
+               ON CONFLICT(day) DO UPDATE SET
+                   paid = paid + excluded.paid, revenue_rub = revenue_rub + excluded.revenue_rub""",
+            (sign, sign * (amount_rub or 0))
+        )
+    
+    async def update_invoice_id(self, order_id, invoice_id):
+        await self._write(self._update_invoice_id, order_id, invoice_id)
+        self.invalidate_order(order_id)
+    
+    def _update_invoice_id(self, order_id, invoice_id):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "UPDATE orders SET invoice_id = ? WHERE id = ?",
+            (invoice_id, order_id)
+        )
+        self.conn.commit()
+    
+    async def add_payment_photo(self, order_id, file_id):
+        """Сохранить photo_file_id оплаты заказа, если заказ в PAYMENT_PHOTO_STATUSES.
+        Возвращает False, если заказ уже подтвержден или отменен - фото не записано."""
+        updated = await self._write(self._add_payment_photo, order_id, file_id)
+        self.invalidate_order(order_id)
+        return updated
+    
+    def _add_payment_photo(self, order_id, file_id):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            f"""UPDATE orders SET payment_photo = ?
+                WHERE id = ? AND status IN ({", ".join("?" * len(PAYMENT_PHOTO_STATUSES))})""",
+            (file_id, order_id, *PAYMENT_PHOTO_STATUSES)
         )
         self.conn.commit()
         return cursor.rowcount > 0
     
-    def update_invoice_id(self, order_id, invoice_id):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "UPDATE orders SET invoice_id = ? WHERE id = ?",
-            (invoice_id, order_id)
-        )
-        self.conn.commit()
+    async def get_active_orders(self):
+        """Все активные заказы (не выполненные и не отмененные)"""
+        return await self._read(self._get_active_orders)
+    
+    def _get_active_orders(self):
+        cursor = self.conn.cursor()
+        cursor.row_factory = Order.from_row
+        cursor.execute(f"""
+            {ORDER_SELECT}
+            WHERE status NOT IN ('completed', 'cancelled')
+            ORDER BY created_at DESC, id DESC
+        """)
+        return cursor.fetchall()
+    
+    async def get_active_orders_page(self, limit, after=None, before=None, status=None):
+        """Страница активных заказов (новые сверху) по курсору (created_at, id).
+        after - заказы старше курсора (следующая страница), before - новее (предыдущая).
+        Возвращает до limit + 1 строк, лишняя строка говорит о наличии еще одной страницы."""
+        return await self._read(self._get_active_orders_page, limit, after, before, status)
+    
+    def _get_active_orders_page(self, limit, after, before, status):
+        # Фильтр по статусу идет по idx_orders_status, без фильтра - по частичному idx_orders_active
+        if status:
+            conditions = ["status = ?"]
+            params = [status]
+        else:
+            conditions = ["status NOT IN ('completed', 'cancelled')"]
+            params = []
+        
+        if before:
+            conditions.append("(created_at, id) > (?, ?)")
+            params.extend(before)
+            order = "ASC"
+        else:
+            if after:
+                conditions.append("(created_at, id) < (?, ?)")
+                params.extend(after)
+            order = "DESC"
+        
+        cursor = self.conn.cursor()
+        cursor.row_factory = Order.from_row
+        cursor.execute(f"""
+            {ORDER_SELECT}
+            WHERE {" AND ".join(conditions)}
+            ORDER BY created_at {order}, id {order}
+            LIMIT ?
+        """, (*params, limit + 1))
+        rows = cursor.fetchall()
+        
+        if before:
+            # Ближайшие к курсору строки стоят первыми - возвращаем страницу в обычном порядке
+            rows = rows[:limit][::-1] + rows[limit:]
+        return rows
+    
+    async def get_stats(self):
+        """Готовые агрегаты для экрана статистики, без обхода orders"""
+        return await self._read(self._get_stats)
+    
+    def _get_stats(self):
+        cursor = self.conn.cursor()
+        
+        cursor.execute("SELECT status, orders FROM stats_status")
+        statuses = dict(cursor.fetchall())
+        
+        cursor.execute("SELECT order_type, orders, paid, revenue_rub FROM stats_product ORDER BY order_type")
+        products = cursor.fetchall()
+        
+        revenue = {}
+        for name, days in (("today", 0), ("week", 6), ("month", 29)):
+            cursor.execute(
+                "SELECT COALESCE(SUM(revenue_rub), 0) FROM stats_daily WHERE day >= date('now', ?)",
+                (f"-{days} days",)
+            )
+            revenue[name] = cursor.fetchone()[0]
+        
+        return {"statuses": statuses, "products": products, "revenue": revenue}
+    
+    async def get_backlog(self):
+        """Активные заказы по статусам [(status, orders)] и число неотправленных сообщений outbox"""
+        return await self._read(self._get_backlog)
+    
+    def _get_backlog(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT status, orders FROM stats_status WHERE status NOT IN ('completed', 'cancelled')")
+        statuses = cursor.fetchall()
+        cursor.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'")
+        return statuses, cursor.fetchone()[0]
+    
+    async def get_orders_by_status(self, status):
+        """Заказы с указанным статусом (id, invoice_id)"""
+        return await self._read(self._get_orders_by_status, status)
+    
+    def _get_orders_by_status(self, status):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT id, invoice_id FROM orders WHERE status = ? ORDER BY id",
+            (status,)
+        )
+        return cursor.fetchall()
+    
+    async def get_due_outbox(self, limit, per_chat=OUTBOX_CHAT_BATCH):
+        """Сообщения outbox, которые пора отправить (id, chat_id, method, payload, attempts):
+        не больше limit всего и первые per_chat каждого чата"""
+        return await self._read(self._get_due_outbox, limit, per_chat)
+    
+    def _get_due_outbox(self, limit, per_chat):
+        cursor = self.conn.cursor()
+        # Пока более раннее сообщение чата ждет повтора, следующие за ним не отправляем
+        now = time.time()
+        cursor.execute(
+            """SELECT id, chat_id, method, payload, attempts FROM (
+                   SELECT id, chat_id, method, payload, attempts,
+                          ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS position
+                   FROM outbox
+                   WHERE status = 'pending' AND next_attempt_at <= ?
+                     AND NOT EXISTS (
+                         SELECT 1 FROM outbox AS earlier
+                         WHERE earlier.chat_id = outbox.chat_id AND earlier.status = 'pending'
+                           AND earlier.id < outbox.id AND earlier.next_attempt_at > ?
+                     )
+               )
+               WHERE position <= ?
+               ORDER BY id LIMIT ?""",
+            (now, now, per_chat, limit)
+        )
+        return cursor.fetchall()
+    
+    async def finish_outbox(self, sent_ids, retries, failed):
+        """Итог прохода одной транзакцией: отправленные, повторы (id, attempts, next_at, error), неудачные (id, error)"""
+        await self._write(self._finish_outbox, sent_ids, retries, failed)
+    
+    def _finish_outbox(self, sent_ids, retries, failed):
+        cursor = self.conn.cursor()
+        cursor.executemany(
+            "UPDATE outbox SET status = 'sent', attempts = attempts + 1, last_error = NULL WHERE id = ?",
+            [(outbox_id,) for outbox_id in sent_ids]
+        )
+        cursor.executemany(
+            "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            [(attempts, next_attempt_at, error, outbox_id) for outbox_id, attempts, next_attempt_at, error in retries]
+        )
+        cursor.executemany(
+            "UPDATE outbox SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?",
+            [(error, outbox_id) for outbox_id, error in failed]
+        )
+        self.conn.commit()
+    
+    async def prune_outbox(self, days):
+        """Удалить отправленные сообщения старше days дней"""
+        return await self._write(self._prune_outbox, days)
+    
+    def _prune_outbox(self, days):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "DELETE FROM outbox WHERE status = 'sent' AND created_at < datetime('now', ?)",
+            (f"-{days} days",)
+        )
+        self.conn.commit()
+        return cursor.rowcount
+    
+    async def get_fsm_entry(self, key):
+        """Запись FSM хранилища (state, data, expires_at)"""
+        return await self._read(self._get_fsm_entry, key)
+    
+    def _get_fsm_entry(self, key):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT state, data, expires_at FROM fsm_storage WHERE key = ?",
+            (key,)
+        )
+        return cursor.fetchone()
+    
+    async def save_fsm_entries(self, upserts, deletes):
+        """Пакетно сохранить и удалить записи FSM хранилища одной транзакцией"""
+        await self._write(self._save_fsm_entries, upserts, deletes)
+    
+    def _save_fsm_entries(self, upserts, deletes):
+        cursor = self.conn.cursor()
+        cursor.executemany(
+            "INSERT OR REPLACE INTO fsm_storage (key, state, data, expires_at) VALUES (?, ?, ?, ?)",
+            upserts
+        )
+        cursor.executemany("DELETE FROM fsm_storage WHERE key = ?", deletes)
+        self.conn.commit()
+    
+    async def delete_expired_fsm_entries(self, now):
+        return await self._write(self._delete_expired_fsm_entries, now)
+    
+    def _delete_expired_fsm_entries(self, now):
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM fsm_storage WHERE expires_at < ?", (now,))
+        self.conn.commit()
+        return cursor.rowcount
+    
+    async def get_order(self, order_id):
+        """Заказ (Order) по id или None, повторные запросы того же заказа - из кэша"""
+        order = self._order_cache.get(order_id)
+        if order is not None:
+            self._order_cache.move_to_end(order_id)
+            self.order_cache_hits += 1
+            return order
+        
+        self.order_cache_misses += 1
+        version = self._order_cache_version
+        order = await self._read(self._get_order, order_id)
+        
+        # Если пока шло чтение заказ поменяли, прочитанная строка может быть устаревшей - не кэшируем
+        if order is not None and version == self._order_cache_version:
+            self._order_cache[order_id] = order
+            if len(self._order_cache) > self._order_cache_size:
+                self._order_cache.popitem(last=False)
+        return order
+    
+    def invalidate_order(self, order_id=None):
+        """Убрать заказ из кэша (после записи); без order_id - очистить весь кэш"""
+        self._order_cache_version += 1
+        if order_id is None:
+            self._order_cache.clear()
+        else:
+            self._order_cache.pop(order_id, None)
+    
+    def order_cache_info(self):
+        """Счетчики кэша заказов"""
+        return {
+            "size": len(self._order_cache),
+            "max_size": self._order_cache_size,
+            "hits": self.order_cache_hits,
+            "misses": self.order_cache_misses
+        }
+    
+    def _get_order(self, order_id):
+        cursor = self.conn.cursor()
+        cursor.row_factory = Order.from_row
+        # Один запрос - один снимок: заказ, который архив переносит прямо сейчас, найдется в одной из таблиц
+        cursor.execute(
+            f"{ORDER_SELECT} WHERE id = ? UNION ALL {ORDER_ARCHIVE_SELECT} WHERE id = ? LIMIT 1",
+            (order_id, order_id)
+        )
+        return cursor.fetchone()
+    
+    async def archive_orders(self, older_than, limit):
+        """Перенести до limit заказов, завершенных больше older_than секунд назад,
+        из orders в orders_archive одной транзакцией. Возвращает число перенесенных."""
+        return await self._write(self._archive_orders, older_than, limit)
+    
+    def _archive_orders(self, older_than, limit):
+        cursor = self.conn.cursor()
+        # Возраст - с момента завершения; у заказов, завершенных до миграции 8, status_changed_at
+        # пустой - для них от создания
+        cursor.execute(
+            f"""INSERT INTO orders_archive ({ORDER_ARCHIVE_COLUMNS})
+                SELECT {ORDER_ARCHIVE_COLUMNS} FROM orders
+                WHERE id IN (
+                    SELECT id FROM orders
+                    WHERE status IN ('completed', 'cancelled')
+                      AND COALESCE(status_changed_at, created_at) < datetime('now', ?)
+                    LIMIT ?
+                )
+                RETURNING id""",
+            (f"-{older_than} seconds", limit)
+        )
+        archived = cursor.fetchall()
+        cursor.executemany("DELETE FROM orders WHERE id = ?", archived)
+        self.conn.commit()
+        return len(archived)
+    
+    async def incremental_vacuum(self, pages):
+        """Вернуть ОС до pages свободных страниц файла. Возвращает, сколько страниц освобождено."""
+        return await self._write(self._incremental_vacuum, pages)
+    
+    def _incremental_vacuum(self, pages):
+        cursor = self.conn.cursor()
+        # Без auto_vacuum=INCREMENTAL прагма ничего не делает
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        before = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        # execute делает только один шаг (одну страницу) - executescript выполняет прагму до конца
+        self.conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        return before - cursor.execute("PRAGMA freelist_count").fetchone()[0]
+
+# ========== FSM ХРАНИЛИЩЕ ==========
+class SQLiteStorage(BaseStorage):
+    """FSM хранилище aiogram: LRU кэш в памяти перед таблицей fsm_storage.
+    Записи живут FSM_TTL секунд, изменения пишутся в SQLite пакетами."""
+    
+    def __init__(self, database, max_cached=FSM_CACHE_SIZE, ttl=FSM_TTL):
+        self.db = database
+        self.max_cached = max_cached
+        self.ttl = ttl
+        self._cache = OrderedDict()  # ключ -> [state, data, expires_at]
+        self._dirty = set()
+        self._flush_lock = asyncio.Lock()
+        # Будит maintain() раньше FSM_FLUSH_INTERVAL, когда набралась полная пачка
+        self._flush_soon = asyncio.Event()
+    
+    @staticmethod
+    def _make_key(key: StorageKey):
+        return (
+            f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+            f"{key.business_connection_id or ''}:{key.destiny}"
+        )
+    
+    async def _entry(self, key: StorageKey):
+        """Запись из кэша, при промахе - из SQLite. Просроченная запись считается пустой."""
+        storage_key = self._make_key(key)
+        entry = self._cache.get(storage_key)
+        
+        if entry is None:
+            row = await self.db.get_fsm_entry(storage_key)
+            
+            # Пока ждали SQLite, запись мог создать другой хендлер
+            entry = self._cache.get(storage_key)
+            if entry is None:
+                if row:
+                    entry = [row[0], json.loads(row[1]) if row[1] else {}, row[2]]
+                else:
+                    entry = [None, {}, 0]
+                self._cache[storage_key] = entry
+                self._evict()
+        
+        self._cache.move_to_end(storage_key)
+        
+        if entry[2] and entry[2] < time.time():
+            entry[0], entry[1], entry[2] = None, {}, 0
+        
+        return storage_key, entry
+    
+    def _touch(self, storage_key, entry):
+        """Отметить запись измененной и продлить ее TTL"""
+        entry[2] = time.time() + self.ttl if (entry[0] is not None or entry[1]) else 0
+        self._dirty.add(storage_key)
+        
+        if len(self._dirty) >= FSM_FLUSH_BATCH:
+            self._flush_soon.set()
+    
+    def _evict(self):
+        """Выгрузить из памяти самые старые записи сверх лимита (несохраненные остаются до flush)"""
+        while len(self._cache) > self.max_cached:
+            storage_key = next(iter(self._cache))
+            if storage_key in self._dirty:
+                break
+            del self._cache[storage_key]
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._touch(storage_key, entry)
+    
+    async def get_state(self, key: StorageKey):
+        storage_key, entry = await self._entry(key)
+        return entry[0]
+    
+    async def set_data(self, key: StorageKey, data):
+        storage_key, entry = await self._entry(key)
+        entry[1] = data.copy()
+        self._touch(storage_key, entry)
+    
+    async def get_data(self, key: StorageKey):
+        storage_key, entry = await self._entry(key)
+        return entry[1].copy()
+    
+    async def flush(self):
+        """Записать все измененные записи одной транзакцией"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            
+            dirty, self._dirty = self._dirty, set()
+            upserts = []
+            deletes = []
+            for storage_key in dirty:
+                entry = self._cache.get(storage_key)
+                if entry is None or (entry[0] is None and not entry[1]):
+                    deletes.append((storage_key,))
+                else:
+                    upserts.append((storage_key, entry[0], json.dumps(entry[1]), entry[2]))
+            
+            try:
+                await self.db.save_fsm_entries(upserts, deletes)
+            except Exception:
+                self._dirty |= dirty
+                raise
+            
+            self._evict()
+    
+    def active_counts(self):
+        """Непустые непросроченные записи в памяти по destiny: {(destiny,): количество}"""
+        now = time.time()
+        counts = {}
+        for storage_key, entry in self._cache.items():
+            if (entry[0] is not None or entry[1]) and not (entry[2] and entry[2] < now):
+                destiny = (storage_key.rsplit(":", 1)[1],)
+                counts[destiny] = counts.get(destiny, 0) + 1
+        return counts
+    
+    def sweep(self):
+        """Убрать из памяти просроченные записи"""
+        now = time.time()
+        expired = [
+            storage_key for storage_key, entry in self._cache.items()
+            if entry[2] and entry[2] < now and storage_key not in self._dirty
+        ]
+        for storage_key in expired:
+            del self._cache[storage_key]
+        return len(expired)
+    
+    async def maintain(self):
+        """Фоновая задача: пакетная запись изменений и очистка просроченных записей"""
+        last_sweep = time.monotonic()
+        
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_soon.wait(), timeout=FSM_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_soon.clear()
+            
+            try:
+                await self.flush()
+                
+                if time.monotonic() - last_sweep >= FSM_SWEEP_INTERVAL:
+                    last_sweep = time.monotonic()
+                    self.sweep()
+                    await self.db.delete_expired_fsm_entries(time.time())
+            except Exception as e:
+                swallowed_errors.inc("fsm_storage", type(e).__name__)
+                logger.exception(f"FSM хранилище: {e}")
+    
+    async def close(self) -> None:
+        await self.flush()
+
+def admin_confirmation_context(state: FSMContext):
+    """Отдельная запись хранилища под подтверждения админа, не пересекается с покупками"""
+    return FSMContext(storage=state.storage, key=replace(state.key, destiny="admin_confirmation"))
+
+# ========== ПОЛЬЗОВАТЕЛИ ==========
+class UserBuffer:
+    """Буфер новых пользователей перед таблицей users: /start не ждет записи в SQLite.
+    Пишет пачкой раз в USER_FLUSH_INTERVAL или при USER_FLUSH_BATCH пользователях."""
+    
+    def __init__(self, database, seen_limit=USER_SEEN_LIMIT):
+        self.db = database
+        self.seen_limit = seen_limit
+        self._pending = {}  # user_id -> (user_id, username, full_name)
+        self._seen = set()  # уже в буфере или в базе - повторный /start пропускаем
+        self._flush_lock = asyncio.Lock()
+        # Будит maintain() раньше USER_FLUSH_INTERVAL, когда набралась полная пачка
+        self._flush_soon = asyncio.Event()
+    
+    def add(self, user_id, username, full_name):
+        if user_id in self._seen:
+            return
+        
+        if len(self._seen) >= self.seen_limit:
+            # Забываем всех сразу: худшее последствие - лишний INSERT OR IGNORE
+            self._seen = set(self._pending)
+        
+        self._seen.add(user_id)
+        self._pending[user_id] = (user_id, username, full_name)
+        
+        if len(self._pending) >= USER_FLUSH_BATCH:
+            self._flush_soon.set()
+    
+    async def flush(self):
+        """Записать накопленных пользователей одной транзакцией"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            
+            pending, self._pending = self._pending, {}
+            try:
+                await self.db.add_users(list(pending.values()))
+            except Exception:
+                # Вернем в буфер, запишем следующим проходом
+                self._pending = {**pending, **self._pending}
+                raise
+    
+    async def maintain(self):
+        """Фоновая задача: пакетная запись буфера"""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_soon.wait(), timeout=USER_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_soon.clear()
+            
+            try:
+                await self.flush()
+            except Exception as e:
+                swallowed_errors.inc("user_buffer", type(e).__name__)
+                logger.exception(f"Буфер пользователей: {e}")
+    
+    async def close(self):
+        await self.flush()
+
+# ========== УВЕДОМЛЕНИЯ ==========
+class TokenBucket:
+    """Ограничение частоты: rate токенов в секунду, запас не больше capacity"""
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+    
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class Notifier:
+    """Доставка сообщений с лимитами Telegram: общий NOTIFY_GLOBAL_RATE в секунду
+    и не чаще раза в NOTIFY_CHAT_INTERVAL на чат, с ожиданием по RetryAfter"""
+    
+    def __init__(self, rate=NOTIFY_GLOBAL_RATE, chat_interval=NOTIFY_CHAT_INTERVAL):
+        self.chat_interval = chat_interval
+        self._bucket = TokenBucket(rate)
+        self._chat_next = {}  # chat_id -> время, раньше которого в чат не пишем
+    
+    async def _wait_chat_slot(self, chat_id):
+        now = time.monotonic()
+        slot = max(now, self._chat_next.get(chat_id, 0))
+        self._chat_next[chat_id] = slot + self.chat_interval
+        
+        if len(self._chat_next) > 10000:
+            self._chat_next = {key: value for key, value in self._chat_next.items() if value > now}
+        
+        if slot > now:
+            await asyncio.sleep(slot - now)
+    
+    async def deliver(self, chat_id, method, **kwargs):
+        """Выполнить один вызов Bot API с учетом лимитов и RetryAfter"""
+        for attempt in range(NOTIFY_MAX_RETRIES + 1):
+            await self._wait_chat_slot(chat_id)
+            await self._bucket.acquire()
+            
+            try:
+                return await getattr(bot, method)(chat_id, **kwargs)
+            except TelegramRetryAfter as e:
+                if attempt == NOTIFY_MAX_RETRIES:
+                    raise
+                # Telegram сам говорит, сколько ждать - следующие сообщения в этот чат тоже ждут
+                self._chat_next[chat_id] = time.monotonic() + e.retry_after
+
+def admin_notifications(*calls):
+    """Уведомления для outbox всем админам: calls - (метод Bot API, аргументы)"""
+    return [(admin_id, method, kwargs) for admin_id in ADMIN_IDS for method, kwargs in calls]
+
+async def deliver_outbox_batch():
+    """Отправить один пакет outbox. Чаты обрабатываются параллельно, сообщения внутри чата - по порядку,
+    не больше OUTBOX_CHAT_BATCH на чат, чтобы проход не ждал самый загруженный чат.
+    Возвращает число взятых сообщений."""
+    rows = await db.get_due_outbox(OUTBOX_BATCH)
+    
+    by_chat = {}
+    for row in rows:
+        by_chat.setdefault(row[1], []).append(row)
+    
+    sent_ids, retries, failed = [], [], []
+    
+    async def deliver_chat(chat_rows):
+        for outbox_id, chat_id, method, payload, attempts in chat_rows:
+            try:
+                await notifier.deliver(chat_id, method, **json.loads(payload))
+                sent_ids.append(outbox_id)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Бот заблокирован или чат недоступен - повтор не поможет
+                failed.append((outbox_id, str(e)))
+            except Exception as e:
+                swallowed_errors.inc("outbox_delivery", type(e).__name__)
+                if attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                    failed.append((outbox_id, str(e)))
+                else:
+                    delay = min(OUTBOX_BACKOFF_BASE * 2 ** attempts, OUTBOX_BACKOFF_MAX)
+                    retries.append((outbox_id, attempts + 1, time.time() + delay, str(e)))
+                # Остальные сообщения этого чата ждут следующего прохода, чтобы не нарушить порядок
+                return
+    
+    await asyncio.gather(*(deliver_chat(chat_rows) for chat_rows in by_chat.values()))
+    
+    if sent_ids or retries or failed:
+        await db.finish_outbox(sent_ids, retries, failed)
+    for outbox_id, error in failed:
+        logger.warning(f"Outbox: сообщение {outbox_id} не доставлено: {error}")
     
-    def add_payment_photo(self, order_id, file_id):
-        """Сохранить photo_file_id в details заказа"""
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "UPDATE orders SET details = json_set(details, '$.payment_photo', ?) WHERE id = ?",
-            (file_id, order_id)
-        )
-        self.conn.commit()
-        return cursor.rowcount > 0
+    return len(rows)
+
+async def outbox_drainer():
+    """Фоновая задача: доставляет outbox, после сбоя или перезапуска продолжает с того же места"""
+    last_prune = 0
     
-    def get_active_orders(self):
-        """Все активные заказы (не выполненные и не отмененные)"""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT id, user_id, order_type, recipient, details, amount_rub, 
-                   payment_method, status, created_at 
-            FROM orders 
-            WHERE status NOT IN ('completed', 'cancelled')
-            ORDER BY created_at DESC
-        """)
-        return cursor.fetchall()
+    while True:
+        try:
+            taken = await deliver_outbox_batch()
+            
+            if time.monotonic() - last_prune > 3600:
+                last_prune = time.monotonic()
+                await db.prune_outbox(OUTBOX_KEEP_DAYS)
+        except Exception as e:
+            swallowed_errors.inc("outbox_drainer", type(e).__name__)
+            logger.exception(f"Outbox: {e}")
+            taken = 0
+        
+        # Что-то отправили - сразу следующий проход (у чата могли остаться сообщения сверх
+        # OUTBOX_CHAT_BATCH), иначе ждем новых сообщений или таймаута
+        if not taken:
+            try:
+                await asyncio.wait_for(db.outbox_ready.wait(), timeout=OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            db.outbox_ready.clear()
+
+# ========== ЗАПИСЬ АПДЕЙТОВ ==========
+class UpdateRecorder:
+    """Outer middleware: дописывает каждый входящий апдейт строкой JSON {"t": время, "update": ...}
+    в updates-<время>.jsonl.gz. Файлы только дописываются и ротируются по размеру.
+    Личные данные вычищаются до записи: имена и username убираются, id покупателей
+    заменяются стабильными псевдонимами, свободный текст - заглушками той же формы."""
+    
+    NUMBER = re.compile(r"^[\d\s.,]+$")
+    LONG_DIGITS = re.compile(r"\d{10,}")
+    
+    def __init__(self, directory, salt=UPDATE_LOG_SALT, rotate_bytes=UPDATE_LOG_ROTATE_BYTES,
+                 keep_files=UPDATE_LOG_KEEP_FILES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.salt = salt.encode() if salt else os.urandom(16)
+        self.rotate_bytes = rotate_bytes
+        self.keep_files = keep_files
+        self._file = None
+        self._written = 0
+    
+    async def __call__(self, handler, event, data):
+        try:
+            self.write(event.model_dump(mode="json", exclude_none=True, by_alias=True))
+        except Exception as e:
+            swallowed_errors.inc("update_recorder", type(e).__name__)
+            # Запись лога не должна мешать обработке апдейта
+            logger.warning(f"Запись апдейта: {e}")
+        return await handler(event, data)
+    
+    def _pseudonym(self, value):
+        digest = hmac.new(self.salt, str(value).encode(), hashlib.sha256).hexdigest()
+        return digest[:8]
+    
+    def _scrub_id(self, user_id):
+        # Админов оставляем как есть, иначе при повторе их действия не пройдут проверку ADMIN_IDS
+        if user_id in ADMIN_IDS:
+            return user_id
+        return int(self._pseudonym(user_id), 16) + 10 ** 10
+    
+    def _scrub_text(self, text):
+        text = self.LONG_DIGITS.sub(lambda match: "0" * len(match.group()), text)
+        if text.startswith("/") or self.NUMBER.match(text):
+            return text
+        # Получатель, сообщение в поддержку и прочий ввод: та же форма, без содержимого
+        return ("@" if text.startswith("@") else "") + "u" + self._pseudonym(text)
+    
+    def scrub(self, value, key=None):
+        """Копия апдейта без личных данных"""
+        if isinstance(value, dict):
+            if "is_bot" in value:
+                # User
+                return {"id": self._scrub_id(value["id"]), "is_bot": value["is_bot"], "first_name": "user"}
+            if key in ("chat", "sender_chat"):
+                return {"id": self._scrub_id(value["id"]), "type": value.get("type", "private")}
+            if key == "contact":
+                return {"phone_number": "0", "first_name": "user"}
+            return {
+                item_key: self.scrub(item, item_key) for item_key, item in value.items()
+                if item_key not in ("entities", "caption_entities")
+            }
+        if isinstance(value, list):
+            return [self.scrub(item, key) for item in value]
+        if isinstance(value, str):
+            if key in ("text", "caption"):
+                return self._scrub_text(value)
+            if key in ("file_id", "file_unique_id"):
+                return "f" + self._pseudonym(value)
+        return value
+    
+    def write(self, update):
+        line = json.dumps({"t": round(time.time(), 3), "update": self.scrub(update)}, ensure_ascii=False) + "\n"
+        
+        if self._file is None or self._written >= self.rotate_bytes:
+            self._rotate()
+        
+        self._file.write(line)
+        self._written += len(line)
+    
+    def _rotate(self):
+        self.close()
+        name = f"updates-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.jsonl.gz"
+        self._file = gzip.open(self.directory / name, "at", encoding="utf-8")
+        self._written = 0
+        
+        for old in sorted(self.directory.glob("updates-*.jsonl.gz"))[:-self.keep_files]:
+            old.unlink()
     
-    def get_order(self, order_id):
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT user_id, order_type, recipient, details, amount_rub, 
-                   payment_method, status, invoice_id, created_at 
-            FROM orders WHERE id = ?
-        """, (order_id,))
-        return cursor.fetchone()
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+# ========== ПЛАНИРОВЩИК АПДЕЙТОВ ==========
+# Кнопки, которые двигают деньги, и шаги покупки - остальные кнопки считаются просмотром
+PAYMENT_CALLBACKS = {"card_pay", "crypto_pay", "check_crypto", "confirm_paid", "cancel_photo"}
+INPUT_CALLBACKS = {"premium"}
+
+def classify_update(update: types.Update):
+    """Класс апдейта для UpdateScheduler: payment, admin, input или browsing"""
+    if update.callback_query:
+        route = unpack_callback(update.callback_query.data or "")
+        action = route[0].name if route else None
+        if action in PAYMENT_CALLBACKS:
+            return "payment"
+        if update.callback_query.from_user.id in ADMIN_IDS:
+            return "admin"
+        if action in INPUT_CALLBACKS:
+            return "input"
+        return "browsing"
+    
+    message = update.message
+    if message:
+        if message.photo:
+            return "payment"
+        if message.from_user and message.from_user.id in ADMIN_IDS:
+            return "admin"
+        if message.text and not message.text.startswith("/"):
+            return "input"
+    return "browsing"
+
+class UpdateScheduler:
+    """Outer middleware: апдейты ждут места в пуле своего класса (UPDATE_CLASSES) и в общем
+    лимите UPDATE_WORKERS. Освободившееся место получает самый приоритетный ждущий класс.
+    Если очередь класса полна или ожидание дольше лимита, апдейт отбрасывается."""
+    
+    def __init__(self, classes=UPDATE_CLASSES, workers=UPDATE_WORKERS):
+        self.classes = classes
+        self.workers = workers
+        self._by_priority = sorted(classes, key=lambda name: classes[name][0])
+        self._queues = {name: deque() for name in classes}  # futures ждущих апдейтов
+        self._running = {name: 0 for name in classes}
+        self._total_running = 0
+    
+    async def __call__(self, handler, event, data):
+        update_class = classify_update(event)
+        
+        if not await self._acquire(update_class):
+            update_shed.inc(update_class)
+            await self._reject(event)
+            return UNHANDLED
+        
+        try:
+            return await handler(event, data)
+        finally:
+            self._running[update_class] -= 1
+            self._total_running -= 1
+            self._dispatch()
+    
+    async def _acquire(self, update_class):
+        """Дождаться места; False - апдейт нужно отбросить"""
+        _, _, max_queued, max_wait = self.classes[update_class]
+        queue = self._queues[update_class]
+        if max_queued is not None and len(queue) >= max_queued:
+            return False
+        
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        self._dispatch()
+        
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout=max_wait)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # Место выдано в момент таймаута - апдейт обрабатывается
+                return True
+            # _dispatch мог уже вынуть отмененный future из очереди
+            if future in queue:
+                queue.remove(future)
+            return False
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Место уже выдано - вернуть его
+                self._running[update_class] -= 1
+                self._total_running -= 1
+                self._dispatch()
+            elif future in queue:
+                queue.remove(future)
+            raise
+        finally:
+            update_wait_seconds.observe(time.monotonic() - started, update_class)
+        return True
+    
+    def _dispatch(self):
+        """Раздать свободные места ждущим апдейтам по приоритету классов"""
+        for update_class in self._by_priority:
+            max_running = self.classes[update_class][1]
+            queue = self._queues[update_class]
+            while queue and self._total_running < self.workers and self._running[update_class] < max_running:
+                future = queue.popleft()
+                if future.done():
+                    continue
+                future.set_result(None)
+                self._running[update_class] += 1
+                self._total_running += 1
+    
+    async def _reject(self, update: types.Update):
+        """Отброшенная кнопка: убрать часики и попросить повторить позже"""
+        if update.callback_query:
+            try:
+                await update.callback_query.answer("⏳ Бот перегружен, попробуйте через минуту")
+            except Exception as e:
+                swallowed_errors.inc("update_scheduler", type(e).__name__)
+    
+    def queue_depths(self):
+        return {(name,): len(queue) for name, queue in self._queues.items()}
+    
+    def running(self):
+        return {(name,): count for name, count in self._running.items()}
+
+class KeyedLock:
+    """Замки по ключу: владельцы одного ключа проходят строго по очереди (asyncio.Lock - FIFO),
+    разных ключей - параллельно. Запись ключа живет, пока у него есть владелец или ждущие."""
+    
+    def __init__(self):
+        self._locks = {}  # ключ -> [asyncio.Lock, владелец и ждущие]
+    
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+    
+    def __len__(self):
+        return len(self._locks)
+    
+    def waiting(self):
+        return sum(users - 1 for _, users in self._locks.values())
+
+def update_lock_key(update: types.Update):
+    """Ключ очередности апдейта: пользователь, а для кнопок админа с заказом - заказ,
+    чтобы два админа не работали с одним заказом одновременно"""
+    callback = update.callback_query
+    if callback:
+        if callback.from_user.id in ADMIN_IDS:
+            route = unpack_callback(callback.data or "")
+            # У кнопок заказа первый аргумент - order_id
+            if route and route[1] and isinstance(route[1][0], int):
+                return ("order", route[1][0])
+        return ("user", callback.from_user.id)
+    
+    user = getattr(update.event, "from_user", None)
+    return ("user", user.id) if user else None
+
+update_locks = KeyedLock()
+
+async def serialize_updates(handler, event, data):
+    """Outer middleware: апдейты одного ключа выполняются по порядку поступления.
+    Стоит до планировщика, чтобы апдейт, ждущий свою очередь, не занимал место в пуле."""
+    key = update_lock_key(event)
+    if key is None:
+        return await handler(event, data)
+    async with update_locks.hold(key):
+        return await handler(event, data)
+
+update_lock_keys = Gauge(
+    "bot_update_lock_keys", "Ключи очередности с апдейтами в работе или в ожидании",
+    collect=lambda: {(): len(update_locks)}
+)
+update_lock_waiting = Gauge(
+    "bot_update_lock_waiting", "Апдейты, ждущие завершения предыдущего апдейта того же ключа",
+    collect=lambda: {(): update_locks.waiting()}
+)
+
+update_scheduler = UpdateScheduler()
+
+update_queue = Gauge(
+    "bot_update_queue", "Апдейты, ждущие места в планировщике, по классам", ["class"],
+    collect=update_scheduler.queue_depths
+)
+update_running = Gauge(
+    "bot_update_running", "Апдейты в обработке по классам", ["class"], collect=update_scheduler.running
+)
+update_wait_seconds = Histogram("bot_update_wait_seconds", "Ожидание места в планировщике по классам", ["class"])
+update_shed = Counter("bot_update_shed_total", "Апдейты, отброшенные планировщиком", ["class"])
 
 # ========== ИНИЦИАЛИЗАЦИЯ ==========
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+bot.session.middleware(telegram_metrics)
 db = Database()
+fsm_storage = SQLiteStorage(db)  # состояния пользователей и подтверждения админов
+user_buffer = UserBuffer(db)
+dp = Dispatcher(storage=fsm_storage)
+notifier = Notifier()
+
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+
+update_recorder = UpdateRecorder(UPDATE_LOG_DIR) if UPDATE_LOG_DIR else None
+if update_recorder:
+    dp.update.outer_middleware(update_recorder)
+
+# После записи: в лог попадают и апдейты, которые планировщик отбросит
+dp.update.outer_middleware(serialize_updates)
+dp.update.outer_middleware(update_scheduler)
+
+# ========== КНОПКИ ==========
+# callback_data нового формата: версия, код действия и аргументы через ':', например "1mo:42".
+# Версия - первый символ: при смене формата старые кнопки в чатах можно разобрать по старым правилам.
+CALLBACK_VERSION = "1"
+CALLBACK_ACTIONS = {}  # имя действия -> CallbackAction, для кнопок и разбора старого формата
+CALLBACK_CODES = {}  # код -> CallbackAction, для разбора нового формата
+
+class CallbackAction:
+    """Обработчик кнопки и функции, превращающие строки из callback_data в его аргументы"""
+    
+    __slots__ = ("name", "code", "handler", "arg_types", "required_args", "wants_state")
+    
+    def __init__(self, name, code, handler, arg_types):
+        self.name = name
+        self.code = code
+        self.handler = handler
+        self.arg_types = arg_types
+        
+        parameters = inspect.signature(handler).parameters
+        # Аргументы кнопки идут после callback; со значением по умолчанию можно не передавать
+        self.required_args = sum(
+            1 for parameter in list(parameters.values())[1:1 + len(arg_types)]
+            if parameter.default is parameter.empty
+        )
+        self.wants_state = "state" in parameters
+
+def callback_route(name, *arg_types, code):
+    """Зарегистрировать обработчик кнопки. arg_types - int, str или функция, которая
+    бросает ValueError на чужое значение. Обработчик получает (callback, *аргументы[, state=])."""
+    def register(handler):
+        if name in CALLBACK_ACTIONS or code in CALLBACK_CODES:
+            raise ValueError(f"Кнопка {name}/{code} уже зарегистрирована")
+        CALLBACK_ACTIONS[name] = CALLBACK_CODES[code] = CallbackAction(name, code, handler, arg_types)
+        return handler
+    return register
+
+def pack_callback(name, *args):
+    """callback_data кнопки действия name"""
+    data = ":".join([CALLBACK_VERSION + CALLBACK_ACTIONS[name].code, *map(str, args)])
+    if len(data.encode()) > 64 or data.count(":") != len(args):
+        raise ValueError(f"Нельзя упаковать {name}{args} в callback_data")
+    return data
 
-user_states = {}
-admin_confirmations = {}  # Для подтверждения выполнения заказа
+def unpack_callback(data):
+    """callback_data -> (CallbackAction, аргументы) или None, если кнопка не наша или устарела"""
+    if data.startswith(CALLBACK_VERSION):
+        code, *args = data[len(CALLBACK_VERSION):].split(":")
+        action = CALLBACK_CODES.get(code)
+    else:
+        action, args = parse_legacy_callback(data)
+    
+    if action is None or not action.required_args <= len(args) <= len(action.arg_types):
+        return None
+    try:
+        return action, [arg_type(arg) for arg_type, arg in zip(action.arg_types, args)]
+    except ValueError:
+        return None
+
+def parse_legacy_callback(data):
+    """Старый формат "имя" или "имя_арг_арг" - такие кнопки еще остались в отправленных сообщениях.
+    Имя ищется среди префиксов до '_', проверок не больше, чем '_' в строке."""
+    action = CALLBACK_ACTIONS.get(data)
+    if action is not None:
+        return action, []
+    
+    end = data.find("_")
+    while end != -1:
+        action = CALLBACK_ACTIONS.get(data[:end])
+        if action is not None and action.arg_types:
+            return action, data[end + 1:].split("_")
+        end = data.find("_", end + 1)
+    return None, []
+
+def callback_route_filter(callback: types.CallbackQuery):
+    """Фильтр обработчика кнопок: разобранное действие и аргументы уходят в данные апдейта"""
+    route = unpack_callback(callback.data or "")
+    if route is None:
+        return False
+    return {"callback_action": route[0], "callback_args": route[1]}
+
+@dp.callback_query(callback_route_filter)
+async def route_callback(callback: types.CallbackQuery, state: FSMContext, callback_action, callback_args):
+    """Единственный обработчик кнопок aiogram: действие выбрано по словарю в фильтре, без перебора"""
+    if callback_action.wants_state:
+        await callback_action.handler(callback, *callback_args, state=state)
+    else:
+        await callback_action.handler(callback, *callback_args)
 
 # ========== КЛАВИАТУРЫ ==========
 def main_menu_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⭐️ Купить звезды", callback_data="buy_stars")],
-        [InlineKeyboardButton(text="👑 Купить премиум", callback_data="buy_premium")],
-        [InlineKeyboardButton(text="💱 Обмен валют", callback_data="exchange")],
-        [InlineKeyboardButton(text="📊 Информация", callback_data="info")],
+        [InlineKeyboardButton(text="⭐️ Купить звезды", callback_data=pack_callback("buy_stars"))],
+        [InlineKeyboardButton(text="👑 Купить премиум", callback_data=pack_callback("buy_premium"))],
+        [InlineKeyboardButton(text="💱 Обмен валют", callback_data=pack_callback("exchange"))],
+        [InlineKeyboardButton(text="📊 Информация", callback_data=pack_callback("info"))],
         [InlineKeyboardButton(text="🆘 Тех поддержка", url=f"https://t.me/{SUPPORT_USER}")]
     ])
 
 def back_to_main_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+        [InlineKeyboardButton(text="🔙 Главное меню", callback_data=pack_callback("main_menu"))]
     ])
 
 def admin_menu_kb():
     """Упрощенное админ меню - только 2 пункта"""
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📦 Активные заказы", callback_data="admin_active_orders")],
-        [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="🔙 В меню", callback_data="main_menu")]
+        [InlineKeyboardButton(text="📦 Активные заказы", callback_data=pack_callback("admin_active_orders"))],
+        [InlineKeyboardButton(text="📊 Статистика", callback_data=pack_callback("admin_stats"))],
+        [InlineKeyboardButton(text="🔙 В меню", callback_data=pack_callback("main_menu"))]
     ])
 
 def confirm_payment_kb(order_id):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Я оплатил", callback_data=f"confirm_paid_{order_id}")],
-        [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+        [InlineKeyboardButton(text="✅ Я оплатил", callback_data=pack_callback("confirm_paid", order_id))],
+        [InlineKeyboardButton(text="🔙 Главное меню", callback_data=pack_callback("main_menu"))]
     ])
 
 def back_kb(target):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data=target)]
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=pack_callback(target))]
     ])
 
 # ========== ГЛАВНОЕ МЕНЮ ==========
@@ -251,7 +2141,7 @@ async def cmd_start(message: types.Message):
     username = message.from_user.username or ""
     full_name = message.from_user.full_name
     
-    db.add_user(user_id, username, full_name)
+    user_buffer.add(user_id, username, full_name)
     
     caption = (
         "🪐 **Digi Store - Главное меню**\n\n"
@@ -285,7 +2175,7 @@ async def show_main_menu(message: types.Message):
     )
 
 # ========== ПОКУПКА ЗВЕЗД ==========
-@dp.callback_query(F.data == "main_menu")
+@callback_route("main_menu", code="mm")
 async def main_menu_handler(callback: types.CallbackQuery):
     caption = (
         "🪐 **Digi Store - Главное меню**\n\n"
@@ -303,9 +2193,9 @@ async def main_menu_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "buy_stars")
-async def buy_stars_handler(callback: types.CallbackQuery):
-    user_states[callback.from_user.id] = {"action": "waiting_stars_recipient"}
+@callback_route("buy_stars", code="bs")
+async def buy_stars_handler(callback: types.CallbackQuery, state: FSMContext):
+    await state.set_data({"action": "waiting_stars_recipient"})
     
     caption = (
         "⭐️ **Покупка Telegram Stars**\n\n"
@@ -321,17 +2211,17 @@ async def buy_stars_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "buy_premium")
+@callback_route("buy_premium", code="bp")
 async def buy_premium_handler(callback: types.CallbackQuery):
     price_text = ""
     for key, value in PREMIUM_PRICES.items():
         price_text += f"• {value['name']}: {value['rub']:.2f} RUB\n"
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="3 месяца", callback_data="premium_3m")],
-        [InlineKeyboardButton(text="6 месяцев", callback_data="premium_6m")],
-        [InlineKeyboardButton(text="1 год", callback_data="premium_1y")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
+        [InlineKeyboardButton(text="3 месяца", callback_data=pack_callback("premium", "3m"))],
+        [InlineKeyboardButton(text="6 месяцев", callback_data=pack_callback("premium", "6m"))],
+        [InlineKeyboardButton(text="1 год", callback_data=pack_callback("premium", "1y"))],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=pack_callback("main_menu"))]
     ])
     
     caption = (
@@ -347,34 +2237,36 @@ async def buy_premium_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("premium_"))
-async def premium_period_handler(callback: types.CallbackQuery):
-    period = callback.data.replace("premium_", "")
+def premium_period(value):
+    """Аргумент кнопки: ключ PREMIUM_PRICES"""
+    if value not in PREMIUM_PRICES:
+        raise ValueError(value)
+    return value
+
+@callback_route("premium", premium_period, code="pp")
+async def premium_period_handler(callback: types.CallbackQuery, period: str, state: FSMContext):
+    await state.set_data({
+        "action": "waiting_premium_recipient",
+        "period": period,
+        "amount_rub": PREMIUM_PRICES[period]["rub"]
+    })
     
-    if period in PREMIUM_PRICES:
-        user_states[callback.from_user.id] = {
-            "action": "waiting_premium_recipient",
-            "period": period,
-            "amount_rub": PREMIUM_PRICES[period]["rub"]
-        }
-        
-        caption = (
-            f"👑 **Telegram Premium - {PREMIUM_PRICES[period]['name']}**\n\n"
-            f"Цена: **{PREMIUM_PRICES[period]['rub']:.2f} RUB**\n\n"
-            "✏️ Введите username получателя (можно с @):"
-        )
-        
-        await callback.message.edit_text(
-            text=caption,
-            reply_markup=back_kb("buy_premium"),
-            parse_mode="Markdown"
-        )
+    caption = (
+        f"👑 **Telegram Premium - {PREMIUM_PRICES[period]['name']}**\n\n"
+        f"Цена: **{PREMIUM_PRICES[period]['rub']:.2f} RUB**\n\n"
+        "✏️ Введите username получателя (можно с @):"
+    )
     
+    await callback.message.edit_text(
+        text=caption,
+        reply_markup=back_kb("buy_premium"),
+        parse_mode="Markdown"
+    )
     await callback.answer()
 
-@dp.callback_query(F.data == "exchange")
-async def exchange_handler(callback: types.CallbackQuery):
-    user_states[callback.from_user.id] = {"action": "waiting_exchange_amount"}
+@callback_route("exchange", code="ex")
+async def exchange_handler(callback: types.CallbackQuery, state: FSMContext):
+    await state.set_data({"action": "waiting_exchange_amount"})
     
     caption = (
         "💱 **Обмен валют**\n\n"
@@ -391,12 +2283,12 @@ async def exchange_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@dp.callback_query(F.data == "info")
+@callback_route("info", code="in")
 async def info_handler(callback: types.CallbackQuery):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📈 Репутация", url=REPUTATION_CHANNEL)],
         [InlineKeyboardButton(text="📰 Новости", url=NEWS_CHANNEL)],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=pack_callback("main_menu"))]
     ])
     
     caption = "📊 **Информация**\n\nВыберите раздел:"
@@ -428,85 +2320,122 @@ async def admin_panel(message: types.Message):
     )
 
 # Показ активных заказов
-@dp.callback_query(F.data == "admin_active_orders")
+# Фильтры по статусу: короткий ключ для callback_data -> (статус, название)
+ORDER_FILTERS = {
+    "all": (None, "Все"),
+    "pend": ("pending", "⏳"),
+    "wpay": ("waiting_payment", "💳"),
+    "wconf": ("waiting_confirmation", "📸"),
+    "wcry": ("waiting_crypto", "💎"),
+    "conf": ("confirmed", "✅")
+}
+
+def orders_page_callback(filter_key, direction="n", order=None):
+    """callback_data страницы заказов: фильтр, направление n|p и курсор (created_at цифрами, id)"""
+    if order is None:
+        return pack_callback("orders_page", filter_key, direction)
+    created_at = "".join(ch for ch in str(order.created_at) if ch.isdigit())
+    return pack_callback("orders_page", filter_key, direction, created_at, order.id)
+
+def order_filter(value):
+    """Аргумент кнопки: ключ ORDER_FILTERS"""
+    if value not in ORDER_FILTERS:
+        raise ValueError(value)
+    return value
+
+def page_direction(value):
+    if value not in ("n", "p"):
+        raise ValueError(value)
+    return value
+
+def cursor_time(value):
+    """Аргумент кнопки: created_at из 14 цифр обратно в 'YYYY-MM-DD HH:MM:SS'"""
+    if len(value) != 14 or not value.isdigit():
+        raise ValueError(value)
+    return f"{value[0:4]}-{value[4:6]}-{value[6:8]} {value[8:10]}:{value[10:12]}:{value[12:14]}"
+
+@callback_route("admin_active_orders", code="ao")
 async def admin_active_orders_handler(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    orders = db.get_active_orders()
+    await show_active_orders_page(callback)
+
+@callback_route("orders_page", order_filter, page_direction, cursor_time, int, code="op")
+async def admin_orders_page_handler(callback: types.CallbackQuery, filter_key: str, direction: str,
+                                    created_at: str = None, order_id: int = None):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("❌ Доступ запрещен")
+        return
+    
+    cursor = (created_at, order_id) if order_id is not None else None
+    
+    await show_active_orders_page(callback, filter_key, direction, cursor)
+
+async def show_active_orders_page(callback: types.CallbackQuery, filter_key="all", direction="n", cursor=None):
+    """Одна страница активных заказов - один индексный запрос независимо от размера очереди"""
+    status_filter, filter_name = ORDER_FILTERS[filter_key]
+    
+    if direction == "p" and cursor:
+        rows = await db.get_active_orders_page(ADMIN_ORDERS_PAGE_SIZE, before=cursor, status=status_filter)
+        orders = rows[:ADMIN_ORDERS_PAGE_SIZE]
+        has_newer = len(rows) > ADMIN_ORDERS_PAGE_SIZE
+        has_older = True
+    else:
+        rows = await db.get_active_orders_page(ADMIN_ORDERS_PAGE_SIZE, after=cursor, status=status_filter)
+        orders = rows[:ADMIN_ORDERS_PAGE_SIZE]
+        has_newer = cursor is not None
+        has_older = len(rows) > ADMIN_ORDERS_PAGE_SIZE
+    
+    # Кнопки фильтров по статусу, текущий отмечен
+    filter_buttons = [
+        InlineKeyboardButton(
+            text=f"• {name} •" if key == filter_key else name,
+            callback_data=orders_page_callback(key)
+        )
+        for key, (status, name) in ORDER_FILTERS.items()
+    ]
     
     if not orders:
         caption = "📦 **Активные заказы**\n\nНет активных заказов"
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_active_orders")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
+            filter_buttons,
+            [InlineKeyboardButton(text="🔄 Обновить", callback_data=orders_page_callback(filter_key))],
+            [InlineKeyboardButton(text="🔙 Назад", callback_data=pack_callback("admin_back"))]
         ])
     else:
         caption = "📦 **Активные заказы**\n\n"
         
-        # Группируем заказы по статусу
         for order in orders:
-            order_id, user_id, order_type, recipient, details, amount_rub, payment_method, status, created_at = order
-            
-            # Статусы в emoji
-            status_emoji = {
-                'pending': '⏳',
-                'waiting_payment': '💳',
-                'waiting_confirmation': '📸',
-                'waiting_crypto': '💎',
-                'confirmed': '✅'
-            }.get(status, '❓')
-            
-            # Форматируем дату
-            created_short = str(created_at)[:16] if created_at else "---"
-            
-            caption += f"{status_emoji} **Заказ #{order_id}**\n"
-            caption += f"📦 Тип: {order_type}\n"
-            
-            if order_type == "stars":
-                try:
-                    details_dict = json.loads(details) if details else {}
-                    stars = details_dict.get("stars", 0)
-                    caption += f"⭐️ Количество: {stars} звезд\n"
-                except:
-                    pass
-            elif order_type == "premium":
-                try:
-                    details_dict = json.loads(details) if details else {}
-                    period = details_dict.get("period", "")
-                    period_name = PREMIUM_PRICES.get(period, {}).get("name", "")
-                    caption += f"👑 Период: {period_name}\n"
-                except:
-                    pass
-            elif order_type == "exchange":
-                try:
-                    details_dict = json.loads(details) if details else {}
-                    amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-                    caption += f"💸 К выдаче: {amount_usd:.2f} USD\n"
-                except:
-                    pass
-            
-            if recipient:
-                caption += f"👤 Получатель: @{recipient}\n"
-            
-            caption += f"💰 Сумма: {amount_rub:.2f} RUB\n"
-            caption += f"💳 Метод: {payment_method}\n"
-            caption += f"📅 Дата: {created_short}\n"
-            caption += f"📊 Статус: {status}\n\n"
+            caption += format_active_order(order)
         
         keyboard_buttons = []
         for order in orders:
-            order_id = order[0]
+            order_id = order.id
             keyboard_buttons.append([
                 InlineKeyboardButton(
                     text=f"📦 Управление заказом #{order_id}", 
-                    callback_data=f"manage_order_{order_id}"
+                    callback_data=pack_callback("manage_order", order_id)
                 )
             ])
         
-        keyboard_buttons.append([InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_active_orders")])
-        keyboard_buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")])
+        # Навигация по страницам: курсор - первый/последний заказ страницы
+        nav_buttons = []
+        if has_newer:
+            nav_buttons.append(InlineKeyboardButton(
+                text="⬅️ Новее", callback_data=orders_page_callback(filter_key, "p", orders[0])
+            ))
+        if has_older:
+            nav_buttons.append(InlineKeyboardButton(
+                text="Старее ➡️", callback_data=orders_page_callback(filter_key, "n", orders[-1])
+            ))
+        if nav_buttons:
+            keyboard_buttons.append(nav_buttons)
+        
+        keyboard_buttons.append(filter_buttons)
+        keyboard_buttons.append([InlineKeyboardButton(text="🔄 Обновить", callback_data=orders_page_callback(filter_key))])
+        keyboard_buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data=pack_callback("admin_back"))])
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
     
@@ -517,40 +2446,62 @@ async def admin_active_orders_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
+def format_active_order(order):
+    """Блок заказа для списка активных заказов"""
+    # Статусы в emoji
+    status_emoji = {
+        'pending': '⏳',
+        'waiting_payment': '💳',
+        'waiting_confirmation': '📸',
+        'waiting_crypto': '💎',
+        'confirmed': '✅'
+    }.get(order.status, '❓')
+    
+    # Форматируем дату
+    created_short = str(order.created_at)[:16] if order.created_at else "---"
+    
+    text = f"{status_emoji} **Заказ #{order.id}**\n"
+    text += f"📦 Тип: {order.order_type}\n"
+    
+    if order.order_type == "stars":
+        text += f"⭐️ Количество: {order.stars or 0} звезд\n"
+    elif order.order_type == "premium":
+        text += f"👑 Период: {order.period_name}\n"
+    elif order.order_type == "exchange":
+        text += f"💸 К выдаче: {order.payout_usd:.2f} USD\n"
+    
+    if order.recipient:
+        text += f"👤 Получатель: @{order.recipient}\n"
+    
+    text += f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
+    text += f"💳 Метод: {order.payment_method}\n"
+    text += f"📅 Дата: {created_short}\n"
+    text += f"📊 Статус: {order.status}\n\n"
+    return text
+
 # Управление конкретным заказом (С ФОТО ОПЛАТЫ)
-@dp.callback_query(F.data.startswith("manage_order_"))
-async def manage_order_handler(callback: types.CallbackQuery):
+@callback_route("manage_order", int, code="mo")
+async def manage_order_handler(callback: types.CallbackQuery, order_id: int):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("manage_order_", ""))
-    order = db.get_order(order_id)
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id, created_at = order
-    
-    # Получаем детали заказа
-    details_dict = {}
-    try:
-        if details:
-            details_dict = json.loads(details)
-    except:
-        pass
-    
     # Проверяем есть ли фото оплаты
-    photo_file_id = details_dict.get("payment_photo") if details_dict else None
+    photo_file_id = order.payment_photo
     
-    if photo_file_id and status in ["waiting_confirmation", "confirmed"]:
+    if photo_file_id and order.status in ["waiting_confirmation", "confirmed"]:
         # Отправляем фото оплаты админу
         try:
             photo_caption = f"📸 **Фото оплаты заказа #{order_id}**\n\n"
             photo_caption += f"🆔 Заказ: #{order_id}\n"
-            photo_caption += f"📦 Тип: {order_type}\n"
-            photo_caption += f"💰 Сумма: {amount_rub:.2f} RUB"
+            photo_caption += f"📦 Тип: {order.order_type}\n"
+            photo_caption += f"💰 Сумма: {order.amount_rub:.2f} RUB"
             
             await bot.send_photo(
                 callback.message.chat.id,
@@ -559,6 +2510,7 @@ async def manage_order_handler(callback: types.CallbackQuery):
                 parse_mode="Markdown"
             )
         except Exception as e:
+            swallowed_errors.inc("admin_payment_photo", type(e).__name__)
             print(f"Ошибка отправки фото: {e}")
             await callback.message.answer("❌ Не удалось загрузить фото оплаты")
     
@@ -567,29 +2519,25 @@ async def manage_order_handler(callback: types.CallbackQuery):
     
     # Информация о пользователе
     caption += f"👤 **Покупатель:**\n"
-    caption += f"   ID: `{user_id}`\n"
+    caption += f"   ID: `{order.user_id}`\n"
     
     # Информация о заказе
     caption += f"\n📦 **Детали заказа:**\n"
-    caption += f"   Тип: {order_type}\n"
-    
-    if order_type == "stars":
-        stars = details_dict.get("stars", 0)
-        caption += f"   ⭐️ Звезд: {stars}\n"
-    elif order_type == "premium":
-        period = details_dict.get("period", "")
-        period_name = PREMIUM_PRICES.get(period, {}).get("name", "")
-        caption += f"   👑 Период: {period_name}\n"
-    elif order_type == "exchange":
-        amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-        caption += f"   💸 К выдаче: {amount_usd:.2f} USD\n"
-    
-    if recipient:
-        caption += f"   👤 Получатель: @{recipient}\n"
-    
-    caption += f"   💰 Сумма: {amount_rub:.2f} RUB\n"
-    caption += f"   💳 Метод: {payment_method}\n"
-    caption += f"   📊 Статус: {status}\n"
+    caption += f"   Тип: {order.order_type}\n"
+    
+    if order.order_type == "stars":
+        caption += f"   ⭐️ Звезд: {order.stars or 0}\n"
+    elif order.order_type == "premium":
+        caption += f"   👑 Период: {order.period_name}\n"
+    elif order.order_type == "exchange":
+        caption += f"   💸 К выдаче: {order.payout_usd:.2f} USD\n"
+    
+    if order.recipient:
+        caption += f"   👤 Получатель: @{order.recipient}\n"
+    
+    caption += f"   💰 Сумма: {order.amount_rub:.2f} RUB\n"
+    caption += f"   💳 Метод: {order.payment_method}\n"
+    caption += f"   📊 Статус: {order.status}\n"
     
     if photo_file_id:
         caption += f"   📸 Фото оплаты: ✅ Есть\n"
@@ -599,42 +2547,42 @@ async def manage_order_handler(callback: types.CallbackQuery):
     # Кнопки управления
     keyboard_buttons = []
     
-    if status == "waiting_confirmation":
+    if order.status == "waiting_confirmation":
         # Заказ ожидает проверки фото
         keyboard_buttons.append([
-            InlineKeyboardButton(text="✅ Подтвердить оплату", callback_data=f"admin_confirm_payment_{order_id}")
+            InlineKeyboardButton(text="✅ Подтвердить оплату", callback_data=pack_callback("admin_confirm_payment", order_id))
         ])
         keyboard_buttons.append([
-            InlineKeyboardButton(text="❌ Отклонить заказ", callback_data=f"admin_reject_order_{order_id}")
+            InlineKeyboardButton(text="❌ Отклонить заказ", callback_data=pack_callback("admin_reject_order", order_id))
         ])
     
-    elif status == "waiting_crypto":
+    elif order.status == "waiting_crypto":
         # CryptoBot оплата
         keyboard_buttons.append([
-            InlineKeyboardButton(text="💎 Проверить оплату", callback_data=f"check_crypto_{order_id}")
+            InlineKeyboardButton(text="💎 Проверить оплату", callback_data=pack_callback("check_crypto", order_id))
         ])
         keyboard_buttons.append([
-            InlineKeyboardButton(text="❌ Отменить заказ", callback_data=f"admin_reject_order_{order_id}")
+            InlineKeyboardButton(text="❌ Отменить заказ", callback_data=pack_callback("admin_reject_order", order_id))
         ])
     
-    elif status == "confirmed":
+    elif order.status == "confirmed":
         # Заказ подтвержден, можно выполнить
         keyboard_buttons.append([
-            InlineKeyboardButton(text="📦 Я передал товар", callback_data=f"admin_delivered_{order_id}")
+            InlineKeyboardButton(text="📦 Я передал товар", callback_data=pack_callback("admin_delivered", order_id))
         ])
     
     else:
         # Другие статусы
         keyboard_buttons.append([
-            InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"admin_confirm_payment_{order_id}")
+            InlineKeyboardButton(text="✅ Подтвердить", callback_data=pack_callback("admin_confirm_payment", order_id))
         ])
         keyboard_buttons.append([
-            InlineKeyboardButton(text="❌ Отменить", callback_data=f"admin_reject_order_{order_id}")
+            InlineKeyboardButton(text="❌ Отменить", callback_data=pack_callback("admin_reject_order", order_id))
         ])
     
     keyboard_buttons.append([
-        InlineKeyboardButton(text="🔄 Обновить", callback_data=f"manage_order_{order_id}"),
-        InlineKeyboardButton(text="📦 К заказам", callback_data="admin_active_orders")
+        InlineKeyboardButton(text="🔄 Обновить", callback_data=pack_callback("manage_order", order_id)),
+        InlineKeyboardButton(text="📦 К заказам", callback_data=pack_callback("admin_active_orders"))
     ])
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
@@ -647,19 +2595,17 @@ async def manage_order_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # Подтверждение оплаты (админ)
-@dp.callback_query(F.data.startswith("admin_confirm_payment_"))
-async def admin_confirm_payment_handler(callback: types.CallbackQuery):
+@callback_route("admin_confirm_payment", int, code="ac")
+async def admin_confirm_payment_handler(callback: types.CallbackQuery, order_id: int, state: FSMContext):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("admin_confirm_payment_", ""))
-    
     # Сохраняем подтверждение
-    admin_confirmations[callback.from_user.id] = {
+    await admin_confirmation_context(state).set_data({
         "action": "confirm_payment",
         "order_id": order_id
-    }
+    })
     
     caption = (
         f"⚠️ **ВНИМАНИЕ!**\n\n"
@@ -672,8 +2618,8 @@ async def admin_confirm_payment_handler(callback: types.CallbackQuery):
     )
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ ДА, я всё проверил и подтверждаю", callback_data=f"admin_final_confirm_{order_id}")],
-        [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"manage_order_{order_id}")]
+        [InlineKeyboardButton(text="✅ ДА, я всё проверил и подтверждаю", callback_data=pack_callback("admin_final_confirm", order_id))],
+        [InlineKeyboardButton(text="🔙 Отмена", callback_data=pack_callback("manage_order", order_id))]
     ])
     
     await callback.message.edit_text(
@@ -684,53 +2630,40 @@ async def admin_confirm_payment_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # Финальное подтверждение
-@dp.callback_query(F.data.startswith("admin_final_confirm_"))
-async def admin_final_confirm_handler(callback: types.CallbackQuery):
+@callback_route("admin_final_confirm", int, code="fc")
+async def admin_final_confirm_handler(callback: types.CallbackQuery, order_id: int, state: FSMContext):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("admin_final_confirm_", ""))
-    
-    # Меняем статус заказа
-    db.update_order_status(order_id, "confirmed")
-    
-    # Уведомляем пользователя
-    order = db.get_order(order_id)
-    if order:
-        user_id = order[0]
-        try:
-            await bot.send_message(
-                user_id,
-                f"✅ **Ваш заказ #{order_id} подтвержден!**\n\n"
-                f"Товар будет отправлен в течение 15 минут - 3 часа."
-            )
-        except:
-            pass
+    # Меняем статус заказа (повторное нажатие или уже отмененный заказ не меняют ничего)
+    confirmed = await db.update_order_status(order_id, "confirmed", notifications=[
+        (None, "send_message", {"text": (
+            f"✅ **Ваш заказ #{order_id} подтвержден!**\n\n"
+            f"Товар будет отправлен в течение 15 минут - 3 часа."
+        )})
+    ])
     
     # Удаляем подтверждение
-    if callback.from_user.id in admin_confirmations:
-        del admin_confirmations[callback.from_user.id]
+    await admin_confirmation_context(state).clear()
     
-    await callback.answer("✅ Заказ подтвержден!")
+    await callback.answer("✅ Заказ подтвержден!" if confirmed else "⚠️ Статус заказа уже изменен")
     
     # Возвращаем к списку заказов
     await admin_active_orders_handler(callback)
 
 # Отклонение заказа (админ)
-@dp.callback_query(F.data.startswith("admin_reject_order_"))
-async def admin_reject_order_handler(callback: types.CallbackQuery):
+@callback_route("admin_reject_order", int, code="ar")
+async def admin_reject_order_handler(callback: types.CallbackQuery, order_id: int, state: FSMContext):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("admin_reject_order_", ""))
-    
     # Сохраняем подтверждение
-    admin_confirmations[callback.from_user.id] = {
+    await admin_confirmation_context(state).set_data({
         "action": "reject_order",
         "order_id": order_id
-    }
+    })
     
     caption = (
         f"⚠️ **ВНИМАНИЕ!**\n\n"
@@ -743,8 +2676,8 @@ async def admin_reject_order_handler(callback: types.CallbackQuery):
     )
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="❌ ДА, отклоняю заказ", callback_data=f"admin_final_reject_{order_id}")],
-        [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"manage_order_{order_id}")]
+        [InlineKeyboardButton(text="❌ ДА, отклоняю заказ", callback_data=pack_callback("admin_final_reject", order_id))],
+        [InlineKeyboardButton(text="🔙 Отмена", callback_data=pack_callback("manage_order", order_id))]
     ])
     
     await callback.message.edit_text(
@@ -755,53 +2688,40 @@ async def admin_reject_order_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # Финальное отклонение
-@dp.callback_query(F.data.startswith("admin_final_reject_"))
-async def admin_final_reject_handler(callback: types.CallbackQuery):
+@callback_route("admin_final_reject", int, code="fr")
+async def admin_final_reject_handler(callback: types.CallbackQuery, order_id: int, state: FSMContext):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("admin_final_reject_", ""))
-    
     # Меняем статус заказа
-    db.update_order_status(order_id, "cancelled")
-    
-    # Уведомляем пользователя
-    order = db.get_order(order_id)
-    if order:
-        user_id = order[0]
-        try:
-            await bot.send_message(
-                user_id,
-                f"❌ **Ваш заказ #{order_id} отклонен.**\n\n"
-                f"По вопросам обращайтесь в поддержку."
-            )
-        except:
-            pass
+    rejected = await db.update_order_status(order_id, "cancelled", notifications=[
+        (None, "send_message", {"text": (
+            f"❌ **Ваш заказ #{order_id} отклонен.**\n\n"
+            f"По вопросам обращайтесь в поддержку."
+        )})
+    ])
     
     # Удаляем подтверждение
-    if callback.from_user.id in admin_confirmations:
-        del admin_confirmations[callback.from_user.id]
+    await admin_confirmation_context(state).clear()
     
-    await callback.answer("❌ Заказ отклонен")
+    await callback.answer("❌ Заказ отклонен" if rejected else "⚠️ Статус заказа уже изменен")
     
     # Возвращаем к списку заказов (заказ исчезнет из списка)
     await admin_active_orders_handler(callback)
 
 # Админ подтвердил передачу товара
-@dp.callback_query(F.data.startswith("admin_delivered_"))
-async def admin_delivered_handler(callback: types.CallbackQuery):
+@callback_route("admin_delivered", int, code="ad")
+async def admin_delivered_handler(callback: types.CallbackQuery, order_id: int, state: FSMContext):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("admin_delivered_", ""))
-    
     # Сохраняем подтверждение
-    admin_confirmations[callback.from_user.id] = {
+    await admin_confirmation_context(state).set_data({
         "action": "delivered",
         "order_id": order_id
-    }
+    })
     
     caption = (
         f"⚠️ **ПОДТВЕРЖДЕНИЕ ПЕРЕДАЧИ**\n\n"
@@ -814,8 +2734,8 @@ async def admin_delivered_handler(callback: types.CallbackQuery):
     )
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ ДА, товар передан", callback_data=f"admin_final_delivered_{order_id}")],
-        [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"manage_order_{order_id}")]
+        [InlineKeyboardButton(text="✅ ДА, товар передан", callback_data=pack_callback("admin_final_delivered", order_id))],
+        [InlineKeyboardButton(text="🔙 Отмена", callback_data=pack_callback("manage_order", order_id))]
     ])
     
     await callback.message.edit_text(
@@ -826,59 +2746,70 @@ async def admin_delivered_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # Финальное подтверждение передачи
-@dp.callback_query(F.data.startswith("admin_final_delivered_"))
-async def admin_final_delivered_handler(callback: types.CallbackQuery):
+@callback_route("admin_final_delivered", int, code="fd")
+async def admin_final_delivered_handler(callback: types.CallbackQuery, order_id: int, state: FSMContext):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    order_id = int(callback.data.replace("admin_final_delivered_", ""))
-    
     # Меняем статус заказа на выполненный
-    db.update_order_status(order_id, "completed")
-    
-    # Уведомляем пользователя
-    order = db.get_order(order_id)
-    if order:
-        user_id = order[0]
-        try:
-            await bot.send_message(
-                user_id,
-                f"🎉 **Ваш заказ #{order_id} выполнен!**\n\n"
-                f"Спасибо за покупку! 😊"
-            )
-        except:
-            pass
+    completed = await db.update_order_status(order_id, "completed", notifications=[
+        (None, "send_message", {"text": (
+            f"🎉 **Ваш заказ #{order_id} выполнен!**\n\n"
+            f"Спасибо за покупку! 😊"
+        )})
+    ])
     
     # Удаляем подтверждение
-    if callback.from_user.id in admin_confirmations:
-        del admin_confirmations[callback.from_user.id]
+    await admin_confirmation_context(state).clear()
     
-    await callback.answer("✅ Заказ выполнен!")
+    await callback.answer("✅ Заказ выполнен!" if completed else "⚠️ Статус заказа уже изменен")
     
     # Возвращаем к списку заказов (заказ исчезнет из списка)
     await admin_active_orders_handler(callback)
 
 # Статистика
-@dp.callback_query(F.data == "admin_stats")
+@callback_route("admin_stats", code="as")
 async def admin_stats_handler(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
         return
     
-    # Простая статистика
-    orders = db.get_active_orders()
-    active_count = len(orders)
+    stats = await db.get_stats()
+    statuses = stats["statuses"]
+    
+    active_count = sum(count for status, count in statuses.items() if status not in ("completed", "cancelled"))
+    total_orders = sum(count for order_type, count, paid, revenue in stats["products"])
+    total_paid = sum(paid for order_type, count, paid, revenue in stats["products"])
+    total_revenue = sum(revenue for order_type, count, paid, revenue in stats["products"])
+    conversion = total_paid / total_orders * 100 if total_orders else 0
     
     caption = (
         f"📊 **Статистика магазина**\n\n"
-        f"📦 Активных заказов: {active_count}\n\n"
-        f"Для детальной статистики используйте аналитику."
+        f"📦 Активных заказов: {active_count}\n"
+        f"   ⏳ Ожидают оплаты: {statuses.get('pending', 0) + statuses.get('waiting_payment', 0)}\n"
+        f"   📸 Проверка фото: {statuses.get('waiting_confirmation', 0)}\n"
+        f"   💎 CryptoBot: {statuses.get('waiting_crypto', 0)}\n"
+        f"   ✅ К выдаче: {statuses.get('confirmed', 0)}\n\n"
+        f"🧾 Всего заказов: {total_orders}\n"
+        f"🎉 Выполнено: {statuses.get('completed', 0)}\n"
+        f"❌ Отменено: {statuses.get('cancelled', 0)}\n"
+        f"📈 Конверсия в оплату: {conversion:.1f}%\n\n"
+        f"💰 **Выручка:**\n"
+        f"   Сегодня: {stats['revenue']['today']:.2f} RUB\n"
+        f"   7 дней: {stats['revenue']['week']:.2f} RUB\n"
+        f"   30 дней: {stats['revenue']['month']:.2f} RUB\n"
+        f"   Всего: {total_revenue:.2f} RUB\n"
     )
     
+    if stats["products"]:
+        caption += "\n📦 **По товарам:**\n"
+        for order_type, count, paid, revenue in stats["products"]:
+            caption += f"   {order_type}: {count} заказов, {paid} оплачено, {revenue:.2f} RUB\n"
+    
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data=pack_callback("admin_stats"))],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data=pack_callback("admin_back"))]
     ])
     
     await callback.message.edit_text(
@@ -889,7 +2820,7 @@ async def admin_stats_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # Назад в админ меню
-@dp.callback_query(F.data == "admin_back")
+@callback_route("admin_back", code="ab")
 async def admin_back_handler(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("❌ Доступ запрещен")
@@ -909,97 +2840,74 @@ async def admin_back_handler(callback: types.CallbackQuery):
 
 # ========== ОБРАБОТКА ФОТО ОПЛАТЫ ==========
 @dp.message(F.photo)
-async def handle_payment_photo(message: types.Message):
+async def handle_payment_photo(message: types.Message, state: FSMContext):
     """Обработка фото оплаты"""
     user_id = message.from_user.id
+    state_data = await state.get_data()
     
-    if user_id not in user_states:
+    if not state_data:
         await message.answer("Пожалуйста, используйте кнопки меню.")
         return
     
-    state = user_states[user_id]
-    
-    if state.get("action") == "waiting_payment_photo":
-        order_id = state.get("order_id")
-        order = db.get_order(order_id)
+    if state_data.get("action") == "waiting_payment_photo":
+        order_id = state_data.get("order_id")
+        order = await db.get_order(order_id)
         
         if not order:
             await message.answer("❌ Заказ не найден")
             return
         
-        user_id_db, order_type, recipient, details, amount_rub, payment_method, status, invoice_id, created_at = order
-        
         # Получаем file_id фото
         photo_file_id = message.photo[-1].file_id
         
-        # Сохраняем фото в базу
-        try:
-            details_dict = json.loads(details) if details else {}
-            details_dict["payment_photo"] = photo_file_id
-            db.add_payment_photo(order_id, photo_file_id)
-        except:
-            pass
-        
-        # Обновляем статус
-        db.update_order_status(order_id, "waiting_confirmation")
+        # Сохраняем фото в базу (к подтвержденному или отмененному заказу - нет)
+        if not await db.add_payment_photo(order_id, photo_file_id):
+            await state.clear()
+            await message.answer(f"❌ Заказ #{order_id} уже обработан или отменен")
+            await show_main_menu(message)
+            return
         
         # Удаляем состояние
-        del user_states[user_id]
+        await state.clear()
         
-        # Уведомляем админа с фото
-        for admin_id in ADMIN_IDS:
-            try:
-                # Сначала отправляем фото
-                photo_caption = f"📸 **Новое фото оплаты | Заказ #{order_id}**"
-                
-                await bot.send_photo(
-                    admin_id,
-                    photo=photo_file_id,
-                    caption=photo_caption
-                )
-                
-                # Затем отправляем детали заказа
-                admin_message = f"🆕 **Новый заказ ожидает проверки**\n\n"
-                admin_message += f"🆔 Заказ: #{order_id}\n"
-                admin_message += f"👤 Пользователь: {message.from_user.username or 'Нет юзернейма'}\n"
-                admin_message += f"🆔 ID: {message.from_user.id}\n"
-                admin_message += f"📦 Тип: {order_type}\n"
-                admin_message += f"💰 Сумма: {amount_rub:.2f} RUB\n"
-                
-                if order_type == "exchange":
-                    try:
-                        details_dict = json.loads(details) if details else {}
-                        amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-                        admin_message += f"💸 К выдаче: {amount_usd:.2f} USD\n"
-                    except:
-                        pass
-                else:
-                    admin_message += f"👤 Получатель: {recipient}\n"
-                
-                admin_message += f"\nДля проверки зайдите в /admin → 📦 Активные заказы"
-                
-                await bot.send_message(admin_id, admin_message)
-                
-            except Exception as e:
-                print(f"Ошибка отправки админу: {e}")
+        # Уведомляем админов с фото (через outbox, покупатель не ждет рассылку)
+        photo_caption = f"📸 **Новое фото оплаты | Заказ #{order_id}**"
+        
+        admin_message = f"🆕 **Новый заказ ожидает проверки**\n\n"
+        admin_message += f"🆔 Заказ: #{order_id}\n"
+        admin_message += f"👤 Пользователь: {message.from_user.username or 'Нет юзернейма'}\n"
+        admin_message += f"🆔 ID: {message.from_user.id}\n"
+        admin_message += f"📦 Тип: {order.order_type}\n"
+        admin_message += f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
+        
+        if order.order_type == "exchange":
+            admin_message += f"💸 К выдаче: {order.payout_usd:.2f} USD\n"
+        else:
+            admin_message += f"👤 Получатель: {order.recipient}\n"
+        
+        admin_message += f"\nДля проверки зайдите в /admin → 📦 Активные заказы"
+        
+        # Обновляем статус, сначала фото, затем детали заказа
+        changed = await db.update_order_status(order_id, "waiting_confirmation", notifications=admin_notifications(
+            ("send_photo", {"photo": photo_file_id, "caption": photo_caption}),
+            ("send_message", {"text": admin_message})
+        ))
+        
+        # Повторное фото к заказу на проверке принимаем, к отмененному или подтвержденному - нет
+        if not changed and (await db.get_order(order_id)).status != "waiting_confirmation":
+            await message.answer(f"❌ Заказ #{order_id} уже обработан или отменен")
+            await show_main_menu(message)
+            return
         
         # Сообщение пользователю
-        if order_type == "exchange":
-            try:
-                details_dict = json.loads(details) if details else {}
-                amount_usd = details_dict.get("amount_usd", amount_rub / USD_RATE)
-                user_message = (
-                    f"✅ Фото оплаты получено!\n"
-                    f"💸 Вы получаете: {amount_usd:.2f} USD\n"
-                    f"💰 Оплачено: {amount_rub:.2f} RUB\n\n"
-                    "Заказ передан админу на проверку.\n"
-                    "После проверки USD будут отправлены вам в течение 15 минут - 3 часа."
-                )
-            except:
-                user_message = (
-                    "✅ Фото оплаты получено! Заказ передан админу на проверку.\n"
-                    "После проверки USD будут отправлены вам в течение 15 минут - 3 часа."
-                )
+        if order.order_type == "exchange":
+            user_message = (
+                f"✅ Фото оплаты получено!\n"
+                f"💸 Вы получаете: {order.payout_usd:.2f} USD\n"
+                f"💰 Оплачено: {order.amount_rub:.2f} RUB\n\n"
+                "Заказ передан админу на проверку.\n"
+                "После проверки USD будут отправлены вам в течение 15 минут - 3 часа."
+            )
         else:
             user_message = (
                 "✅ Фото оплаты получено! Заказ передан админу на проверку.\n"
@@ -1012,24 +2920,28 @@ async def handle_payment_photo(message: types.Message):
         await show_main_menu(message)
 
 # ========== ОПЛАТА КАРТОЙ ==========
-@dp.callback_query(F.data.startswith("card_pay_"))
-async def card_payment_handler(callback: types.CallbackQuery):
-    order_id = int(callback.data.replace("card_pay_", ""))
-    order = db.get_order(order_id)
+@callback_route("card_pay", int, code="cp")
+async def card_payment_handler(callback: types.CallbackQuery, order_id: int):
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id, created_at = order
+    # Оплачивать можно только заказ, который еще ждет оплаты
+    if order.status != "waiting_payment" and not can_change_status(order.status, "waiting_payment"):
+        await callback.answer("❌ Заказ уже оплачен или отменен")
+        return
     
-    # Обновляем статус
-    db.update_order_status(order_id, "waiting_payment")
+    # Повторное нажатие или возврат из cancel_photo: заказ уже ждет оплаты картой, переход не нужен
+    if order.status != "waiting_payment" and not await db.update_order_status(order_id, "waiting_payment"):
+        await callback.answer("❌ Заказ уже оплачен или отменен")
+        return
     
     caption = (
         f"💳 **Оплата картой**\n\n"
         f"🆔 Заказ: #{order_id}\n"
-        f"💰 Сумма: {amount_rub:.2f} RUB\n\n"
+        f"💰 Сумма: {order.amount_rub:.2f} RUB\n\n"
         f"**Реквизиты для перевода:**\n"
         f"`{CARD_NUMBER}`\n\n"
         "**Инструкция:**\n"
@@ -1049,39 +2961,48 @@ async def card_payment_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # ========== ОПЛАТА CRYPTOBOT ==========
-@dp.callback_query(F.data.startswith("crypto_pay_"))
-async def crypto_payment_handler(callback: types.CallbackQuery):
+@callback_route("crypto_pay", int, code="kp")
+async def crypto_payment_handler(callback: types.CallbackQuery, order_id: int):
     if not cryptobot:
         await callback.answer("❌ CryptoBot временно недоступен")
         return
     
-    order_id = int(callback.data.replace("crypto_pay_", ""))
-    order = db.get_order(order_id)
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id, created_at = order
+    # Новый счет - только для заказа, который еще ждет оплаты
+    if order.status != "waiting_crypto" and not can_change_status(order.status, "waiting_crypto"):
+        await callback.answer("❌ Заказ уже оплачен или отменен")
+        return
     
     # Создаем счет в CryptoBot
     result = await cryptobot.create_invoice(
-        amount=amount_rub,
-        description=f"Заказ #{order_id} | {order_type}"
+        amount=order.amount_rub,
+        description=f"Заказ #{order_id} | {order.order_type}"
     )
     
     if result["success"]:
         # Сохраняем invoice_id
-        db.update_invoice_id(order_id, result["invoice_id"])
-        db.update_order_status(order_id, "waiting_crypto")
+        await db.update_invoice_id(order_id, result["invoice_id"])
+        
+        # Пока создавался счет, заказ могли отменить или подтвердить - ссылку на оплату не показываем.
+        # Новая ссылка для заказа, который уже ждет крипты, статус не меняет.
+        status = (await db.get_order(order_id)).status
+        if status != "waiting_crypto" and not await db.update_order_status(order_id, "waiting_crypto"):
+            await callback.answer("❌ Заказ уже оплачен или отменен")
+            return
+        crypto_watch_wakeup.set()
         
         # Рассчитываем USDT сумму
-        amount_usdt = amount_rub / 85.0
+        amount_usdt = order.amount_rub / 85.0
         
         caption = (
             f"💎 **Оплата через CryptoBot**\n\n"
             f"🆔 Заказ: #{order_id}\n"
-            f"💰 Сумма: {amount_rub:.2f} RUB\n"
+            f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
             f"💱 К оплате: {amount_usdt:.2f} USDT\n\n"
             "**Для оплаты:**\n"
             "1. Нажмите кнопку ниже\n"
@@ -1092,8 +3013,8 @@ async def crypto_payment_handler(callback: types.CallbackQuery):
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="💎 Оплатить в CryptoBot", url=result["pay_url"])],
-            [InlineKeyboardButton(text="✅ Проверить оплату", callback_data=f"check_crypto_{order_id}")],
-            [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+            [InlineKeyboardButton(text="✅ Проверить оплату", callback_data=pack_callback("check_crypto", order_id))],
+            [InlineKeyboardButton(text="🔙 Главное меню", callback_data=pack_callback("main_menu"))]
         ])
         
         await callback.message.edit_text(
@@ -1107,77 +3028,49 @@ async def crypto_payment_handler(callback: types.CallbackQuery):
     await callback.answer()
 
 # ========== ПРОВЕРКА CRYPTOBOT ОПЛАТЫ ==========
-@dp.callback_query(F.data.startswith("check_crypto_"))
-async def check_crypto_payment(callback: types.CallbackQuery):
+@callback_route("check_crypto", int, code="kc")
+async def check_crypto_payment(callback: types.CallbackQuery, order_id: int):
     if not cryptobot:
         await callback.answer("❌ CryptoBot временно недоступен")
         return
     
-    order_id = int(callback.data.replace("check_crypto_", ""))
-    order = db.get_order(order_id)
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id, created_at = order
-    
-    if not invoice_id:
+    if not order.invoice_id:
         await callback.answer("❌ Нет invoice_id для проверки")
         return
     
     await callback.answer("🔍 Проверяем оплату...")
     
-    result = await cryptobot.check_invoice_status(invoice_id)
+    result = await cryptobot.check_invoice_status(order.invoice_id)
     
     if result["success"]:
         if result["status"] == "paid":
-            # ОПЛАТА ПРОШЛА!
-            db.update_order_status(order_id, "confirmed")
-            
-            # Уведомляем админа
-            for admin_id in ADMIN_IDS:
-                try:
-                    admin_message = (
-                        f"💎 **CryptoBot оплата ПОДТВЕРЖДЕНА**\n\n"
-                        f"🆔 Заказ: #{order_id}\n"
-                        f"💰 Сумма: {amount_rub:.2f} RUB\n"
-                        f"📦 Тип: {order_type}\n"
-                    )
-                    
-                    if order_type != "exchange":
-                        admin_message += f"👤 Получатель: {recipient}\n"
-                    
-                    admin_message += f"\n✅ Статус: ОПЛАЧЕНО\n"
-                    admin_message += f"👨‍💼 Перейдите в админ панель для выполнения заказа"
-                    
-                    await bot.send_message(admin_id, admin_message)
-                except:
-                    pass
-            
-            # Уведомляем пользователя
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"✅ **Оплата подтверждена!**\n\n"
-                    f"🆔 Ваш заказ: #{order_id}\n"
-                    f"💰 Сумма: {amount_rub:.2f} RUB\n\n"
-                    f"Товар будет отправлен в течение 15 минут - 3 часа!"
-                )
-            except:
-                pass
+            # ОПЛАТА ПРОШЛА! (если заказ уже подтвердил фоновый watcher - повторно не уведомляем)
+            _, order = await settle_paid_crypto_order(order_id)
             
             # Обновляем сообщение
-            caption = (
-                f"💎 **Оплата подтверждена!**\n\n"
-                f"🆔 Заказ: #{order_id}\n"
-                f"💰 Сумма: {amount_rub:.2f} RUB\n"
-                f"✅ Статус: ОПЛАЧЕНО\n\n"
-                f"Админ уведомлен о платеже. Товар будет отправлен в течение 15 минут - 3 часа!"
-            )
+            if order.status in PAID_STATUSES:
+                caption = (
+                    f"💎 **Оплата подтверждена!**\n\n"
+                    f"🆔 Заказ: #{order_id}\n"
+                    f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
+                    f"✅ Статус: ОПЛАЧЕНО\n\n"
+                    f"Админ уведомлен о платеже. Товар будет отправлен в течение 15 минут - 3 часа!"
+                )
+            else:
+                caption = (
+                    f"⚠️ **Оплата получена, но заказ #{order_id} уже отменен**\n\n"
+                    f"💰 Сумма: {order.amount_rub:.2f} RUB\n\n"
+                    f"Админ уведомлен. Обратитесь в поддержку, чтобы получить товар или вернуть деньги."
+                )
             
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+                [InlineKeyboardButton(text="🔙 Главное меню", callback_data=pack_callback("main_menu"))]
             ])
             
             await callback.message.edit_text(
@@ -1193,11 +3086,12 @@ async def check_crypto_payment(callback: types.CallbackQuery):
             )
             
         elif result["status"] == "expired":
-            db.update_order_status(order_id, "cancelled")
-            
-            caption = f"❌ **Счет просрочен!**\n\nЗаказ #{order_id} отменен."
+            if await expire_crypto_order(order_id):
+                caption = f"❌ **Счет просрочен!**\n\nЗаказ #{order_id} отменен."
+            else:
+                caption = f"❌ **Счет просрочен!**\n\nСтатус заказа #{order_id} уже изменен."
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔙 Главное меню", callback_data="main_menu")]
+                [InlineKeyboardButton(text="🔙 Главное меню", callback_data=pack_callback("main_menu"))]
             ])
             
             await callback.message.edit_text(
@@ -1212,67 +3106,276 @@ async def check_crypto_payment(callback: types.CallbackQuery):
             show_alert=True
         )
 
+async def confirm_crypto_order(order_id):
+    """Подтвердить оплаченный CryptoBot заказ и уведомить админов и покупателя"""
+    order = await db.get_order(order_id)
+    
+    if not order or order.status != "waiting_crypto":
+        return False
+    
+    # Уведомляем админа
+    admin_message = (
+        f"💎 **CryptoBot оплата ПОДТВЕРЖДЕНА**\n\n"
+        f"🆔 Заказ: #{order_id}\n"
+        f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
+        f"📦 Тип: {order.order_type}\n"
+    )
+    
+    if order.order_type != "exchange":
+        admin_message += f"👤 Получатель: {order.recipient}\n"
+    
+    admin_message += f"\n✅ Статус: ОПЛАЧЕНО\n"
+    admin_message += f"👨‍💼 Перейдите в админ панель для выполнения заказа"
+    
+    # Уведомляем пользователя
+    user_message = (
+        f"✅ **Оплата подтверждена!**\n\n"
+        f"🆔 Ваш заказ: #{order_id}\n"
+        f"💰 Сумма: {order.amount_rub:.2f} RUB\n\n"
+        f"Товар будет отправлен в течение 15 минут - 3 часа!"
+    )
+    
+    # Кнопка проверки и watcher могут прийти одновременно - уведомит только выигравший переход
+    return await db.update_order_status(
+        order_id, "confirmed",
+        notifications=admin_notifications(("send_message", {"text": admin_message}))
+        + [(order.user_id, "send_message", {"text": user_message})]
+    )
+
+async def settle_paid_crypto_order(order_id):
+    """Счет заказа оплачен: подтвердить заказ. Если заказ уже не ждет оплаты (отменен админом
+    или по сроку), деньги получены без товара - уведомляем админов, чтобы разобрались вручную.
+    Возвращает (подтвержден ли этим вызовом, актуальный заказ)."""
+    if await confirm_crypto_order(order_id):
+        return True, await db.get_order(order_id)
+    
+    order = await db.get_order(order_id)
+    if order and order.status not in PAID_STATUSES:
+        admin_message = (
+            f"⚠️ **Оплата по неактивному заказу**\n\n"
+            f"🆔 Заказ: #{order_id}\n"
+            f"📊 Статус: {order.status}\n"
+            f"💰 Сумма: {order.amount_rub:.2f} RUB\n"
+            f"💎 Счет CryptoBot: {order.invoice_id}\n"
+            f"🆔 ID пользователя: {order.user_id}\n\n"
+            f"Счет оплачен, но заказ уже не ждет оплаты. Выполните заказ вручную или верните деньги."
+        )
+        # Ключ по статусу: повторные нажатия "Проверить оплату" не дублируют уведомление
+        await db.add_notifications(
+            f"order:{order_id}:paid_while_{order.status}", order.user_id,
+            admin_notifications(("send_message", {"text": admin_message}))
+        )
+    return False, order
+
+async def expire_crypto_order(order_id, notify_user=False):
+    """Отменить заказ с просроченным CryptoBot счетом"""
+    order = await db.get_order(order_id)
+    
+    if not order or order.status != "waiting_crypto":
+        return False
+    
+    notifications = []
+    if notify_user:
+        notifications.append((None, "send_message", {
+            "text": f"❌ **Счет просрочен!**\n\nЗаказ #{order_id} отменен."
+        }))
+    
+    return await db.update_order_status(order_id, "cancelled", notifications=notifications)
+
+# ========== ФОНОВАЯ ПРОВЕРКА CRYPTOBOT ==========
+crypto_watch_wakeup = asyncio.Event()
+
+async def poll_crypto_invoices():
+    """Проверить все заказы в статусе waiting_crypto пачками по CRYPTO_WATCH_BATCH.
+    Возвращает (изменилось ли что-то, были ли ошибки)."""
+    orders = await db.get_orders_by_status("waiting_crypto")
+    
+    invoice_orders = {}
+    for order_id, invoice_id in orders:
+        if invoice_id:
+            invoice_orders[str(invoice_id)] = order_id
+    
+    invoice_ids = list(invoice_orders)
+    changed = False
+    failed = False
+    
+    for i in range(0, len(invoice_ids), CRYPTO_WATCH_BATCH):
+        batch = invoice_ids[i:i + CRYPTO_WATCH_BATCH]
+        result = await cryptobot.get_invoices(batch)
+        
+        if not result["success"]:
+            logger.warning(f"CryptoBot watcher: ошибка getInvoices: {result['error']}")
+            failed = True
+            continue
+        
+        for invoice in result["items"]:
+            order_id = invoice_orders.get(str(invoice.get("invoice_id")))
+            if order_id is None:
+                continue
+            
+            if invoice.get("status") == "paid":
+                confirmed, _ = await settle_paid_crypto_order(order_id)
+                changed |= confirmed
+            elif invoice.get("status") == "expired":
+                changed |= await expire_crypto_order(order_id, notify_user=True)
+    
+    return changed, failed
+
+async def crypto_invoice_watcher():
+    """Фоновая задача: подтверждает и отменяет CryptoBot заказы без нажатия кнопки.
+    Интервал сокращается при активности и растет в простое и при ошибках API."""
+    interval = CRYPTO_WATCH_MIN_INTERVAL
+    
+    while True:
+        try:
+            changed, failed = await poll_crypto_invoices()
+        except Exception as e:
+            swallowed_errors.inc("crypto_watcher", type(e).__name__)
+            logger.exception(f"CryptoBot watcher: {e}")
+            changed, failed = False, True
+        
+        if failed:
+            interval = min(interval * 2, CRYPTO_WATCH_MAX_INTERVAL)
+        elif changed:
+            interval = CRYPTO_WATCH_MIN_INTERVAL
+        else:
+            interval = min(interval * 1.5, CRYPTO_WATCH_MAX_INTERVAL)
+        
+        # Новый счет будит watcher раньше срока
+        try:
+            await asyncio.wait_for(crypto_watch_wakeup.wait(), timeout=interval)
+            crypto_watch_wakeup.clear()
+            interval = CRYPTO_WATCH_MIN_INTERVAL
+        except asyncio.TimeoutError:
+            pass
+
+# ========== ОТМЕНА ЗАБРОШЕННЫХ ЗАКАЗОВ ==========
+def expired_order_notifications(order_id):
+    return [(None, "send_message", {"text": (
+        f"⌛ **Заказ #{order_id} отменен**\n\n"
+        f"Оплата не поступила вовремя. Если вы уже оплатили, обратитесь в поддержку."
+    )})]
+
+async def expire_abandoned_orders():
+    """Отменить заказы, которые пролежали в статусах ORDER_TTLS дольше срока.
+    Возвращает {статус: сколько отменено}."""
+    expired = {}
+    for status, (ttl, notify) in ORDER_TTLS.items():
+        notifications = expired_order_notifications if notify else None
+        expired[status] = 0
+        # Пачками, чтобы большой первый проход не держал writer долго
+        while True:
+            batch = await db.expire_orders(status, ttl, notifications)
+            expired[status] += len(batch)
+            if len(batch) < ORDER_SWEEP_BATCH:
+                break
+    return expired
+
+async def order_expiry_sweeper():
+    """Фоновая задача: раз в ORDER_SWEEP_INTERVAL отменяет заброшенные заказы,
+    чтобы список активных заказов и очередь админа не росли бесконечно"""
+    while True:
+        try:
+            expired = await expire_abandoned_orders()
+            for status, count in expired.items():
+                if count:
+                    orders_expired.inc(status, amount=count)
+            if any(expired.values()):
+                logger.info(f"Отменено заброшенных заказов: {expired}")
+        except Exception as e:
+            swallowed_errors.inc("order_sweeper", type(e).__name__)
+            logger.exception(f"Отмена заброшенных заказов: {e}")
+        
+        await asyncio.sleep(ORDER_SWEEP_INTERVAL)
+
+# ========== АРХИВ ЗАКАЗОВ ==========
+async def archive_finished_orders():
+    """Перенести завершенные заказы старше ORDER_ARCHIVE_DAYS в orders_archive и вернуть
+    освободившееся место. Пачки по ORDER_ARCHIVE_BATCH - отдельные транзакции, между ними
+    проходят остальные записи бота. Возвращает число перенесенных заказов."""
+    archived = 0
+    while True:
+        moved = await db.archive_orders(ORDER_ARCHIVE_DAYS * 86400, ORDER_ARCHIVE_BATCH)
+        archived += moved
+        if moved < ORDER_ARCHIVE_BATCH:
+            break
+    
+    # Шагами по DB_VACUUM_PAGES, пока шаг освобождает полную порцию
+    if archived:
+        while await db.incremental_vacuum(DB_VACUUM_PAGES) == DB_VACUUM_PAGES:
+            pass
+    return archived
+
+async def order_archiver():
+    """Фоновая задача: раз в ORDER_ARCHIVE_INTERVAL переносит завершенные заказы в архив,
+    чтобы запросы к orders работали с небольшой таблицей"""
+    while True:
+        try:
+            archived = await archive_finished_orders()
+            if archived:
+                orders_archived.inc(amount=archived)
+                logger.info(f"Перенесено в архив заказов: {archived}")
+        except Exception as e:
+            swallowed_errors.inc("order_archiver", type(e).__name__)
+            logger.exception(f"Архив заказов: {e}")
+        
+        await asyncio.sleep(ORDER_ARCHIVE_INTERVAL)
+
 # ========== ПОДТВЕРЖДЕНИЕ ОПЛАТЫ КАРТОЙ ==========
-@dp.callback_query(F.data.startswith("confirm_paid_"))
-async def confirm_card_payment(callback: types.CallbackQuery):
-    order_id = int(callback.data.replace("confirm_paid_", ""))
-    order = db.get_order(order_id)
+@callback_route("confirm_paid", int, code="pd")
+async def confirm_card_payment(callback: types.CallbackQuery, order_id: int, state: FSMContext):
+    order = await db.get_order(order_id)
     
     if not order:
         await callback.answer("❌ Заказ не найден")
         return
     
-    user_id, order_type, recipient, details, amount_rub, payment_method, status, invoice_id, created_at = order
-    
     # Добавляем ожидание фото
-    user_states[callback.from_user.id] = {
+    await state.set_data({
         "action": "waiting_payment_photo",
         "order_id": order_id
-    }
+    })
     
     await callback.message.edit_text(
         f"📸 **Пришлите фото/скриншот оплаты**\n\n"
         f"🆔 Заказ: #{order_id}\n"
-        f"💰 Сумма: {amount_rub:.2f} RUB\n\n"
+        f"💰 Сумма: {order.amount_rub:.2f} RUB\n\n"
         "Пожалуйста, отправьте скриншот перевода.\n"
         "После отправки фото заказ будет передан админу на проверку.",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"cancel_photo_{order_id}")]
+            [InlineKeyboardButton(text="🔙 Отмена", callback_data=pack_callback("cancel_photo", order_id))]
         ])
     )
     
     await callback.answer()
 
 # Отмена отправки фото
-@dp.callback_query(F.data.startswith("cancel_photo_"))
-async def cancel_photo_handler(callback: types.CallbackQuery):
-    order_id = int(callback.data.replace("cancel_photo_", ""))
-    
-    if callback.from_user.id in user_states:
-        del user_states[callback.from_user.id]
+@callback_route("cancel_photo", int, code="xp")
+async def cancel_photo_handler(callback: types.CallbackQuery, order_id: int, state: FSMContext):
+    await state.clear()
     
-    await card_payment_handler(callback)
+    await card_payment_handler(callback, order_id)
 
 # ========== ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ ==========
 @dp.message(F.text)
-async def handle_text_messages(message: types.Message):
+async def handle_text_messages(message: types.Message, state: FSMContext):
     if message.text.startswith('/'):
         return
     
     user_id = message.from_user.id
+    state_data = await state.get_data()
     
-    if user_id in user_states and user_states[user_id].get("action") == "waiting_payment_photo":
+    if state_data.get("action") == "waiting_payment_photo":
         await message.answer("📸 Пожалуйста, отправьте фото/скриншот оплаты")
         return
     
     text = message.text.strip()
     
-    if user_id not in user_states:
+    if not state_data:
         await message.answer("Используйте меню", reply_markup=main_menu_kb())
         return
     
-    state = user_states[user_id]
-    action = state.get("action")
+    action = state_data.get("action")
     
     if action == "waiting_stars_recipient":
         recipient = text.strip()
@@ -1284,8 +3387,7 @@ async def handle_text_messages(message: types.Message):
             await message.answer("❌ Введите username получателя (можно с @)")
             return
         
-        state["recipient"] = recipient
-        state["action"] = "waiting_stars_amount"
+        await state.update_data(recipient=recipient, action="waiting_stars_amount")
         
         await message.answer(
             f"✅ Получатель: @{recipient}\n\n"
@@ -1301,26 +3403,24 @@ async def handle_text_messages(message: types.Message):
                 return
             
             amount_rub = stars * STAR_RATE
-            recipient = state.get("recipient", "")
+            recipient = state_data.get("recipient", "")
             
-            state["stars_amount"] = stars
-            state["amount_rub"] = amount_rub
+            await state.update_data(stars_amount=stars, amount_rub=amount_rub)
             
             # Создаем заказ
-            order_id = db.add_order(
-                user_id, "stars", recipient, 
-                json.dumps({"stars": stars}), 
-                amount_rub, "card"
+            order_id = await db.add_order(
+                user_id, "stars", recipient, amount_rub, "card",
+                stars=stars
             )
             
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💳 Перевод на карту", callback_data=f"card_pay_{order_id}")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="buy_stars")]
+                [InlineKeyboardButton(text="💳 Перевод на карту", callback_data=pack_callback("card_pay", order_id))],
+                [InlineKeyboardButton(text="🔙 Назад", callback_data=pack_callback("buy_stars"))]
             ])
             
             if cryptobot:
                 keyboard.inline_keyboard.insert(0, [
-                    InlineKeyboardButton(text="💎 CryptoBot", callback_data=f"crypto_pay_{order_id}")
+                    InlineKeyboardButton(text="💎 CryptoBot", callback_data=pack_callback("crypto_pay", order_id))
                 ])
             
             await message.answer(
@@ -1339,26 +3439,25 @@ async def handle_text_messages(message: types.Message):
         if recipient.startswith('@'):
             recipient = recipient[1:]
             
-        period = state.get("period")
-        amount_rub = state.get("amount_rub")
+        period = state_data.get("period")
+        amount_rub = state_data.get("amount_rub")
         
         if period and amount_rub:
-            state["recipient"] = recipient
+            await state.update_data(recipient=recipient)
             
-            order_id = db.add_order(
-                user_id, "premium", recipient,
-                json.dumps({"period": period}),
-                amount_rub, "card"
+            order_id = await db.add_order(
+                user_id, "premium", recipient, amount_rub, "card",
+                period=period
             )
             
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💳 Перевод на карту", callback_data=f"card_pay_{order_id}")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="buy_premium")]
+                [InlineKeyboardButton(text="💳 Перевод на карту", callback_data=pack_callback("card_pay", order_id))],
+                [InlineKeyboardButton(text="🔙 Назад", callback_data=pack_callback("buy_premium"))]
             ])
             
             if cryptobot:
                 keyboard.inline_keyboard.insert(0, [
-                    InlineKeyboardButton(text="💎 CryptoBot", callback_data=f"crypto_pay_{order_id}")
+                    InlineKeyboardButton(text="💎 CryptoBot", callback_data=pack_callback("crypto_pay", order_id))
                 ])
             
             await message.answer(
@@ -1377,19 +3476,14 @@ async def handle_text_messages(message: types.Message):
             
             amount_usd = amount_rub / USD_RATE
             
-            order_id = db.add_order(
-                user_id, "exchange", "",
-                json.dumps({
-                    "amount_rub": amount_rub, 
-                    "amount_usd": amount_usd,
-                    "exchange_rate": USD_RATE
-                }),
-                amount_rub, "card"
+            order_id = await db.add_order(
+                user_id, "exchange", "", amount_rub, "card",
+                amount_usd=amount_usd, exchange_rate=USD_RATE
             )
             
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💳 Оплатить картой", callback_data=f"card_pay_{order_id}")],
-                [InlineKeyboardButton(text="🔙 Назад", callback_data="exchange")]
+                [InlineKeyboardButton(text="💳 Оплатить картой", callback_data=pack_callback("card_pay", order_id))],
+                [InlineKeyboardButton(text="🔙 Назад", callback_data=pack_callback("exchange"))]
             ])
             
             await message.answer(
@@ -1406,6 +3500,79 @@ async def handle_text_messages(message: types.Message):
             await message.answer("❌ Пожалуйста, введите число")
 
 # ========== ЗАПУСК БОТА ==========
+def create_webhook_app():
+    """aiohttp приложение, которое принимает обновления Telegram и передает их в dp"""
+    app = web.Application()
+    
+    # Telegram получает 200 сразу, хендлеры выполняются в фоне параллельно
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None,
+        handle_in_background=True
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    
+    return app
+
+async def metrics_handler(request):
+    """GET /metrics: размеры очереди заказов и outbox читаются из БД в момент запроса"""
+    statuses, pending = await db.get_backlog()
+    for status, orders in statuses:
+        active_orders.set(orders, status)
+    outbox_pending.set(pending)
+    
+    return web.Response(
+        body=render_metrics().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+async def ready_handler(request):
+    """GET /ready: 503, пока watchdog не запущен или event loop недавно простаивал дольше LOOP_READY_MAX_LAG"""
+    lag = loop_watchdog.recent_max_lag()
+    if lag is None:
+        return web.Response(status=503, text="loop watchdog not running\n")
+    if lag > LOOP_READY_MAX_LAG:
+        return web.Response(status=503, text=f"event loop lag {lag:.3f}s\n")
+    return web.Response(text=f"ok, event loop lag {lag:.3f}s\n")
+
+async def start_metrics_server():
+    """Отдельный локальный HTTP сервер для /metrics и /ready, работает в любом режиме обновлений"""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/ready", ready_handler)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+async def run_webhook():
+    """Webhook режим: веб-сервер + регистрация webhook в Telegram"""
+    runner = web.AppRunner(create_webhook_app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    print(f"🌐 Webhook сервер: {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    # Без WEBHOOK_URL сервер работает локально (например, для POST записанных обновлений)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+    
+    try:
+        await asyncio.Event().wait()
+    finally:
+        if WEBHOOK_URL:
+            try:
+                await bot.delete_webhook()
+            except Exception as e:
+                print(f"❌ Не удалось удалить webhook: {e}")
+        await runner.cleanup()
+
 async def main():
     print("=" * 50)
     print("🚀 Digi Store Bot запускается...")
@@ -1420,6 +3587,7 @@ async def main():
     print(f"👑 Админ ID: {ADMIN_IDS}")
     print(f"💎 CryptoBot: {'✅ Настроен' if CRYPTOBOT_TOKEN else '❌ Нет токена'}")
     print(f"💳 Карта: {CARD_NUMBER}")
+    print(f"📡 Обновления: {UPDATES_MODE}")
     print("=" * 50)
     print("✅ Админ панель упрощена:")
     print("👉 /admin - админ панель (2 кнопки)")
@@ -1429,12 +3597,44 @@ async def main():
     print("📸 Админ видит фото оплаты при управлении заказом!")
     print("=" * 50)
     
+    background_tasks = []
+    
+    background_tasks.append(asyncio.create_task(fsm_storage.maintain()))
+    background_tasks.append(asyncio.create_task(user_buffer.maintain()))
+    background_tasks.append(asyncio.create_task(outbox_drainer()))
+    background_tasks.append(asyncio.create_task(order_expiry_sweeper()))
+    if ORDER_ARCHIVE_DAYS:
+        background_tasks.append(asyncio.create_task(order_archiver()))
+    background_tasks.append(asyncio.create_task(loop_watchdog.run()))
+    
+    if cryptobot:
+        await cryptobot.start()
+        background_tasks.append(asyncio.create_task(crypto_invoice_watcher()))
+    
+    metrics_runner = await start_metrics_server() if METRICS_PORT else None
+    
     try:
-        await dp.start_polling(bot)
+        if UPDATES_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
     except Exception as e:
         print(f"❌ Ошибка: {e}")
     finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        
+        if cryptobot:
+            await cryptobot.close()
         await bot.session.close()
+        await fsm_storage.close()
+        await user_buffer.close()
+        if update_recorder:
+            update_recorder.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
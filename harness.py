@@ -0,0 +1,119 @@
+"""Общая обвязка бенчмарков, replay.py и тестов: временная база и бот без сети.
+
+geiu создает бота и базу при импорте, поэтому prepare() вызывается до import geiu:
+база создается во временной папке, а не поверх digistore.db. install_fakes() после
+импорта подменяет сессию бота и CryptoBot - ни один запрос не уходит в сеть.
+
+    import harness
+    TMP_DIR = harness.prepare("bench_handlers_")
+    import geiu
+    bot, session, cryptobot = harness.install_fakes()
+"""
+import itertools
+import os
+import shutil
+import tempfile
+from collections import Counter
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, GetMe, SendMessage, SendPhoto
+from aiogram.types import Chat, Message, User
+
+BOT_TOKEN = "42:OFFLINE"
+
+
+def prepare(prefix, db_name="bench.db", source=None):
+    """Временная папка под базу geiu (с копией source, если задан). Вызывать до import geiu.
+    Возвращает путь к папке."""
+    tmp_dir = tempfile.mkdtemp(prefix=prefix)
+    os.environ.setdefault("BOT_TOKEN", BOT_TOKEN)
+    os.environ["DB_PATH"] = os.path.join(tmp_dir, db_name)
+    if source:
+        shutil.copyfile(source, os.environ["DB_PATH"])
+    return tmp_dir
+
+
+def cleanup(tmp_dir):
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class FakeSession(BaseSession):
+    """Сессия без сети: считает вызовы Bot API по методам и запоминает последнюю клавиатуру в чате"""
+
+    def __init__(self, keep_keyboards=True):
+        super().__init__()
+        self.calls = Counter()
+        self.keyboards = {} if keep_keyboards else None
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+
+        if isinstance(method, (SendMessage, SendPhoto, EditMessageText)):
+            chat_id = method.chat_id or 0
+            if self.keyboards is not None and method.reply_markup is not None:
+                self.keyboards[chat_id] = method.reply_markup
+            return Message(
+                message_id=next(self._message_ids), date=datetime.now(),
+                chat=Chat(id=chat_id, type="private"), text=getattr(method, "text", None)
+            )
+        if isinstance(method, GetMe):
+            return User(id=bot.id, is_bot=True, first_name="offline")
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class FakeCryptoBot:
+    """CryptoBot без сети: счета остаются неоплаченными, пока не вызван pay()"""
+
+    def __init__(self):
+        self.invoices = {}
+        self.next_id = itertools.count(1)
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def pay(self, invoice_id):
+        self.invoices[str(invoice_id)] = "paid"
+
+    def _status(self, invoice_id):
+        # Счета из скопированной базы (replay.py --db) этот клиент не создавал
+        return self.invoices.get(str(invoice_id), "active")
+
+    async def create_invoice(self, amount, description="", timeout=None):
+        invoice_id = next(self.next_id)
+        self.invoices[str(invoice_id)] = "active"
+        return {"success": True, "invoice_id": invoice_id, "pay_url": f"https://t.me/CryptoBot?start=IV{invoice_id}",
+                "amount": f"{amount / 85:.2f}", "asset": "USDT"}
+
+    async def check_invoice_status(self, invoice_id, timeout=None):
+        return {"success": True, "status": self._status(invoice_id), "paid_at": None, "amount": "1"}
+
+    async def get_invoices(self, invoice_ids, timeout=None):
+        return {"success": True, "items": [
+            {"invoice_id": int(invoice_id), "status": self._status(invoice_id)} for invoice_id in invoice_ids
+        ]}
+
+
+def install_fakes(keep_keyboards=True):
+    """Подменить в geiu бота и CryptoBot фейковыми, уведомления - без лимитов Telegram.
+    Возвращает (bot, session, cryptobot)."""
+    import geiu
+
+    session = FakeSession(keep_keyboards)
+    bot = Bot(geiu.BOT_TOKEN, session=session)
+    cryptobot = FakeCryptoBot()
+    geiu.bot = bot
+    geiu.cryptobot = cryptobot
+    geiu.notifier = geiu.Notifier(rate=10 ** 6, chat_interval=0)
+    return bot, session, cryptobot
@@ -0,0 +1,567 @@
+"""Нагрузочный тест бота целиком, без сети.
+
+Поднимает локальные заглушки Telegram Bot API (getUpdates, sendMessage, editMessageText,
+sendPhoto, answerCallbackQuery) и CryptoBot API (createInvoice, getInvoices) с настраиваемой
+задержкой и ошибками, запускает geiu.py отдельным процессом с TELEGRAM_API_URL и
+CRYPTOBOT_API_URL на эти заглушки и гоняет через него N покупателей и M админов по
+настоящим сценариям: звезды и обмен с оплатой картой и фото, премиум через CryptoBot,
+подтверждение и выдача заказов админами.
+
+Нагрузка растет ступенями (--stages), для каждой печатается пропускная способность,
+задержка ответа p50/p95/p99 и таймауты, в конце - точка насыщения.
+
+    python loadtest.py --stages 5,10,20,40,80 --stage-seconds 20 --admins 2
+    python loadtest.py --tg-latency 50 --tg-errors 0.02 --crypto-errors 0.05
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from aiohttp import ClientSession, web
+
+BOT_TOKEN = "42:LOADTEST"
+BOT_ID = 42
+CUSTOMER_IDS = itertools.count(100_001)
+ADMIN_BASE_ID = 900_001
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class Fault:
+    """Задержка и ошибки заглушки: latency - средняя задержка в секундах, errors - доля ответов 5xx"""
+
+    def __init__(self, latency, errors):
+        self.latency = latency
+        self.errors = errors
+
+    async def apply(self):
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        return random.random() < self.errors
+
+
+# ========== ЗАГЛУШКА TELEGRAM BOT API ==========
+class TelegramStandIn:
+    """Bot API для одного бота: апдейты отдаются через long polling getUpdates,
+    исходящие вызовы бота пересылаются виртуальным пользователям по chat_id"""
+
+    def __init__(self, fault, flood_rate=0.0):
+        self.fault = fault
+        self.flood_rate = flood_rate
+        self.updates = []
+        self.new_updates = asyncio.Event()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.users = {}  # chat_id -> VirtualUser
+        self.callbacks = {}  # callback_query_id -> VirtualUser
+        self.calls = Counter()
+        self.injected = Counter()
+        self.polling = asyncio.Event()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    def push(self, kind, payload):
+        update_id = next(self.update_ids)
+        self.updates.append({"update_id": update_id, kind: payload})
+        self.new_updates.set()
+        return update_id
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        try:
+            params = dict(await request.post())
+        except ConnectionResetError:
+            # Бот оборвал запрос на остановке - отвечать некому
+            return web.Response(status=499)
+        params.update(request.query)
+        self.calls[method] += 1
+
+        if method == "getUpdates":
+            return await self.get_updates(params)
+
+        failed = await self.fault.apply()
+        if failed:
+            self.injected["5xx"] += 1
+            return web.json_response({"ok": False, "error_code": 502, "description": "Bad Gateway"}, status=502)
+        if self.flood_rate and random.random() < self.flood_rate:
+            self.injected["429"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1}
+            }, status=429)
+
+        if method == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+        elif method in ("sendMessage", "sendPhoto", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            result = {
+                "message_id": int(params.get("message_id") or next(self.message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text") or params.get("caption") or ""
+            }
+            user = self.users.get(chat_id)
+            if user:
+                user.receive(method, params)
+        elif method == "answerCallbackQuery":
+            result = True
+            user = self.callbacks.pop(params.get("callback_query_id"), None)
+            if user:
+                user.receive(method, params)
+        else:
+            # deleteWebhook, setMyCommands и прочее, что не влияет на сценарии
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def get_updates(self, params):
+        self.polling.set()
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+
+        if offset:
+            self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        return web.json_response({"ok": True, "result": self.updates[:limit]})
+
+
+# ========== ЗАГЛУШКА CRYPTOBOT ==========
+class CryptoBotStandIn:
+    """Crypto Pay API: счета создаются активными, оплачиваются вызовом pay()"""
+
+    def __init__(self, fault):
+        self.fault = fault
+        self.invoices = {}
+        self.invoice_ids = itertools.count(1)
+        self.calls = Counter()
+        self.injected = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/api/createInvoice", self.create_invoice)
+        app.router.add_get("/api/getInvoices", self.get_invoices)
+        return app
+
+    def pay(self, invoice_id):
+        if invoice_id in self.invoices:
+            self.invoices[invoice_id]["status"] = "paid"
+            self.invoices[invoice_id]["paid_at"] = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+
+    async def _fail(self, method):
+        self.calls[method] += 1
+        if await self.fault.apply():
+            self.injected += 1
+            return web.json_response({"ok": False, "error": {"code": 500, "name": "INTERNAL_ERROR"}}, status=500)
+
+    async def create_invoice(self, request):
+        failed = await self._fail("createInvoice")
+        if failed:
+            return failed
+
+        data = await request.json()
+        invoice_id = next(self.invoice_ids)
+        self.invoices[invoice_id] = {
+            "invoice_id": invoice_id,
+            "status": "active",
+            "asset": data.get("asset", "USDT"),
+            "amount": data.get("amount", "0"),
+            "pay_url": f"https://t.me/CryptoBot?start=IV{invoice_id}",
+            "paid_at": None
+        }
+        return web.json_response({"ok": True, "result": self.invoices[invoice_id]})
+
+    async def get_invoices(self, request):
+        failed = await self._fail("getInvoices")
+        if failed:
+            return failed
+
+        ids = [int(invoice_id) for invoice_id in request.query.get("invoice_ids", "").split(",") if invoice_id]
+        items = [self.invoices[invoice_id] for invoice_id in ids if invoice_id in self.invoices]
+        return web.json_response({"ok": True, "result": {"items": items}})
+
+
+# ========== ВИРТУАЛЬНЫЕ ПОЛЬЗОВАТЕЛИ ==========
+class Stats:
+    """Задержки ответов бота (время, задержка) и таймауты"""
+
+    def __init__(self):
+        self.samples = []
+        self.timeouts = []
+        self.flows = Counter()
+
+    def window(self, started, finished):
+        latencies = [latency for at, latency in self.samples if started <= at < finished]
+        timeouts = sum(1 for at in self.timeouts if started <= at < finished)
+        return latencies, timeouts
+
+
+class NoResponse(Exception):
+    pass
+
+
+class VirtualUser:
+    """Пользователь Telegram: шлет апдейт и ждет ответа бота в своем чате.
+    Ответом считается первое сообщение с клавиатурой или answerCallbackQuery на это нажатие.
+    Правки принимаются только для сообщения текущего нажатия: запоздавшая правка
+    от прошлого шага не должна сойти за ответ на следующий."""
+
+    def __init__(self, tg, stats, user_id, timeout, think):
+        self.tg = tg
+        self.stats = stats
+        self.user_id = user_id
+        self.timeout = timeout
+        self.think = think
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+        self.keyboard = []
+        self.responses = asyncio.Queue()
+        self.callback_id = None
+        self.callback_message_id = None
+        tg.users[user_id] = self
+
+    def receive(self, method, params):
+        if method == "answerCallbackQuery":
+            if params.get("callback_query_id") == self.callback_id:
+                self.responses.put_nowait(None)
+        elif method == "editMessageText" and int(params.get("message_id") or 0) != self.callback_message_id:
+            return
+        elif params.get("reply_markup"):
+            self.responses.put_nowait(json.loads(params["reply_markup"]).get("inline_keyboard", []))
+
+    async def _exchange(self, kind, payload, want_keyboard):
+        while not self.responses.empty():
+            self.responses.get_nowait()
+
+        started = time.monotonic()
+        self.tg.push(kind, payload)
+
+        deadline = started + self.timeout
+        first = True
+        while True:
+            try:
+                keyboard = await asyncio.wait_for(self.responses.get(), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                self.stats.timeouts.append(time.monotonic())
+                raise NoResponse(kind)
+
+            if first:
+                self.stats.samples.append((time.monotonic(), time.monotonic() - started))
+                first = False
+            if keyboard is not None:
+                self.keyboard = keyboard
+                break
+            if not want_keyboard:
+                break
+
+        if self.think:
+            await asyncio.sleep(random.expovariate(1 / self.think))
+
+    def _message(self, **fields):
+        return {"message_id": next(self.tg.message_ids), "date": int(time.time()),
+                "chat": self.chat, "from": self.user, **fields}
+
+    async def send(self, text, want_keyboard=True):
+        self.callback_message_id = None
+        await self._exchange("message", self._message(text=text), want_keyboard)
+
+    async def send_photo(self):
+        self.callback_message_id = None
+        photo = [{"file_id": f"PHOTO{self.user_id}", "file_unique_id": f"u{self.user_id}", "width": 1, "height": 1}]
+        await self._exchange("message", self._message(photo=photo), True)
+
+    async def click(self, data, want_keyboard=True):
+        self.callback_id = str(next(self.tg.message_ids))
+        self.tg.callbacks[self.callback_id] = self
+        message = self._message(text="...")
+        self.callback_message_id = message["message_id"]
+        payload = {"id": self.callback_id, "from": self.user, "chat_instance": str(self.user_id),
+                   "message": message, "data": data}
+        await self._exchange("callback_query", payload, want_keyboard)
+
+    def button(self, label, field="callback_data"):
+        """Кнопка последней клавиатуры: сначала точное совпадение текста, затем по вхождению"""
+        buttons = [button for row in self.keyboard for button in row if field in button]
+        for button in buttons:
+            if button["text"] == label:
+                return button[field]
+        for button in buttons:
+            if label in button["text"]:
+                return button[field]
+        return None
+
+    async def press(self, label, want_keyboard=True):
+        data = self.button(label)
+        if data is None:
+            raise LookupError(label)
+        await self.click(data, want_keyboard)
+
+
+async def customer(tg, crypto, stats, args, stop):
+    """Покупатель: проходит случайные сценарии покупки, пока не выставлен stop"""
+    user = VirtualUser(tg, stats, next(CUSTOMER_IDS), args.timeout, args.think / 1000)
+
+    while not stop.is_set():
+        flow = random.choices(["stars", "premium", "exchange"], weights=[5, 3, 2])[0]
+        try:
+            await user.send("/start")
+            if flow == "stars":
+                await user.press("Купить звезды")
+                await user.send(f"@friend{user.user_id}")
+                await user.send(str(random.randint(50, 5000)))
+                await user.press("Перевод на карту")
+                await user.press("Я оплатил")
+                await user.send_photo()
+            elif flow == "premium":
+                await user.press("Купить премиум")
+                await user.press(random.choice(["3 месяца", "6 месяцев", "1 год"]))
+                await user.send(f"@friend{user.user_id}")
+                await user.press("CryptoBot")
+                pay_url = user.button("Оплатить в CryptoBot", field="url")
+                # Часть покупателей не платит - такие счета отменяет фоновый watcher
+                if pay_url and random.random() < 0.8:
+                    crypto.pay(int(re.findall(r"\d+", pay_url)[-1]))
+                await user.press("Проверить оплату", want_keyboard=False)
+            else:
+                await user.press("Обмен валют")
+                await user.send(str(random.randint(100, 10000)))
+                await user.press("Оплатить картой")
+                await user.press("Я оплатил")
+                await user.send_photo()
+            stats.flows[flow] += 1
+        except (NoResponse, LookupError):
+            stats.flows[f"{flow}: сбой"] += 1
+
+
+async def admin(tg, stats, args, admin_id, stop):
+    """Админ: по очереди подтверждает заказы на проверке и выдает подтвержденные, пока не выставлен stop"""
+    user = VirtualUser(tg, stats, admin_id, args.timeout, args.think / 1000)
+
+    while not stop.is_set():
+        worked = False
+        try:
+            await user.send("/admin")
+            await user.press("Активные заказы")
+
+            await user.press("📸")
+            if user.button("Управление заказом"):
+                await user.press("Управление заказом")
+                await user.press("Подтвердить оплату")
+                await user.press("ДА, я всё проверил")
+                stats.flows["админ: подтвердил"] += 1
+                worked = True
+
+            await user.press("✅")
+            if user.button("Управление заказом"):
+                await user.press("Управление заказом")
+                await user.press("Я передал товар")
+                await user.press("ДА, товар передан")
+                stats.flows["админ: выдал"] += 1
+                worked = True
+        except (NoResponse, LookupError):
+            stats.flows["админ: сбой"] += 1
+
+        if not worked:
+            await asyncio.sleep(1)
+
+
+# ========== ЗАПУСК ==========
+async def start_site(app):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def spawn_bot(tg_url, crypto_url, admin_ids, tmp_dir, metrics_port):
+    env = dict(
+        os.environ,
+        BOT_TOKEN=BOT_TOKEN,
+        TELEGRAM_API_URL=tg_url,
+        CRYPTOBOT_TOKEN="loadtest",
+        CRYPTOBOT_API_URL=f"{crypto_url}/api",
+        DB_PATH=os.path.join(tmp_dir, "loadtest.db"),
+        ADMIN_IDS=",".join(str(admin_id) for admin_id in admin_ids),
+        UPDATES_MODE="polling",
+        METRICS_PORT=str(metrics_port),
+    )
+    log = open(os.path.join(tmp_dir, "bot.log"), "wb")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "geiu.py")
+    return await asyncio.create_subprocess_exec(
+        sys.executable, script, env=env, stdout=log, stderr=asyncio.subprocess.STDOUT
+    )
+
+
+async def wait_bot_idle(tg, metrics_url, timeout=15):
+    """Дождаться, пока бот заберет все апдейты и доработает их: bot_update_lock_keys на /metrics
+    считает апдейты в обработке и в очереди. aiogram на остановке закрывает сессию, не дожидаясь
+    обработчиков, - без этого их ответы обрываются."""
+    deadline = time.monotonic() + timeout
+    async with ClientSession() as session:
+        while time.monotonic() < deadline:
+            if not tg.updates:
+                try:
+                    async with session.get(metrics_url) as response:
+                        text = await response.text()
+                except OSError:
+                    return False
+                match = re.search(r"^bot_update_lock_keys (\S+)$", text, re.MULTILINE)
+                if match and float(match.group(1)) == 0:
+                    return True
+            await asyncio.sleep(0.1)
+    return False
+
+
+async def run(args):
+    random.seed(args.seed)
+    tmp_dir = tempfile.mkdtemp(prefix="loadtest_")
+
+    tg = TelegramStandIn(Fault(args.tg_latency / 1000, args.tg_errors), args.tg_flood)
+    crypto = CryptoBotStandIn(Fault(args.crypto_latency / 1000, args.crypto_errors))
+    tg_runner, tg_url = await start_site(tg.app())
+    crypto_runner, crypto_url = await start_site(crypto.app())
+
+    admin_ids = [ADMIN_BASE_ID + number for number in range(args.admins)]
+    if args.no_spawn:
+        process = None
+        print("Запустите бота с окружением:")
+        print(f"  BOT_TOKEN={BOT_TOKEN} TELEGRAM_API_URL={tg_url} CRYPTOBOT_TOKEN=loadtest "
+              f"CRYPTOBOT_API_URL={crypto_url}/api ADMIN_IDS={','.join(map(str, admin_ids))}")
+    else:
+        metrics_port = free_port()
+        process = await spawn_bot(tg_url, crypto_url, admin_ids, tmp_dir, metrics_port)
+        print(f"Бот запущен (pid {process.pid}), лог: {os.path.join(tmp_dir, 'bot.log')}")
+
+    stats = Stats()
+    stop = asyncio.Event()
+    tasks = []
+    results = []
+    try:
+        await asyncio.wait_for(tg.polling.wait(), timeout=None if args.no_spawn else 60)
+
+        for admin_id in admin_ids:
+            tasks.append(asyncio.create_task(admin(tg, stats, args, admin_id, stop)))
+
+        print(f"\n{'клиентов':>8} {'апд/с':>8} {'ответов/с':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'таймауты':>9}")
+        saturation = None
+        best_rate = 0
+        for target in args.stages:
+            while len(tasks) - len(admin_ids) < target:
+                tasks.append(asyncio.create_task(customer(tg, crypto, stats, args, stop)))
+
+            # Первые секунды ступени - разгон, в замер не идут
+            await asyncio.sleep(min(2, args.stage_seconds / 4))
+            first_update = next(tg.update_ids)
+            started = time.monotonic()
+            await asyncio.sleep(args.stage_seconds)
+            finished = time.monotonic()
+            updates = next(tg.update_ids) - first_update
+
+            latencies, timeouts = stats.window(started, finished)
+            duration = finished - started
+            rate = len(latencies) / duration
+            p95 = percentile(latencies, 95) * 1000
+            results.append((target, rate, p95))
+            print(f"{target:>8} {updates / duration:>8.1f} {rate:>10.1f} {percentile(latencies, 50) * 1000:>8.1f} "
+                  f"{p95:>8.1f} {percentile(latencies, 99) * 1000:>8.1f} {timeouts:>9}")
+
+            # Насыщение: больше клиентов почти не добавляет ответов в секунду или хвост вышел за SLO
+            if saturation is None and (rate < best_rate * 1.1 or p95 > args.slo_ms or timeouts):
+                saturation = target
+            best_rate = max(best_rate, rate)
+
+        print()
+        if saturation is None:
+            print(f"Насыщение не достигнуто: {best_rate:.1f} ответов/с на {args.stages[-1]} клиентах")
+        else:
+            print(f"Точка насыщения: ~{saturation} клиентов, максимум {best_rate:.1f} ответов/с "
+                  f"(SLO p95 {args.slo_ms:.0f} ms)")
+        print(f"Сценарии: {dict(stats.flows)}")
+        print(f"Bot API: {dict(tg.calls)}, внесено ошибок: {dict(tg.injected)}")
+        print(f"CryptoBot: {dict(crypto.calls)}, внесено ошибок: {crypto.injected}")
+    finally:
+        # Одной отмены мало: wait_for в Python 3.11 может проглотить отмену, пришедшую вместе
+        # с таймаутом ответа, - тогда сценарий ловит NoResponse и идет на следующий круг
+        stop.set()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if process and process.returncode is None:
+            # Сначала бот дорабатывает уже полученные апдейты, затем SIGINT - он штатно
+            # сбрасывает буферы и закрывает базу. Заглушки останавливаются только после выхода бота.
+            await wait_bot_idle(tg, f"http://127.0.0.1:{metrics_port}/metrics")
+            process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(process.wait(), 15)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+
+        await tg_runner.cleanup()
+        await crypto_runner.cleanup()
+        if not args.keep:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", type=lambda value: [int(n) for n in value.split(",")], default=[5, 10, 20, 40, 80],
+                        help="число одновременных покупателей на каждой ступени")
+    parser.add_argument("--stage-seconds", type=float, default=20)
+    parser.add_argument("--admins", type=int, default=2)
+    parser.add_argument("--think", type=float, default=0, help="средняя пауза покупателя между шагами, ms")
+    parser.add_argument("--timeout", type=float, default=15, help="сколько ждать ответа бота, s")
+    parser.add_argument("--slo-ms", type=float, default=1000, help="допустимая p95 задержка ответа")
+    parser.add_argument("--tg-latency", type=float, default=0, help="средняя задержка Bot API, ms")
+    parser.add_argument("--tg-errors", type=float, default=0, help="доля ответов Bot API с 502")
+    parser.add_argument("--tg-flood", type=float, default=0, help="доля ответов Bot API с 429 retry_after")
+    parser.add_argument("--crypto-latency", type=float, default=0, help="средняя задержка CryptoBot, ms")
+    parser.add_argument("--crypto-errors", type=float, default=0, help="доля ответов CryptoBot с 500")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-spawn", action="store_true", help="не запускать бота, только заглушки")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную папку с базой и логом")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
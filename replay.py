@@ -0,0 +1,175 @@
+"""Повтор записанных апдейтов (UPDATE_LOG_DIR) через бота на временной базе.
+
+Читает updates-*.jsonl.gz, импортирует geiu с пустой временной базой (или копией
+--db), подменяет сессию бота на фейковую - ни одно сообщение не уходит в Telegram -
+и CryptoBot на фейковый клиент, затем подает апдейты в dp.feed_update с исходными
+интервалами: --speed 1 - как в записи, --speed 10 - в 10 раз быстрее, --speed 0 - без пауз.
+
+Апдейты одного пользователя обрабатываются строго по очереди, разных - параллельно,
+как при polling. В конце печатает пропускную способность и задержку обработки.
+
+    python replay.py logs/ --speed 0
+    python replay.py logs/updates-20250101-120000-000000.jsonl.gz --speed 1 --db digistore.db
+"""
+import argparse
+import asyncio
+import glob
+import gzip
+import json
+import math
+import os
+import sys
+import time
+from collections import Counter
+
+import harness
+
+# Повтор не должен писать новый лог поверх записанного
+os.environ.pop("UPDATE_LOG_DIR", None)
+
+
+def read_log(paths):
+    """Записи {"t", "update"} из файлов по порядку; оборванный хвост файла пропускается"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "updates-*.jsonl.gz"))))
+        else:
+            files.append(path)
+
+    for path in files:
+        with gzip.open(path, "rt", encoding="utf-8") as log:
+            try:
+                for line in log:
+                    if line.strip():
+                        yield json.loads(line)
+            except (EOFError, json.JSONDecodeError):
+                # Файл еще пишется или бот упал - берем все, что успело записаться
+                print(f"{path}: запись оборвана, остаток пропущен")
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def update_owner(update):
+    """id пользователя апдейта - для сохранения порядка его апдейтов"""
+    for kind, payload in update.items():
+        if isinstance(payload, dict):
+            user = payload.get("from") or payload.get("user") or payload.get("chat")
+            if isinstance(user, dict) and "id" in user:
+                return user["id"]
+    return None
+
+
+async def replay(records, speed, concurrency):
+    import geiu
+    from aiogram.types import Update
+
+    bot, session, _ = harness.install_fakes(keep_keyboards=False)
+
+    # Фоновые задачи те же, что в main()
+    background_tasks = [
+        asyncio.create_task(geiu.fsm_storage.maintain()),
+        asyncio.create_task(geiu.user_buffer.maintain()),
+        asyncio.create_task(geiu.outbox_drainer()),
+        asyncio.create_task(geiu.order_expiry_sweeper()),
+        asyncio.create_task(geiu.crypto_invoice_watcher()),
+    ]
+    if geiu.ORDER_ARCHIVE_DAYS:
+        background_tasks.append(asyncio.create_task(geiu.order_archiver()))
+
+    limit = asyncio.Semaphore(concurrency)
+    last_task = {}  # пользователь -> задача его последнего апдейта
+    latencies = []
+    lags = []
+    errors = Counter()
+
+    async def handle(update, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with limit:
+            started = time.perf_counter()
+            try:
+                await geiu.dp.feed_update(bot, update)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+            latencies.append(time.perf_counter() - started)
+
+    first_time = None
+    started = time.perf_counter()
+    count = 0
+    for record in records:
+        if first_time is None:
+            first_time = record["t"]
+
+        if speed:
+            due = started + (record["t"] - first_time) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                lags.append(-delay)
+
+        update = Update.model_validate(record["update"], context={"bot": bot})
+        owner = update_owner(record["update"])
+        task = asyncio.create_task(handle(update, last_task.get(owner)))
+        last_task[owner] = task
+        count += 1
+
+        if not speed and count % concurrency == 0:
+            # Без пауз: даем задачам поработать, чтобы не создать их миллионы сразу
+            await asyncio.sleep(0)
+
+    if last_task:
+        await asyncio.wait(list(last_task.values()))
+    wall = time.perf_counter() - started
+
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await geiu.fsm_storage.close()
+    await geiu.user_buffer.close()
+    geiu.db.close()
+
+    record_span = (record["t"] - first_time) if count else 0
+    print(f"Апдейтов: {count}, в записи {record_span:.1f} s, повтор за {wall:.2f} s "
+          f"({count / wall if wall else 0:.1f}/s, скорость x{record_span / wall if wall else 0:.1f})")
+    print(f"Обработка: p50 {percentile(latencies, 50) * 1000:.2f} ms, p95 {percentile(latencies, 95) * 1000:.2f} ms, "
+          f"p99 {percentile(latencies, 99) * 1000:.2f} ms")
+    if speed:
+        print(f"Отставание от расписания: {len(lags)} апдейтов, p99 {percentile(lags, 99) * 1000:.1f} ms")
+    print(f"Вызовы Bot API: {dict(session.calls)}")
+    if errors:
+        print(f"Ошибки: {dict(errors)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="файлы updates-*.jsonl.gz или папки с ними")
+    parser.add_argument("--speed", type=float, default=1, help="множитель скорости, 0 - без пауз")
+    parser.add_argument("--concurrency", type=int, default=100, help="апдейтов в обработке одновременно")
+    parser.add_argument("--db", help="начать с копии этой базы вместо пустой")
+    parser.add_argument("--keep", action="store_true", help="не удалять временную базу")
+    args = parser.parse_args()
+
+    # До import geiu (в replay): база - во временной папке, с копией --db
+    tmp_dir = harness.prepare("replay_", db_name="replay.db", source=args.db)
+
+    import logging
+    logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+    try:
+        asyncio.run(replay(read_log(args.paths), args.speed, args.concurrency))
+    finally:
+        if not args.keep:
+            harness.cleanup(tmp_dir)
+        else:
+            print(f"База: {os.environ['DB_PATH']}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
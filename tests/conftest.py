@@ -0,0 +1,64 @@
+"""Общая обвязка тестов: geiu импортируется один раз на временной базе.
+
+    python -m pytest -q tests
+"""
+import itertools
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+import pytest
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import harness
+
+# До import geiu: бот и база создаются при импорте
+TMP_DIR = harness.prepare("tests_", db_name="test.db")
+
+import geiu
+
+# Бот и CryptoBot без сети на всю сессию
+BOT, SESSION, CRYPTOBOT = harness.install_fakes()
+
+
+@pytest.fixture
+def bot():
+    return BOT
+
+
+@pytest.fixture
+def session():
+    """Сессия бота; счетчики вызовов обнуляются перед каждым тестом"""
+    SESSION.calls.clear()
+    return SESSION
+
+
+@pytest.fixture
+def sql():
+    """Отдельное соединение с базой теста: соединения geiu.db привязаны к его потокам"""
+    conn = sqlite3.connect(os.environ["DB_PATH"])
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def callback_update(bot):
+    """Фабрика апдейтов-нажатий: callback_update(user_id, data)"""
+    update_ids = itertools.count(1)
+
+    def make(user_id, data):
+        user = User(id=user_id, is_bot=False, first_name="user")
+        message = Message(message_id=1, date=datetime.now(), chat=Chat(id=user_id, type="private"), text="...")
+        callback = CallbackQuery(id=str(user_id), from_user=user, chat_instance=str(user_id), message=message, data=data)
+        update = Update(update_id=next(update_ids), callback_query=callback)
+        # Как в Dispatcher.feed_update: бот привязывается ко всем вложенным объектам
+        return Update.model_validate(update.model_dump(), context={"bot": bot})
+    return make
+
+
+def pytest_sessionfinish(session, exitstatus):
+    geiu.db.close()
+    harness.cleanup(TMP_DIR)
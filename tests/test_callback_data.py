@@ -0,0 +1,83 @@
+"""callback_data кнопок: pack_callback/unpack_callback и разбор старого формата "имя_арг"."""
+import pytest
+
+import geiu
+
+ORDER_BUTTONS = ["manage_order", "admin_confirm_payment", "admin_final_confirm", "admin_reject_order",
+                 "admin_final_reject", "admin_delivered", "admin_final_delivered", "card_pay", "crypto_pay",
+                 "check_crypto", "confirm_paid", "cancel_photo"]
+PLAIN_BUTTONS = ["main_menu", "buy_stars", "buy_premium", "exchange", "info", "admin_active_orders",
+                 "admin_stats", "admin_back"]
+
+
+def route(data):
+    unpacked = geiu.unpack_callback(data)
+    return unpacked and (unpacked[0].name, unpacked[1])
+
+
+def test_every_action_is_covered():
+    assert set(geiu.CALLBACK_ACTIONS) == set(ORDER_BUTTONS + PLAIN_BUTTONS + ["premium", "orders_page"])
+
+
+@pytest.mark.parametrize("name, args, parsed", [
+    *[(name, [], []) for name in PLAIN_BUTTONS],
+    *[(name, [9_999_999_999], [9_999_999_999]) for name in ORDER_BUTTONS],
+    ("premium", ["6m"], ["6m"]),
+    ("orders_page", ["wconf", "n"], ["wconf", "n"]),
+    # Курсор страницы: created_at цифрами туда, обратно - в формате SQLite
+    ("orders_page", ["all", "p", "20250131235958", 42], ["all", "p", "2025-01-31 23:59:58", 42]),
+])
+def test_round_trip(name, args, parsed):
+    data = geiu.pack_callback(name, *args)
+    assert data.startswith(geiu.CALLBACK_VERSION)
+    assert len(data.encode()) <= 64
+    assert route(data) == (name, parsed)
+
+
+@pytest.mark.parametrize("data, expected", [
+    ("main_menu", ("main_menu", [])),
+    ("admin_active_orders", ("admin_active_orders", [])),
+    ("premium_3m", ("premium", ["3m"])),
+    ("premium_1y", ("premium", ["1y"])),
+    ("manage_order_42", ("manage_order", [42])),
+    ("admin_final_confirm_42", ("admin_final_confirm", [42])),
+    ("admin_confirm_payment_7", ("admin_confirm_payment", [7])),
+    ("cancel_photo_5", ("cancel_photo", [5])),
+    ("check_crypto_123", ("check_crypto", [123])),
+])
+def test_legacy_buttons_still_route(data, expected):
+    # Кнопки, отправленные до перехода на новый формат
+    assert route(data) == expected
+
+
+@pytest.mark.parametrize("data", [
+    "",
+    "unknown",
+    "1zz:1",  # неизвестный код
+    "1mo",  # не хватает order_id
+    "1mo:1:2",  # лишний аргумент
+    "1mo:abc",  # не число
+    "1pp:2y",  # нет такого периода
+    "1op:all:x",  # неверное направление
+    "1op:all:n:2025:1",  # неверный курсор
+    "premium_2y",
+    "manage_order_abc",
+    "admin_final_confirm",  # старая кнопка без order_id
+])
+def test_foreign_or_broken_data_is_rejected(data):
+    assert geiu.unpack_callback(data) is None
+
+
+def test_pack_refuses_what_cannot_be_unpacked():
+    with pytest.raises(ValueError):
+        geiu.pack_callback("manage_order", "1:2")
+    with pytest.raises(ValueError):
+        geiu.pack_callback("premium", "x" * 64)
+
+
+def test_duplicate_registration_is_refused():
+    with pytest.raises(ValueError):
+        geiu.callback_route("main_menu", code="zz")(lambda callback: None)
+    with pytest.raises(ValueError):
+        geiu.callback_route("brand_new", code="mm")(lambda callback: None)
+    assert "brand_new" not in geiu.CALLBACK_ACTIONS
@@ -0,0 +1,92 @@
+"""CryptoBotAPI против локального сервера-заглушки: зависший createInvoice не блокирует event loop.
+
+    python -m pytest -q tests
+"""
+import asyncio
+import time
+
+from aiohttp import web
+
+import geiu
+
+INVOICE_TIMEOUT = 1.0  # секунд на зависший createInvoice
+
+
+async def start_stand_in():
+    """Заглушка pay.crypt.bot: createInvoice не отвечает никогда, getInvoices отвечает сразу"""
+    hang = asyncio.Event()
+
+    async def create_invoice(request):
+        await hang.wait()
+        return web.json_response({"ok": False})
+
+    async def get_invoices(request):
+        ids = request.query["invoice_ids"].split(",")
+        return web.json_response({"ok": True, "result": {"items": [
+            {"invoice_id": int(invoice_id), "status": "active"} for invoice_id in ids
+        ]}})
+
+    app = web.Application()
+    app.router.add_post("/api/createInvoice", create_invoice)
+    app.router.add_get("/api/getInvoices", get_invoices)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, hang, f"http://127.0.0.1:{port}/api"
+
+
+async def ticker(stop, gaps):
+    """Другая работа бота: максимальный интервал между шагами показывает блокировку loop"""
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(0.01)
+        now = time.perf_counter()
+        gaps.append(now - last)
+        last = now
+
+
+async def hanging_invoice_scenario():
+    runner, hang, base_url = await start_stand_in()
+    client = geiu.CryptoBotAPI("TOKEN", base_url=base_url, max_concurrency=4)
+    await client.start()
+    try:
+        stop = asyncio.Event()
+        gaps = []
+        ticks = asyncio.create_task(ticker(stop, gaps))
+
+        started = time.perf_counter()
+        hung = asyncio.create_task(client.create_invoice(100, timeout=INVOICE_TIMEOUT))
+        await asyncio.sleep(0.1)
+
+        # Пока счет висит, проверки счетов идут параллельно и быстро
+        checks = await asyncio.gather(*(client.get_invoices([i, i + 1]) for i in range(20)))
+        checks_time = time.perf_counter() - started
+        assert not hung.done()
+
+        result = await hung
+        hung_time = time.perf_counter() - started
+        stop.set()
+        await ticks
+        return checks, checks_time, result, hung_time, gaps
+    finally:
+        hang.set()
+        await client.close()
+        await runner.cleanup()
+
+
+def test_hanging_invoice_does_not_block_other_work():
+    checks, checks_time, result, hung_time, gaps = asyncio.run(hanging_invoice_scenario())
+
+    assert all(check["success"] for check in checks)
+    assert [item["invoice_id"] for item in checks[3]["items"]] == [3, 4]
+    assert checks_time < INVOICE_TIMEOUT
+
+    # Зависший вызов завершается по своему таймауту, а не по общему CRYPTOBOT_TIMEOUT
+    assert result == {"success": False, "error": "Timeout"}
+    assert INVOICE_TIMEOUT * 0.9 <= hung_time < INVOICE_TIMEOUT + 1
+
+    # Event loop все это время не стоял
+    assert len(gaps) > 20
+    assert max(gaps) < 0.2
@@ -0,0 +1,122 @@
+"""SQLiteStorage: состояния переживают перезапуск, пустые и просроченные записи удаляются, кэш ограничен."""
+import asyncio
+import itertools
+
+from aiogram.fsm.storage.base import StorageKey
+
+import geiu
+
+user_ids = itertools.count(30_000)
+
+
+def new_key():
+    user_id = next(user_ids)
+    return StorageKey(bot_id=42, chat_id=user_id, user_id=user_id)
+
+
+def stored(sql, storage, key):
+    return sql.execute(
+        "SELECT state, data FROM fsm_storage WHERE key = ?", (storage._make_key(key),)
+    ).fetchone()
+
+
+def test_state_and_data_survive_restart(sql):
+    key = new_key()
+
+    async def scenario():
+        storage = geiu.SQLiteStorage(geiu.db)
+        await storage.set_state(key, "Form:amount")
+        await storage.set_data(key, {"order_id": 7, "recipient": "кто-то"})
+        await storage.close()
+
+        restarted = geiu.SQLiteStorage(geiu.db)
+        return await restarted.get_state(key), await restarted.get_data(key)
+
+    assert asyncio.run(scenario()) == ("Form:amount", {"order_id": 7, "recipient": "кто-то"})
+    assert stored(sql, geiu.SQLiteStorage(geiu.db), key)[0] == "Form:amount"
+
+
+def test_returned_data_is_a_copy():
+    key = new_key()
+
+    async def scenario():
+        storage = geiu.SQLiteStorage(geiu.db)
+        data = {"items": 1}
+        await storage.set_data(key, data)
+        data["items"] = 2
+        (await storage.get_data(key))["items"] = 3
+        return await storage.get_data(key)
+
+    assert asyncio.run(scenario()) == {"items": 1}
+
+
+def test_cleared_entry_is_deleted(sql):
+    key = new_key()
+    storage = geiu.SQLiteStorage(geiu.db)
+
+    async def scenario():
+        await storage.set_state(key, "Form:amount")
+        await storage.flush()
+        assert stored(sql, storage, key)
+        await storage.set_state(key, None)
+        await storage.set_data(key, {})
+        await storage.flush()
+
+    asyncio.run(scenario())
+    assert stored(sql, storage, key) is None
+
+
+def test_expired_entry_reads_empty(sql):
+    key = new_key()
+
+    async def scenario():
+        storage = geiu.SQLiteStorage(geiu.db, ttl=-1)
+        await storage.set_state(key, "Form:amount")
+        await storage.set_data(key, {"order_id": 7})
+        await storage.flush()
+        assert stored(sql, storage, key)
+        # Просрочена и в памяти, и в SQLite
+        restarted = geiu.SQLiteStorage(geiu.db)
+        return (await storage.get_state(key), await storage.get_data(key),
+                await restarted.get_state(key), await restarted.get_data(key))
+
+    assert asyncio.run(scenario()) == (None, {}, None, {})
+
+
+def test_unsaved_entries_are_not_evicted():
+    keys = [new_key() for _ in range(3)]
+
+    async def scenario():
+        storage = geiu.SQLiteStorage(geiu.db, max_cached=1)
+        for number, key in enumerate(keys):
+            await storage.set_data(key, {"n": number})
+        # Лимит превышен, но несохраненное из памяти не уходит
+        assert len(storage._cache) == 3
+        await storage.flush()
+        assert len(storage._cache) == 1
+        # Выгруженные записи читаются из SQLite
+        return [await storage.get_data(key) for key in keys]
+
+    assert asyncio.run(scenario()) == [{"n": 0}, {"n": 1}, {"n": 2}]
+
+
+def test_full_batch_wakes_the_flush_loop(sql, monkeypatch):
+    monkeypatch.setattr(geiu, "FSM_FLUSH_BATCH", 2)
+    keys = [new_key() for _ in range(2)]
+    storage = geiu.SQLiteStorage(geiu.db)
+
+    async def scenario():
+        maintain = asyncio.create_task(storage.maintain())
+        try:
+            for key in keys:
+                await storage.set_state(key, "Form:amount")
+            # Пачка набралась - запись не ждет FSM_FLUSH_INTERVAL
+            for _ in range(50):
+                if not storage._dirty:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            maintain.cancel()
+
+    asyncio.run(scenario())
+    assert all(stored(sql, storage, key) for key in keys)
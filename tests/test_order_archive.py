@@ -0,0 +1,64 @@
+"""Архив заказов: переносятся заказы, завершенные больше ORDER_ARCHIVE_DAYS назад."""
+import asyncio
+import itertools
+
+import geiu
+
+user_ids = itertools.count(40_000)
+DAY = 86400
+
+
+async def finished_order(sql, status, created_days_ago, finished_days_ago):
+    order_id = await geiu.db.add_order(next(user_ids), "stars", "someone", 100.0, "card", stars=50)
+    if status == "completed":
+        assert await geiu.db.update_order_status(order_id, "confirmed")
+    assert await geiu.db.update_order_status(order_id, status)
+    status_changed_at = f"datetime('now', '-{finished_days_ago} days')" if finished_days_ago is not None else "NULL"
+    sql.execute(
+        f"UPDATE orders SET created_at = datetime('now', ?), status_changed_at = {status_changed_at} WHERE id = ?",
+        (f"-{created_days_ago} days", order_id)
+    )
+    sql.commit()
+    geiu.db.invalidate_order(order_id)
+    return order_id
+
+
+def archived(sql, order_ids):
+    return {order_id for (order_id,) in sql.execute("SELECT id FROM orders_archive").fetchall()} & set(order_ids)
+
+
+def test_age_counts_from_completion(sql):
+    async def scenario():
+        orders = {
+            "old, just completed": await finished_order(sql, "completed", 40, 0),
+            "old, long cancelled": await finished_order(sql, "cancelled", 40, 31),
+            # Завершен до миграции 8: status_changed_at пустой, возраст - от создания
+            "before migration": await finished_order(sql, "completed", 40, None),
+            "new, before migration": await finished_order(sql, "completed", 1, None),
+        }
+        while await geiu.db.archive_orders(30 * DAY, 100):
+            pass
+        return orders
+
+    orders = asyncio.run(scenario())
+    assert archived(sql, orders.values()) == {orders["old, long cancelled"], orders["before migration"]}
+
+
+def test_archive_keeps_every_order_column(sql):
+    orders_columns = [row[1] for row in sql.execute("PRAGMA table_info(orders)")]
+    archive_columns = [row[1] for row in sql.execute("PRAGMA table_info(orders_archive)")]
+    assert set(orders_columns) <= set(archive_columns)
+
+    async def scenario():
+        order_id = await finished_order(sql, "completed", 40, 31)
+        before = await geiu.db.get_order(order_id)
+        while await geiu.db.archive_orders(30 * DAY, 100):
+            pass
+        geiu.db.invalidate_order(order_id)
+        return order_id, before, await geiu.db.get_order(order_id)
+
+    order_id, before, after = asyncio.run(scenario())
+    assert archived(sql, [order_id]) == {order_id}
+    # get_order читает архив через UNION ALL - заказ тот же, со временем завершения
+    assert after == before
+    assert after.status_changed_at is not None
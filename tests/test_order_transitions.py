@@ -0,0 +1,94 @@
+"""Переходы статусов заказа: ORDER_TRANSITIONS, compare-and-set и order_status_history."""
+import asyncio
+import itertools
+import logging
+
+import pytest
+
+import geiu
+
+STATUSES = list(geiu.ORDER_TRANSITIONS)
+REFUSED = [(old, new) for old in STATUSES for new in STATUSES if not geiu.can_change_status(old, new)]
+# Кратчайший путь из pending в каждый статус
+PATHS = {
+    "pending": [],
+    "waiting_payment": ["waiting_payment"],
+    "waiting_crypto": ["waiting_crypto"],
+    "waiting_confirmation": ["waiting_payment", "waiting_confirmation"],
+    "confirmed": ["confirmed"],
+    "completed": ["confirmed", "completed"],
+    "cancelled": ["cancelled"],
+}
+
+user_ids = itertools.count(10_000)
+
+
+async def new_order(status="pending"):
+    order_id = await geiu.db.add_order(next(user_ids), "stars", "someone", 100.0, "card", stars=50)
+    for step in PATHS[status]:
+        assert await geiu.db.update_order_status(order_id, step)
+    return order_id
+
+
+def history(sql, order_id):
+    return sql.execute(
+        "SELECT old_status, new_status FROM order_status_history WHERE order_id = ? ORDER BY id", (order_id,)
+    ).fetchall()
+
+
+def test_allowed_path_writes_history(sql):
+    async def scenario():
+        order_id = await new_order("waiting_confirmation")
+        assert await geiu.db.update_order_status(order_id, "confirmed")
+        assert await geiu.db.update_order_status(order_id, "completed")
+        return order_id
+
+    order_id = asyncio.run(scenario())
+    assert history(sql, order_id) == [
+        (None, "pending"), ("pending", "waiting_payment"), ("waiting_payment", "waiting_confirmation"),
+        ("waiting_confirmation", "confirmed"), ("confirmed", "completed"),
+    ]
+
+
+@pytest.mark.parametrize("old_status, new_status", REFUSED)
+def test_refused_transition_changes_nothing(sql, old_status, new_status):
+    async def scenario():
+        order_id = await new_order(old_status)
+        before = history(sql, order_id)
+        assert not await geiu.db.update_order_status(order_id, new_status)
+        return order_id, before, await geiu.db.get_order(order_id)
+
+    order_id, before, order = asyncio.run(scenario())
+    assert order.status == old_status
+    assert history(sql, order_id) == before
+
+
+def test_concurrent_transitions_have_one_winner(sql):
+    async def scenario():
+        order_id = await new_order("waiting_confirmation")
+        results = await asyncio.gather(
+            geiu.db.update_order_status(order_id, "confirmed"),
+            geiu.db.update_order_status(order_id, "cancelled"),
+        )
+        return order_id, results, await geiu.db.get_order(order_id)
+
+    order_id, results, order = asyncio.run(scenario())
+    assert sorted(results) == [False, True]
+    assert order.status == ("confirmed", "cancelled")[results.index(True)]
+    assert history(sql, order_id)[-1] == ("waiting_confirmation", order.status)
+
+
+def test_repeated_card_pay_is_not_a_refused_transition(bot, session, callback_update, caplog):
+    async def scenario():
+        order_id = await new_order()
+        order = await geiu.db.get_order(order_id)
+        for _ in range(2):
+            await geiu.dp.feed_update(bot, callback_update(order.user_id, geiu.pack_callback("card_pay", order_id)))
+        return order_id
+
+    with caplog.at_level(logging.INFO, logger="geiu"):
+        order_id = asyncio.run(scenario())
+
+    assert not [record for record in caplog.records if "отклонен" in record.getMessage()]
+    assert session.calls["EditMessageText"] == 2
+    assert asyncio.run(geiu.db.get_order(order_id)).status == "waiting_payment"
@@ -0,0 +1,124 @@
+"""Outbox: дедупликация, повторы с backoff и не больше OUTBOX_CHAT_BATCH сообщений чата за проход."""
+import asyncio
+import time
+
+import pytest
+
+import geiu
+
+
+@pytest.fixture(autouse=True)
+def empty_outbox(sql):
+    sql.execute("DELETE FROM outbox")
+    sql.commit()
+
+
+def message(chat_id, text):
+    return (chat_id, "send_message", {"text": text})
+
+
+def rows(sql):
+    return sql.execute("SELECT chat_id, payload, status, attempts, next_attempt_at FROM outbox ORDER BY id").fetchall()
+
+
+def test_same_dedupe_prefix_is_queued_once(sql):
+    async def scenario():
+        for _ in range(2):
+            await geiu.db.add_notifications("test:dedupe", 1, [message(None, "a"), message(2, "b")])
+
+    asyncio.run(scenario())
+    assert [(chat_id, payload) for chat_id, payload, *_ in rows(sql)] == [(1, '{"text": "a"}'), (2, '{"text": "b"}')]
+
+
+def test_refused_transition_queues_nothing(sql):
+    async def scenario():
+        order_id = await geiu.db.add_order(20_001, "stars", "someone", 100.0, "card", stars=50)
+        notifications = [message(None, "отменен")]
+        assert await geiu.db.update_order_status(order_id, "cancelled", notifications)
+        assert not await geiu.db.update_order_status(order_id, "cancelled", notifications)
+
+    asyncio.run(scenario())
+    assert len(rows(sql)) == 1
+
+
+def test_one_message_per_chat_per_pass(session, sql):
+    async def scenario():
+        await geiu.db.add_notifications("test:busy", 1, [message(1, f"busy {n}") for n in range(3)])
+        await geiu.db.add_notifications("test:quiet", 2, [message(2, "quiet")])
+
+        due = await geiu.db.get_due_outbox(geiu.OUTBOX_BATCH)
+        assert [(chat_id, payload) for _, chat_id, _, payload, _ in due] == [(1, '{"text": "busy 0"}'), (2, '{"text": "quiet"}')]
+
+        # Загруженный чат получает по сообщению за проход, по порядку
+        passes = []
+        while taken := await geiu.deliver_outbox_batch():
+            passes.append(taken)
+        return passes
+
+    assert asyncio.run(scenario()) == [2, 1, 1]
+    assert session.calls["SendMessage"] == 4
+    assert {status for _, _, status, _, _ in rows(sql)} == {"sent"}
+
+
+def test_failed_delivery_backs_off_and_holds_the_chat(session, sql, monkeypatch):
+    deliver = geiu.notifier.deliver
+    down = {1}
+
+    async def flaky_deliver(chat_id, method, **kwargs):
+        if chat_id in down:
+            raise RuntimeError("network down")
+        return await deliver(chat_id, method, **kwargs)
+
+    monkeypatch.setattr(geiu.notifier, "deliver", flaky_deliver)
+
+    async def scenario():
+        await geiu.db.add_notifications("test:flaky", 1, [message(1, "first"), message(1, "second")])
+        await geiu.db.add_notifications("test:other", 2, [message(2, "other")])
+        started = time.time()
+        await geiu.deliver_outbox_batch()
+
+        first, second, other = rows(sql)
+        assert other[2] == "sent"
+        assert first[2:4] == ("pending", 1)
+        assert first[4] >= started + geiu.OUTBOX_BACKOFF_BASE
+        # Второе сообщение чата не обгоняет первое, пока то ждет повтора
+        assert await geiu.deliver_outbox_batch() == 0
+        assert second[2:4] == ("pending", 0)
+
+        # Срок повтора настал и сеть вернулась - оба уходят по порядку
+        sql.execute("UPDATE outbox SET next_attempt_at = 0 WHERE status = 'pending'")
+        sql.commit()
+        down.clear()
+        while await geiu.deliver_outbox_batch():
+            pass
+
+    asyncio.run(scenario())
+    assert [(payload, status) for _, payload, status, _, _ in rows(sql)] == [
+        ('{"text": "first"}', "sent"), ('{"text": "second"}', "sent"), ('{"text": "other"}', "sent")
+    ]
+    assert session.calls["SendMessage"] == 3
+
+
+def test_backoff_doubles_until_the_message_fails(sql, monkeypatch):
+    async def broken_deliver(chat_id, method, **kwargs):
+        raise RuntimeError("network down")
+
+    monkeypatch.setattr(geiu.notifier, "deliver", broken_deliver)
+
+    async def scenario():
+        await geiu.db.add_notifications("test:broken", 3, [message(3, "never")])
+        delays = []
+        for _ in range(geiu.OUTBOX_MAX_ATTEMPTS):
+            started = time.time()
+            await geiu.deliver_outbox_batch()
+            _, _, status, attempts, next_attempt_at = rows(sql)[0]
+            if status == "pending":
+                delays.append(round(next_attempt_at - started))
+                sql.execute("UPDATE outbox SET next_attempt_at = 0")
+                sql.commit()
+        return delays, rows(sql)[0]
+
+    delays, (_, _, status, attempts, _) = asyncio.run(scenario())
+    assert delays == [min(geiu.OUTBOX_BACKOFF_BASE * 2 ** n, geiu.OUTBOX_BACKOFF_MAX)
+                      for n in range(geiu.OUTBOX_MAX_ATTEMPTS - 1)]
+    assert (status, attempts) == ("failed", geiu.OUTBOX_MAX_ATTEMPTS)
@@ -0,0 +1,115 @@
+"""UpdateScheduler: лимиты классов, отбрасывание по очереди и по ожиданию, гонка таймаута с выдачей места."""
+import asyncio
+
+import geiu
+
+
+def release(scheduler, update_class):
+    """То, что делает __call__ после обработки апдейта"""
+    scheduler._running[update_class] -= 1
+    scheduler._total_running -= 1
+    scheduler._dispatch()
+
+
+def test_full_queue_sheds_immediately():
+    async def scenario():
+        scheduler = geiu.UpdateScheduler(classes={"c": (0, 1, 1, None)}, workers=1)
+        assert await scheduler._acquire("c")
+        waiting = asyncio.create_task(scheduler._acquire("c"))
+        await asyncio.sleep(0)
+
+        # Очередь из одного места занята - третий апдейт отбрасывается сразу
+        assert not await scheduler._acquire("c")
+
+        release(scheduler, "c")
+        assert await waiting
+        assert scheduler.running() == {("c",): 1}
+        assert scheduler.queue_depths() == {("c",): 0}
+
+    asyncio.run(scenario())
+
+
+def test_wait_longer_than_limit_sheds():
+    async def scenario():
+        scheduler = geiu.UpdateScheduler(classes={"c": (0, 1, None, 0.05)}, workers=1)
+        assert await scheduler._acquire("c")
+        assert not await scheduler._acquire("c")
+        assert scheduler.queue_depths() == {("c",): 0}
+
+        release(scheduler, "c")
+        assert scheduler.running() == {("c",): 0}
+        assert await scheduler._acquire("c")
+
+    asyncio.run(scenario())
+
+
+def test_freed_slot_goes_to_higher_priority_class():
+    async def scenario():
+        scheduler = geiu.UpdateScheduler(classes={"high": (0, 1, None, None), "low": (1, 1, None, None)}, workers=1)
+        assert await scheduler._acquire("low")
+        order = []
+
+        async def acquire(update_class):
+            await scheduler._acquire(update_class)
+            order.append(update_class)
+
+        low = asyncio.create_task(acquire("low"))
+        await asyncio.sleep(0)
+        high = asyncio.create_task(acquire("high"))
+        await asyncio.sleep(0)
+
+        release(scheduler, "low")
+        await high
+        assert order == ["high"] and not low.done()
+
+        release(scheduler, "high")
+        await low
+        assert order == ["high", "low"]
+
+    asyncio.run(scenario())
+
+
+def test_timeout_racing_dispatch_sheds_cleanly():
+    async def scenario():
+        scheduler = geiu.UpdateScheduler(classes={"c": (0, 1, None, 0.05)}, workers=1)
+        assert await scheduler._acquire("c")
+        loop = asyncio.get_running_loop()
+
+        waiting = asyncio.create_task(scheduler._acquire("c"))
+        await asyncio.sleep(0)
+        # Место освобождается сразу после таймаута wait_for: _dispatch вынимает уже
+        # отмененный future раньше, чем _acquire успевает убрать его сам
+        loop.call_at(loop.time() + 0.05, lambda: loop.call_soon(release, scheduler, "c"))
+
+        assert await waiting is False
+        assert scheduler.running() == {("c",): 0}
+        assert scheduler.queue_depths() == {("c",): 0}
+        assert await scheduler._acquire("c")
+
+    asyncio.run(scenario())
+
+
+def test_shed_callback_is_answered_and_not_handled(session, callback_update):
+    async def scenario():
+        scheduler = geiu.UpdateScheduler(classes=dict(geiu.UPDATE_CLASSES, browsing=(3, 1, None, 0.05)), workers=1)
+        busy, handled = asyncio.Event(), []
+
+        async def handler(event, data):
+            handled.append(event.update_id)
+            await busy.wait()
+
+        first = callback_update(101, "about")
+        running = asyncio.create_task(scheduler(handler, first, {}))
+        await asyncio.sleep(0)
+
+        shed_before = geiu.update_shed._values.get(("browsing",), 0)
+        result = await scheduler(handler, callback_update(102, "about"), {})
+        busy.set()
+        await running
+
+        assert result is geiu.UNHANDLED
+        assert handled == [first.update_id]
+        assert session.calls["AnswerCallbackQuery"] == 1
+        assert geiu.update_shed._values[("browsing",)] == shed_before + 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,96 @@
+"""KeyedLock и serialize_updates: апдейты одного ключа по очереди, разных - параллельно."""
+import asyncio
+
+import geiu
+
+
+def test_same_key_runs_in_arrival_order():
+    async def scenario():
+        locks = geiu.KeyedLock()
+        order = []
+
+        async def work(name, delay):
+            async with locks.hold("key"):
+                order.append(f"{name}+")
+                await asyncio.sleep(delay)
+                order.append(f"{name}-")
+
+        # Первый держит ключ дольше всех - остальные все равно ждут его и идут по порядку
+        await asyncio.gather(work("a", 0.03), work("b", 0), work("c", 0.01))
+        assert order == ["a+", "a-", "b+", "b-", "c+", "c-"]
+        assert len(locks) == 0
+
+    asyncio.run(scenario())
+
+
+def test_different_keys_run_in_parallel():
+    async def scenario():
+        locks = geiu.KeyedLock()
+        inside = set()
+        overlap = []
+
+        async def work(key):
+            async with locks.hold(key):
+                inside.add(key)
+                await asyncio.sleep(0.01)
+                overlap.append(len(inside))
+                inside.discard(key)
+
+        await asyncio.gather(work(1), work(2), work(3))
+        assert max(overlap) == 3
+
+    asyncio.run(scenario())
+
+
+def test_entry_counts_waiters_and_survives_errors():
+    async def scenario():
+        locks = geiu.KeyedLock()
+        release = asyncio.Event()
+
+        async def failing():
+            async with locks.hold("key"):
+                await release.wait()
+                raise RuntimeError("handler failed")
+
+        async def waiting():
+            async with locks.hold("key"):
+                return "done"
+
+        first = asyncio.create_task(failing())
+        await asyncio.sleep(0)
+        second = asyncio.create_task(waiting())
+        await asyncio.sleep(0)
+        assert (len(locks), locks.waiting()) == (1, 1)
+
+        release.set()
+        results = await asyncio.gather(first, second, return_exceptions=True)
+        assert isinstance(results[0], RuntimeError) and results[1] == "done"
+        assert (len(locks), locks.waiting()) == (0, 0)
+
+    asyncio.run(scenario())
+
+
+def test_lock_key_by_user_and_by_order_for_admins(callback_update):
+    admin_id, user_id = geiu.ADMIN_IDS[0], 555
+
+    assert geiu.update_lock_key(callback_update(user_id, geiu.pack_callback("card_pay", 7))) == ("user", user_id)
+    # Два админа у одного заказа - один ключ
+    assert geiu.update_lock_key(callback_update(admin_id, geiu.pack_callback("admin_final_confirm", 7))) == ("order", 7)
+    assert geiu.update_lock_key(callback_update(admin_id, geiu.pack_callback("admin_stats"))) == ("user", admin_id)
+
+
+def test_serialize_updates_orders_updates_of_one_user(callback_update):
+    async def scenario():
+        order = []
+
+        async def handler(event, data):
+            order.append(event.update_id)
+            await asyncio.sleep(0.02 if len(order) == 1 else 0)
+            order.append(-event.update_id)
+
+        updates = [callback_update(777, geiu.pack_callback("main_menu")) for _ in range(3)]
+        await asyncio.gather(*(geiu.serialize_updates(handler, update, {}) for update in updates))
+        ids = [update.update_id for update in updates]
+        assert order == [ids[0], -ids[0], ids[1], -ids[1], ids[2], -ids[2]]
+
+    asyncio.run(scenario())
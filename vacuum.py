@@ -0,0 +1,46 @@
+"""Перевод существующей базы в режим auto_vacuum=INCREMENTAL.
+
+Новая база создается ботом сразу в этом режиме. Базу, созданную раньше, переводит только
+полный VACUUM: он переписывает весь файл, держит базу заблокированной все время работы
+и требует на диске еще столько же места, сколько занимает база. Поэтому бот сам его не
+запускает - перевод делается один раз этим скриптом при остановленном боте. После него
+order_archiver возвращает ОС место, освобожденное архивом заказов.
+
+    python vacuum.py
+    python vacuum.py --db /data/digistore.db
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=os.environ.get("DB_PATH", "digistore.db"))
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"Нет базы {args.db}")
+        return 1
+
+    conn = sqlite3.connect(args.db)
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        print(f"{args.db} уже в режиме auto_vacuum=INCREMENTAL")
+        return 0
+
+    size = os.path.getsize(args.db)
+    started = time.perf_counter()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+    print(f"{args.db}: auto_vacuum=INCREMENTAL за {time.perf_counter() - started:.1f} s, "
+          f"{size / 2 ** 20:.1f} MB -> {os.path.getsize(args.db) / 2 ** 20:.1f} MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())